@@ -0,0 +1,689 @@
+#!/usr/bin/python
+""" An event loop client for the node's xmlrpc surface.  The other scripts get
+concurrency from a thread or a process per call, here a single thread keeps
+thousands of calls outstanding: calls are queued on a Client and written to a
+pool of keep alive HTTP/1.1 connections, all non-blocking sockets on one
+poll loop.
+
+Every call returns a Call at once.  A Call has a deadline (the timeout from
+when it was made, queueing included) after which it fails with Timeout, can be
+cancelled, takes callbacks run when it is done and, once done, gives its
+result or raises its error.  Client.wait runs the loop until the given calls
+are done.
+
+  client = Client(10000)
+  calls = [client.info(addr, timeout = 10) for addr in addrs]
+  client.wait(calls)
+  infos = [c.result() for c in calls if c.error == None]
+
+Besides localproxy, proxy and uriproxy there are typed helpers for
+Information.Info, the DhtClient methods, trace.GetRouteTo and
+ncserver.ComputePathLatencyTo, and a select argument decoding only some
+member paths of the result (see xmlselect.py).
+Only the standard library is used. """
+import xmlrpclib, xmlselect, socket, select, errno, heapq, collections, \
+  sys, getopt, time, unittest
+
+usage = """usage:
+python asyncbru.py [--port=<xmlrpc port>] [--connections=<count>]
+  [--timeout=<seconds>] <action> <args>
+action is one of
+  info <address> [<address> ...]
+  get <key> [<key> ...]
+  route <address> [<address> ...]
+  test = run the unit tests against a ringemu.py ring
+port = the xmlrpc port for the local brunet node
+connections = maximum number of connections to the node, default 64
+timeout = deadline of each call in seconds, default 30"""
+
+def main():
+  try:
+    optlist, args = getopt.getopt(sys.argv[1:], "", ["port=", "connections=", \
+      "timeout="])
+    o_d = {}
+    for k,v in optlist:
+      o_d[k] = v
+    port = int(o_d.get("--port", 10000))
+    connections = int(o_d.get("--connections", 64))
+    timeout = float(o_d.get("--timeout", 30))
+    action = args[0]
+  except:
+    print usage
+    return
+
+  if action == "test":
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestAsyncBru)
+    unittest.TextTestRunner(verbosity=1).run(suite)
+    return
+  client = Client(port, connections = connections)
+  if action == "info":
+    calls = [client.info(addr, timeout = timeout) for addr in args[1:]]
+  elif action == "get":
+    calls = [client.get(key, timeout = timeout) for key in args[1:]]
+  elif action == "route":
+    calls = [client.route_to(addr, timeout = timeout) for addr in args[1:]]
+  else:
+    print usage
+    return
+  client.wait(calls)
+  for arg, call in zip(args[1:], calls):
+    if call.error != None:
+      print "%s error %s" % (arg, call.error)
+    else:
+      print "%s %s" % (arg, call.result())
+
+class Timeout(Exception):
+  pass
+
+class Cancelled(Exception):
+  pass
+
+class Loop:
+  """poll on the registered sockets and run the timers that are due"""
+  def __init__(self):
+    # fd -> connection, each connection has handle_read and handle_write
+    self.handlers = {}
+    # [when, sequence, function] entries, a cancelled timer has no function
+    self.timers = []
+    self.sequence = 0
+    self.poller = None
+    if hasattr(select, "poll"):
+      self.poller = select.poll()
+    self.events = {}
+
+  def register(self, fd, handler, write):
+    self.handlers[fd] = handler
+    events = select.POLLOUT if write else select.POLLIN
+    if self.poller == None:
+      pass
+    elif fd in self.events:
+      self.poller.modify(fd, events)
+    else:
+      self.poller.register(fd, events)
+    self.events[fd] = events
+
+  def unregister(self, fd):
+    if fd in self.handlers:
+      del self.handlers[fd]
+      del self.events[fd]
+      if self.poller != None:
+        self.poller.unregister(fd)
+
+  def call_at(self, when, function):
+    self.sequence += 1
+    timer = [when, self.sequence, function]
+    heapq.heappush(self.timers, timer)
+    return timer
+
+  def cancel_timer(self, timer):
+    timer[2] = None
+
+  def poll(self, timeout):
+    if self.poller != None:
+      return self.poller.poll(int(timeout * 1000) if timeout != None else None)
+    reads = [fd for fd, e in self.events.items() if e == select.POLLIN]
+    writes = [fd for fd, e in self.events.items() if e == select.POLLOUT]
+    if len(reads) == 0 and len(writes) == 0:
+      time.sleep(timeout or 0)
+      return []
+    r, w, x = select.select(reads, writes, [], timeout)
+    return [(fd, select.POLLIN) for fd in r] + [(fd, select.POLLOUT) for fd in w]
+
+  def run_once(self, timeout = None):
+    while len(self.timers) > 0 and self.timers[0][2] == None:
+      heapq.heappop(self.timers)
+    if len(self.timers) > 0:
+      wait = max(0, self.timers[0][0] - time.time())
+      timeout = wait if timeout == None else min(timeout, wait)
+    try:
+      ready = self.poll(timeout)
+    except (select.error, IOError), e:
+      if e.args[0] != errno.EINTR:
+        raise
+      ready = []
+    for fd, events in ready:
+      handler = self.handlers.get(fd)
+      if handler == None:
+        continue
+      if events & select.POLLOUT and self.events.get(fd) == select.POLLOUT:
+        handler.handle_write()
+      elif events & (select.POLLIN | select.POLLHUP | select.POLLERR):
+        handler.handle_read()
+    now = time.time()
+    while len(self.timers) > 0 and self.timers[0][0] <= now:
+      when, sequence, function = heapq.heappop(self.timers)
+      if function != None:
+        function()
+
+  def run(self, until, timeout = None):
+    """Runs until the function until returns true, or for timeout seconds,
+    returns until()"""
+    end = None
+    if timeout != None:
+      end = time.time() + timeout
+    while not until():
+      if len(self.handlers) == 0 and len(self.timers) == 0:
+        break
+      if end == None:
+        self.run_once()
+      else:
+        left = end - time.time()
+        if left <= 0:
+          break
+        self.run_once(left)
+    return until()
+
+class Call:
+  """A call to the node, done once it has a result or an error (a Fault,
+  socket.error, xmlrpclib.ProtocolError, Timeout or Cancelled)"""
+  def __init__(self, client, body, select = None, convert = None):
+    self.client = client
+    self.body = body
+    self.select = select
+    self.convert = convert
+    self.start = time.time()
+    self.end = None
+    self.value = None
+    self.error = None
+    self.callbacks = []
+    self.timer = None
+    self.connection = None
+
+  def done(self):
+    return self.end != None
+
+  def result(self):
+    if not self.done():
+      raise ValueError("call is not done")
+    if self.error != None:
+      raise self.error
+    return self.value
+
+  def seconds(self):
+    return (self.end or time.time()) - self.start
+
+  def add_callback(self, callback):
+    """callback(call) is run when the call is done, at once if it is"""
+    if self.done():
+      callback(self)
+    else:
+      self.callbacks.append(callback)
+
+  def cancel(self):
+    """Fails the call with Cancelled unless it is done already, a request
+    already sent loses its connection"""
+    self.client.abort(self, Cancelled())
+
+  def finish(self, value = None, error = None):
+    if self.done():
+      return
+    if error == None and self.convert != None:
+      try:
+        value = self.convert(value)
+      except Exception, e:
+        error = e
+    self.end = time.time()
+    self.value = value
+    self.error = error
+    if self.timer != None:
+      self.client.loop.cancel_timer(self.timer)
+    for callback in self.callbacks:
+      callback(self)
+    self.callbacks = []
+
+class Connection:
+  """A keep alive HTTP/1.1 connection carrying one call at a time"""
+  def __init__(self, client):
+    self.client = client
+    self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    self.sock.setblocking(0)
+    self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    self.fd = self.sock.fileno()
+    self.connected = False
+    self.call = None
+    # calls this connection has carried, a failure on a reused connection
+    # before any response may be the server closing it while it was idle
+    self.used = 0
+    err = self.sock.connect_ex(client.address)
+    if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+      self.sock.close()
+      raise socket.error(err, errno.errorcode.get(err, str(err)))
+
+  def send(self, call):
+    self.call = call
+    call.connection = self
+    self.used += 1
+    self.out = self.client.header % len(call.body) + call.body
+    self.head = ""
+    self.status = None
+    self.received = 0
+    if call.select:
+      self.parser, self.unmarshaller = xmlselect.getparser(call.select)
+    else:
+      self.parser, self.unmarshaller = xmlrpclib.getparser()
+    self.client.loop.register(self.fd, self, True)
+
+  def handle_write(self):
+    try:
+      if not self.connected:
+        err = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err != 0:
+          raise socket.error(err, errno.errorcode.get(err, str(err)))
+        self.connected = True
+      sent = self.sock.send(self.out)
+    except socket.error, e:
+      if e.args[0] in (errno.EAGAIN, errno.EINTR):
+        return
+      return self.fail(e)
+    self.out = self.out[sent:]
+    if len(self.out) == 0:
+      self.client.loop.register(self.fd, self, False)
+
+  def handle_read(self):
+    try:
+      data = self.sock.recv(65536)
+    except socket.error, e:
+      if e.args[0] in (errno.EAGAIN, errno.EINTR):
+        return
+      return self.fail(e)
+    if len(data) == 0:
+      if self.status != None and self.length == None and not self.chunked:
+        #the body ends with the connection
+        return self.complete(False)
+      return self.fail(socket.error(errno.ECONNRESET, "connection closed"))
+    self.received += len(data)
+    try:
+      if self.status == None:
+        self.head += data
+        end = self.head.find("\r\n\r\n")
+        if end == -1:
+          return
+        data = self.head[end + 4:]
+        self.parse_head(self.head[:end])
+      if self.chunked:
+        self.read_chunked(data)
+      else:
+        self.read_body(data)
+    except Exception, e:
+      self.fail(e)
+
+  def parse_head(self, head):
+    lines = head.split("\r\n")
+    status = lines[0].split(" ", 2)
+    self.status = int(status[1])
+    self.reason = status[2] if len(status) > 2 else ""
+    self.headers = {}
+    for line in lines[1:]:
+      name, sep, value = line.partition(":")
+      self.headers[name.strip().lower()] = value.strip()
+    self.keep_alive = status[0] == "HTTP/1.1" and \
+      self.headers.get("connection", "").lower() != "close"
+    self.chunked = self.headers.get("transfer-encoding", "").lower() == "chunked"
+    self.length = None
+    if "content-length" in self.headers and not self.chunked:
+      self.length = int(self.headers["content-length"])
+    self.chunk = ""
+    self.left = 0
+    if self.status != 200:
+      #the body is not xml, drop it
+      self.parser = None
+
+  def feed(self, data):
+    if self.parser != None and len(data) > 0:
+      self.parser.feed(data)
+
+  def read_body(self, data):
+    if self.length != None:
+      data = data[:self.length]
+      self.length -= len(data)
+    self.feed(data)
+    if self.length == 0:
+      self.complete(self.keep_alive)
+
+  def read_chunked(self, data):
+    self.chunk += data
+    while True:
+      if self.left > 0:
+        data = self.chunk[:self.left]
+        self.chunk = self.chunk[len(data):]
+        self.left -= len(data)
+        self.feed(data)
+        if self.left > 0:
+          return
+        #the crlf after the chunk
+        self.left = -2
+      if self.left < 0:
+        if len(self.chunk) < 2:
+          return
+        self.chunk = self.chunk[2:]
+        self.left = 0
+      end = self.chunk.find("\r\n")
+      if end == -1:
+        return
+      size = int(self.chunk[:end].split(";")[0], 16)
+      if size == 0:
+        #no trailers are expected from the node
+        return self.complete(self.keep_alive)
+      self.chunk = self.chunk[end + 2:]
+      self.left = size
+
+  def complete(self, reuse):
+    call = self.call
+    self.call = None
+    call.connection = None
+    if self.status != 200:
+      error = xmlrpclib.ProtocolError(self.client.url, self.status, \
+        self.reason, self.headers)
+      value = None
+    else:
+      try:
+        self.parser.close()
+        value = self.unmarshaller.close()[0]
+        error = None
+      except Exception, e:
+        value = None
+        error = e
+    self.parser = self.unmarshaller = None
+    if reuse:
+      self.client.loop.unregister(self.fd)
+      self.client.release(self)
+    else:
+      self.close()
+    call.finish(value, error)
+
+  def fail(self, error):
+    call = self.call
+    self.call = None
+    self.close()
+    if call == None:
+      return
+    call.connection = None
+    if self.used > 1 and self.received == 0 and isinstance(error, socket.error):
+      #the server closed the idle connection, try again on a new one
+      self.client.submit(call)
+    else:
+      call.finish(None, error)
+
+  def close(self):
+    self.client.loop.unregister(self.fd)
+    self.sock.close()
+    self.client.closed(self)
+
+class Client:
+  """Calls to the node on the xmlrpc port, up to connections of them in
+  flight at once and the rest queued.  Clients for several nodes can share a
+  Loop."""
+  def __init__(self, port = 10000, host = "127.0.0.1", path = "/xm.rem", \
+    loop = None, connections = 64, timeout = None):
+    self.address = (host, port)
+    self.url = "http://%s:%i%s" % (host, port, path)
+    self.header = "POST %s HTTP/1.1\r\nHost: %s:%i\r\n" % (path, host, port) + \
+      "Content-Type: text/xml\r\nUser-Agent: asyncbru.py\r\n" + \
+      "Content-Length: %i\r\n\r\n"
+    self.loop = loop or Loop()
+    self.connections = connections
+    self.timeout = timeout
+    self.open = set()
+    self.idle = []
+    self.queue = collections.deque()
+
+  def call(self, method, params, timeout = None, select = None, convert = None):
+    """Calls the xmlrpc method, convert is applied to the result.  timeout is
+    the deadline in seconds, the client's by default."""
+    body = xmlrpclib.dumps(tuple(params), method, allow_none = True)
+    call = Call(self, body, select, convert)
+    if timeout == None:
+      timeout = self.timeout
+    if timeout != None:
+      call.timer = self.loop.call_at(call.start + timeout, \
+        lambda: self.abort(call, Timeout("no result in %.3f seconds" % timeout)))
+    self.submit(call)
+    return call
+
+  def submit(self, call):
+    if len(self.idle) > 0:
+      self.idle.pop().send(call)
+    elif len(self.open) < self.connections:
+      try:
+        conn = Connection(self)
+      except socket.error, e:
+        return call.finish(None, e)
+      self.open.add(conn)
+      conn.send(call)
+    else:
+      self.queue.append(call)
+
+  def release(self, conn):
+    while len(self.queue) > 0:
+      call = self.queue.popleft()
+      if not call.done():
+        return conn.send(call)
+    self.idle.append(conn)
+
+  def closed(self, conn):
+    self.open.discard(conn)
+    if conn in self.idle:
+      self.idle.remove(conn)
+    while len(self.queue) > 0 and len(self.open) < self.connections:
+      call = self.queue.popleft()
+      if not call.done():
+        self.submit(call)
+
+  def abort(self, call, error):
+    if call.done():
+      return
+    conn = call.connection
+    call.finish(None, error)
+    if conn != None:
+      #the response may still come, the connection can't be used again
+      conn.call = None
+      conn.close()
+
+  def close(self):
+    """Cancels the calls not done and closes the connections"""
+    while len(self.queue) > 0:
+      self.queue.popleft().finish(None, Cancelled())
+    for conn in list(self.open):
+      if conn.call != None:
+        self.abort(conn.call, Cancelled())
+      else:
+        conn.close()
+
+  def outstanding(self):
+    return len(self.open) - len(self.idle) + len(self.queue)
+
+  def wait(self, calls = None, timeout = None):
+    """Runs the loop until calls (by default every call made) are done or
+    timeout seconds have passed, returns whether they are all done"""
+    if calls == None:
+      return self.loop.run(lambda: self.outstanding() == 0, timeout)
+    left = [0]
+    def _done(call):
+      left[0] -= 1
+    for call in calls:
+      left[0] += 1
+      call.add_callback(_done)
+    return self.loop.run(lambda: left[0] == 0, timeout)
+
+  # The XmlRpcManager methods, the keyword arguments are those of call
+
+  def localproxy(self, method, *args, **kwargs):
+    return self.call("localproxy", (method,) + args, **kwargs)
+
+  def proxy(self, addr, ah_options, max_results, method, *args, **kwargs):
+    """The result is the list of results, empty if none came back in time"""
+    return self.call("proxy", (addr, ah_options, max_results, method) + args, \
+      **kwargs)
+
+  def uriproxy(self, uri, max_results, method, *args, **kwargs):
+    return self.call("uriproxy", (uri, max_results, method) + args, **kwargs)
+
+  # Typed helpers, keys and values are strings
+
+  def info(self, addr, **kwargs):
+    """The Information.Info of addr, None if it did not answer"""
+    return self.proxy(addr, 3, 1, "Information.Info", convert = _first, **kwargs)
+
+  def put(self, key, value, ttl, **kwargs):
+    return self.localproxy("DhtClient.Put", xmlrpclib.Binary(key), \
+      xmlrpclib.Binary(value), ttl, convert = bool, **kwargs)
+
+  def create(self, key, value, ttl, **kwargs):
+    """Fails with a Fault if the key already has a value"""
+    return self.localproxy("DhtClient.Create", xmlrpclib.Binary(key), \
+      xmlrpclib.Binary(value), ttl, convert = bool, **kwargs)
+
+  def get(self, key, **kwargs):
+    """The [(value, ttl)] of key"""
+    return self.localproxy("DhtClient.Get", xmlrpclib.Binary(key), \
+      convert = _values, **kwargs)
+
+  def begin_get(self, key, **kwargs):
+    """The token for continue_get and end_get"""
+    return self.localproxy("DhtClient.BeginGet", xmlrpclib.Binary(key), **kwargs)
+
+  def continue_get(self, token, **kwargs):
+    """The next (value, ttl), None when there are no more"""
+    return self.localproxy("DhtClient.ContinueGet", token, convert = _value, \
+      **kwargs)
+
+  def end_get(self, token, **kwargs):
+    return self.localproxy("DhtClient.EndGet", token, convert = bool, **kwargs)
+
+  def path_latency(self, addr, dest, **kwargs):
+    """The hops of the route from addr to dest as measured by addr's
+    ncserver.ComputePathLatencyTo, each a dict with node and next_latency in
+    ms, None if addr did not answer"""
+    return self.proxy(addr, 3, 1, "ncserver.ComputePathLatencyTo", dest, \
+      convert = _first, **kwargs)
+
+  def route_to(self, addr, **kwargs):
+    """The hops of the structured route to addr, each a dict with node"""
+    return self.localproxy("trace.GetRouteTo", addr, convert = list, **kwargs)
+
+def _first(results):
+  if len(results) == 0:
+    return None
+  return results[0]
+
+def _data(value):
+  if isinstance(value, xmlrpclib.Binary):
+    return value.data
+  if isinstance(value, memoryview):
+    return value.tobytes()
+  return value
+
+def _value(res):
+  if not res:
+    return None
+  return (_data(res['value']), res['ttl'])
+
+def _values(results):
+  return [_value(res) for res in results]
+
+#############################
+# Here are the unit tests
+#############################
+
+class TestAsyncBru(unittest.TestCase):
+  def serve(self, **kwargs):
+    import ringemu, threading
+    ring = ringemu.VirtualRing(1000, **kwargs)
+    server = ringemu.make_server(ring, 0)
+    t = threading.Thread(target = server.serve_forever)
+    t.daemon = True
+    t.start()
+    self.servers.append(server)
+    return ring, server.server_address[1]
+
+  def setUp(self):
+    self.servers = []
+
+  def tearDown(self):
+    for server in self.servers:
+      server.shutdown()
+      server.server_close()
+
+  def testMany(self):
+    import pybru, random
+    ring, port = self.serve()
+    client = Client(port, connections = 32, timeout = 30)
+    addrs = [str(pybru.Address(a)) for a in random.sample(ring.addrs, 500)] * 4
+    infos = [client.info(a) for a in addrs]
+    puts = [client.put("key%i" % i, "value%i" % i, 600) for i in xrange(200)]
+    self.assertTrue(client.outstanding() > 1000)
+    self.assertTrue(client.wait())
+    self.assertTrue(len(client.open) <= 32)
+    for addr, call in zip(addrs, infos):
+      self.assertEqual(call.result(), ring.info(long(pybru.Address(addr))))
+    self.assertEqual([c.result() for c in puts], [True] * 200)
+    gets = [client.get("key%i" % i, select = ["value", "ttl"]) for i in xrange(200)]
+    self.assertTrue(client.wait(gets))
+    for i, call in enumerate(gets):
+      self.assertEqual(call.result()[0][0], "value%i" % i)
+    #a BeginGet, ContinueGet until no value is left then EndGet, each call
+    #made from the callback of the one before
+    values = []
+    ended = []
+    def _continue(call):
+      if call.result() != None:
+        values.append(call.result()[0])
+        client.continue_get(token.result()).add_callback(_continue)
+      else:
+        client.end_get(token.result()).add_callback(ended.append)
+    token = client.begin_get("key7")
+    token.add_callback(lambda call: \
+      client.continue_get(call.result()).add_callback(_continue))
+    client.wait()
+    self.assertEqual(values, ["value7"])
+    self.assertEqual(ended[0].result(), True)
+    client.close()
+
+  def testDeadline(self):
+    ring, port = self.serve(hop_latency = 0.05)
+    client = Client(port, connections = 4)
+    slow = [client.get("key%i" % i, timeout = 0.02) for i in xrange(8)]
+    cancelled = client.get("other")
+    cancelled.cancel()
+    local = client.localproxy("Information.Info", timeout = 5)
+    done = []
+    local.add_callback(done.append)
+    client.wait(slow + [local])
+    for call in slow:
+      self.assertTrue(isinstance(call.error, Timeout))
+      self.assertTrue(call.seconds() < 0.2)
+    self.assertTrue(isinstance(cancelled.error, Cancelled))
+    self.assertRaises(Cancelled, cancelled.result)
+    self.assertEqual(done, [local])
+    self.assertEqual(local.result()['type'], "BasicNode")
+    #the connections of timed out calls were closed, new ones still work
+    put = client.put("key", "value", 60, timeout = 5)
+    client.wait([put])
+    self.assertEqual(put.result(), True)
+    client.close()
+
+  def testFaults(self):
+    ring, port = self.serve()
+    client = Client(port)
+    first = client.create("key", "value", 60)
+    client.wait([first])
+    second = client.create("key", "other", 60)
+    unknown = client.localproxy("No.Such.Method")
+    remote = client.uriproxy("brunet:node:ABC", 1, "Information.Info")
+    client.wait()
+    self.assertEqual(first.result(), True)
+    self.assertTrue(isinstance(second.error, xmlrpclib.Fault))
+    self.assertTrue(isinstance(unknown.error, xmlrpclib.Fault))
+    self.assertTrue(isinstance(remote.error, xmlrpclib.Fault))
+    client.close()
+    #a port bound but not listening refuses the connection
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(("127.0.0.1", 0))
+    closed = Client(sock.getsockname()[1])
+    call = closed.localproxy("Information.Info", timeout = 5)
+    closed.wait()
+    sock.close()
+    self.assertTrue(isinstance(call.error, socket.error))
+
+if __name__ == "__main__":
+  main()
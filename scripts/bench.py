@@ -0,0 +1,377 @@
+#!/usr/bin/python
+""" Performance benchmarks for the python tools.  Each case times a number of
+operations and reports ops/sec, per operation latency percentiles and the peak
+memory of the process it ran in.  Cases run in a child process of their own so
+memory numbers do not leak from one case to the next.
+
+  address_*        pybru.Address parsing, formatting and comparison
+  crawl            crawl.crawl per hop against a ringemu.py stand-in node
+  graph_check_<n>  tests/protocol/graph_check.py on a synthetic dot graph,
+                   parsing the dump every run (the .csr cache is removed)
+  ugrapher_<n>     tests/protocol/ugrapher.py on the same graphs
+  *_<n>_warm       the same runs reading the .csr cache of an earlier run
+  generate_rtt     tests/coordinate/generate_rtt.py matrix generation
+  dht_*            DhtClient.Put / Get one at a time and in parallel against
+                   the stand-in node
+
+Results are written as json and two result files can be compared, cases that
+got slower or bigger than a threshold are flagged as regressions. """
+import xmlrpclib, pybru, crawl, ringemu, sys, getopt, random, time, os, \
+  json, resource, platform, subprocess, tempfile, threading, unittest
+from multiprocessing import Process, Queue
+from multiprocessing.pool import ThreadPool
+
+usage = """usage:
+python bench.py run [--size=<small|large>] [--repeat=<n>] [--cases=<c1,c2,...>]
+  [--output=<filename>]
+python bench.py compare [--threshold=<percent>] <baseline> <current>
+python bench.py list
+python bench.py test
+run = run the benchmarks and print the results
+size = small runs in seconds, large gives steadier numbers, default small
+repeat = times to run each case, the median run is kept, default 3
+cases = only run these cases
+output = write the results as json
+compare = compare two result files, exits with 1 if there is a regression
+threshold = allowed slowdown or memory growth in percent, default 10
+list = print the names of the cases
+test = run the unit tests"""
+
+SIZES = {
+  'small' : {'address' : 20000, 'crawl' : 500, 'graphs' : [100, 1000],
+             'rtt' : (10, 10), 'dht' : 500},
+  'large' : {'address' : 200000, 'crawl' : 5000, 'graphs' : [1000, 10000, 50000],
+             'rtt' : (20, 20), 'dht' : 5000},
+}
+
+BASE = os.path.dirname(os.path.abspath(__file__))
+GRAPH_CHECK = os.path.join(BASE, "..", "tests", "protocol", "graph_check.py")
+UGRAPHER = os.path.join(BASE, "..", "tests", "protocol", "ugrapher.py")
+GENERATE_RTT = os.path.join(BASE, "..", "tests", "coordinate", "generate_rtt.py")
+
+def main():
+  try:
+    action = sys.argv[1]
+    optlist, args = getopt.getopt(sys.argv[2:], "", ["size=", "repeat=", \
+      "cases=", "output=", "threshold="])
+    o_d = {}
+    for k,v in optlist:
+      o_d[k] = v
+    size = SIZES[o_d.get("--size", "small")]
+    repeat = int(o_d.get("--repeat", 3))
+    threshold = float(o_d.get("--threshold", 10))
+    if action == "compare":
+      baseline, current = args
+    elif action not in ("run", "list", "test"):
+      raise ValueError(action)
+  except:
+    print usage
+    return
+
+  if action == "list":
+    for name, func, arg in cases(size):
+      print name
+  elif action == "run":
+    names = None
+    if "--cases" in o_d:
+      names = o_d["--cases"].split(",")
+    res = run(size, repeat, names)
+    print_results(res)
+    if "--output" in o_d:
+      f = open(o_d["--output"], "w")
+      json.dump(res, f, indent = 1)
+      f.close()
+  elif action == "compare":
+    regressions = compare(load(baseline), load(current), threshold)
+    if len(regressions) > 0:
+      sys.exit(1)
+  else:
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestBench)
+    unittest.TextTestRunner(verbosity=1).run(suite)
+
+#############################
+# The cases, each returns a list with the latency of every operation and the
+# time taken by all of them, which leaves out any setup
+#############################
+
+def random_addresses(count):
+  return [pybru.Address(random.randrange(0, 2 ** 160, 2)) for i in xrange(count)]
+
+def timed(func, items):
+  latencies = []
+  begin = time.time()
+  for item in items:
+    start = time.time()
+    func(item)
+    latencies.append(time.time() - start)
+  return latencies, time.time() - begin
+
+def bench_address_parse(count):
+  strs = [str(a) for a in random_addresses(count)]
+  return timed(pybru.Address, strs)
+
+def bench_address_format(count):
+  nums = [long(a) for a in random_addresses(count)]
+  return timed(lambda n: str(pybru.Address(n)), nums)
+
+def bench_address_compare(count):
+  addrs = random_addresses(count + 1)
+  pairs = zip(addrs[:-1], addrs[1:])
+  return timed(lambda p: p[0] < p[1], pairs)
+
+# Starts a ringemu.py node on a free port in this process
+def stand_in(nodes):
+  ring = ringemu.VirtualRing(nodes)
+  server = ringemu.make_server(ring, 0)
+  t = threading.Thread(target = server.serve_forever)
+  t.daemon = True
+  t.start()
+  return server.server_address[1]
+
+def bench_crawl(nodes):
+  port = stand_in(nodes)
+  hops = []
+  def _logger(msg):
+    hops.append(time.time())
+  hops.append(time.time())
+  crawl.crawl(port, _logger)
+  hops.append(time.time())
+  return [hops[i] - hops[i - 1] for i in xrange(1, len(hops))], hops[-1] - hops[0]
+
+def bench_dht(count, method, parallel = 1):
+  port = stand_in(1000)
+  local = threading.local()
+  def _call(i):
+    if not hasattr(local, "rpc"):
+      local.rpc = xmlrpclib.Server("http://127.0.0.1:%i/xm.rem" % port)
+    key = xmlrpclib.Binary("bench%i" % i)
+    start = time.time()
+    if method == "put":
+      local.rpc.localproxy("DhtClient.Put", key, xmlrpclib.Binary("x" * 100), 3600)
+    else:
+      local.rpc.localproxy("DhtClient.Get", key)
+    return time.time() - start
+  if method == "get":
+    #something to get
+    rpc = xmlrpclib.Server("http://127.0.0.1:%i/xm.rem" % port)
+    for i in xrange(count):
+      rpc.localproxy("DhtClient.Put", xmlrpclib.Binary("bench%i" % i), \
+        xmlrpclib.Binary("x" * 100), 3600)
+  start = time.time()
+  if parallel == 1:
+    return [_call(i) for i in xrange(count)], time.time() - start
+  pool = ThreadPool(parallel)
+  try:
+    return list(pool.imap_unordered(_call, xrange(count))), time.time() - start
+  finally:
+    pool.close()
+
+def synthetic_graph(nodes, shortcuts = 1, unstructured = 4):
+  """A dot graph in the format graph_check.py and ugrapher.py read: near
+  neighbors (red), a leaf (blue) and random unstructured (green) edges, every
+  edge in both directions"""
+  edges = set()
+  for i in xrange(nodes):
+    for d in (1, 2):
+      j = (i + d) % nodes
+      edges.add((i, j, "red"))
+      edges.add((j, i, "red"))
+    for k in xrange(shortcuts):
+      j = random.randrange(nodes)
+      if j != i:
+        edges.add((i, j, "red"))
+        edges.add((j, i, "red"))
+    leaf = (i + nodes / 2) % nodes
+    edges.add((i, leaf, "blue"))
+    edges.add((leaf, i, "blue"))
+    for k in xrange(unstructured / 2):
+      j = random.randrange(nodes)
+      if j != i:
+        edges.add((i, j, "green"))
+        edges.add((j, i, "green"))
+  lines = ["digraph brunet {"]
+  for i in xrange(nodes):
+    lines.append("%i [pos=\"%i,%i\"];" % (i, i, i))
+  for n1, n2, color in edges:
+    lines.append("%i -> %i [color= %s];" % (n1, n2, color))
+  lines.append("}")
+  return "\n".join(lines) + "\n"
+
+def bench_script(script, args, runs = 1):
+  """Latency of running a script, its output is thrown away"""
+  devnull = open(os.devnull, "w")
+  latencies = []
+  for i in xrange(runs):
+    start = time.time()
+    subprocess.check_call([sys.executable, script] + args, stdout = devnull)
+    latencies.append(time.time() - start)
+  devnull.close()
+  return latencies, sum(latencies)
+
+# Cold runs remove the <dump>.csr cache (tests/protocol/dotcsr.py) before each
+# run so they parse the dump like the scripts did before the cache, warm runs
+# build it once untimed and then only read it.
+def bench_graph(script, nodes, warm = False):
+  tmpdir = tempfile.mkdtemp()
+  filename = os.path.join(tmpdir, "graph.dot")
+  f = open(filename, "w")
+  f.write(synthetic_graph(nodes))
+  f.close()
+  cache = filename + ".csr"
+  try:
+    if warm:
+      bench_script(script, [filename])
+      return bench_script(script, [filename], 3)
+    latencies = []
+    for i in xrange(3):
+      if os.path.exists(cache):
+        os.remove(cache)
+      latencies += bench_script(script, [filename])[0]
+    return latencies, sum(latencies)
+  finally:
+    #ugrapher.py leaves its ccdf and gnuplot files next to the graph
+    for name in os.listdir(tmpdir):
+      os.remove(os.path.join(tmpdir, name))
+    os.rmdir(tmpdir)
+
+def cases(size):
+  """The (name, function, argument) of every case"""
+  res = [("address_parse", bench_address_parse, size['address']),
+         ("address_format", bench_address_format, size['address']),
+         ("address_compare", bench_address_compare, size['address']),
+         ("crawl", bench_crawl, size['crawl'])]
+  for n in size['graphs']:
+    res.append(("graph_check_%i" % n, lambda n: bench_graph(GRAPH_CHECK, n), n))
+    res.append(("graph_check_%i_warm" % n, \
+      lambda n: bench_graph(GRAPH_CHECK, n, True), n))
+  for n in size['graphs']:
+    res.append(("ugrapher_%i" % n, lambda n: bench_graph(UGRAPHER, n), n))
+    res.append(("ugrapher_%i_warm" % n, lambda n: bench_graph(UGRAPHER, n, True), n))
+  res.append(("generate_rtt", lambda a: bench_script(GENERATE_RTT, \
+    [str(a[0]), str(a[1])], 3), size['rtt']))
+  res.append(("dht_put", lambda n: bench_dht(n, "put"), size['dht']))
+  res.append(("dht_get", lambda n: bench_dht(n, "get"), size['dht']))
+  res.append(("dht_put_parallel", lambda n: bench_dht(n, "put", 32), size['dht']))
+  return res
+
+#############################
+# Running and comparing
+#############################
+
+def percentile(values, q):
+  values = sorted(values)
+  return values[int(q * (len(values) - 1))]
+
+def peak_memory():
+  """Peak resident memory in KB of this process and any scripts it ran"""
+  return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, \
+    resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+def run_case(func, arg, queue):
+  try:
+    latencies, elapsed = func(arg)
+    queue.put({'ops' : len(latencies), 'seconds' : elapsed,
+      'ops_per_sec' : len(latencies) / elapsed if elapsed > 0 else 0,
+      'p50' : percentile(latencies, 0.5), 'p90' : percentile(latencies, 0.9),
+      'p99' : percentile(latencies, 0.99), 'max_rss_kb' : peak_memory()})
+  except Exception, e:
+    queue.put({'error' : str(e)})
+
+def run(size, repeat = 3, names = None):
+  res = {'python' : platform.python_version(), 'platform' : platform.platform(),
+         'time' : time.time(), 'repeat' : repeat, 'cases' : {}}
+  for name, func, arg in cases(size):
+    if names != None and name not in names:
+      continue
+    runs = []
+    for i in xrange(repeat):
+      queue = Queue()
+      p = Process(target = run_case, args = (func, arg, queue))
+      p.start()
+      runs.append(queue.get())
+      p.join()
+      if 'error' in runs[-1]:
+        break
+    good = sorted([r for r in runs if 'error' not in r], \
+      key = lambda r: r['ops_per_sec'])
+    if len(good) < len(runs):
+      res['cases'][name] = runs[-1]
+    else:
+      res['cases'][name] = good[len(good) / 2]
+  return res
+
+def load(filename):
+  f = open(filename)
+  res = json.load(f)
+  f.close()
+  return res
+
+# The fields compared and whether a larger value is better
+COMPARED = [('ops_per_sec', True), ('p99', False), ('max_rss_kb', False)]
+
+def compare(baseline, current, threshold = 10, out = sys.stdout):
+  """Prints the change of every case and returns the regressions as a list of
+  (case, field, baseline value, current value)"""
+  regressions = []
+  for name in sorted(current['cases']):
+    cur = current['cases'][name]
+    if name not in baseline['cases']:
+      out.write("%s: new case\n" % name)
+      continue
+    base = baseline['cases'][name]
+    if 'error' in cur or 'error' in base:
+      out.write("%s: error %s\n" % (name, cur.get('error', base.get('error'))))
+      continue
+    changes = []
+    for field, larger_better in COMPARED:
+      if base[field] <= 0:
+        continue
+      change = 100.0 * (cur[field] - base[field]) / base[field]
+      worse = -change if larger_better else change
+      flag = ""
+      if worse > threshold:
+        flag = " REGRESSION"
+        regressions.append((name, field, base[field], cur[field]))
+      changes.append("%s %+.1f%%%s" % (field, change, flag))
+    out.write("%s: %s\n" % (name, ", ".join(changes)))
+  out.write("%i regressions over %g%%\n" % (len(regressions), threshold))
+  return regressions
+
+def print_results(res):
+  print "python %s on %s" % (res['python'], res['platform'])
+  for name in sorted(res['cases']):
+    case = res['cases'][name]
+    if 'error' in case:
+      print "%-20s error: %s" % (name, case['error'])
+      continue
+    print "%-20s %10.1f ops/s  p50=%.3fms p90=%.3fms p99=%.3fms  %i KB" % \
+      (name, case['ops_per_sec'], 1000 * case['p50'], 1000 * case['p90'], \
+      1000 * case['p99'], case['max_rss_kb'])
+
+#############################
+# Here are the unit tests
+#############################
+
+class TestBench(unittest.TestCase):
+  def result(self, ops_per_sec, p99, rss):
+    return {'cases' : {'a' : {'ops_per_sec' : ops_per_sec, 'p99' : p99,
+      'max_rss_kb' : rss}}}
+  def testCompare(self):
+    devnull = open(os.devnull, "w")
+    base = self.result(100, 0.01, 1000)
+    self.assertEqual(compare(base, self.result(95, 0.0105, 1050), 10, devnull), [])
+    slower = compare(base, self.result(80, 0.01, 1000), 10, devnull)
+    self.assertEqual([(r[0], r[1]) for r in slower], [('a', 'ops_per_sec')])
+    bigger = compare(base, self.result(100, 0.02, 2000), 10, devnull)
+    self.assertEqual([r[1] for r in bigger], ['p99', 'max_rss_kb'])
+    devnull.close()
+  def testSyntheticGraph(self):
+    """Every edge of the synthetic graph goes both ways"""
+    graph = synthetic_graph(50)
+    edges = set([tuple(line.split(" ")[0:3:2]) for line in graph.split("\n") \
+      if "->" in line])
+    for n1, n2 in edges:
+      self.assertTrue((n2, n1) in edges)
+
+if __name__ == "__main__":
+  main()
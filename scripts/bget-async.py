@@ -1,6 +1,6 @@
 #!/usr/bin/env python
-import xmlrpclib, getopt, sys
-rpc = xmlrpclib.Server("http://127.0.0.1:10000/xm.rem")
+import xmlrpclib, rpcstats, getopt, sys
+rpc = rpcstats.Server("http://127.0.0.1:10000/xm.rem")
 #pydht = xmlrpclib.Server('http://128.227.56.152:64221/xd.rem')
 
 #usage:
@@ -1,7 +1,8 @@
 #!/usr/bin/env python
 
-import sys, tempfile, os, re, os.path
+import sys, tempfile, os, re, os.path, hashlib, json, getopt
 from functools import partial
+from multiprocessing import Pool, cpu_count
 
 filestorename = sys.argv[3:]
 
@@ -83,12 +84,124 @@ def check_tree_main(on_err, args):
       if this_ns != ns:
         on_err(fullnm, this_ns, ns)
 
+#the fast modes keep path -> [mtime, size, sha1, namespace] here
+CACHE_FILE = ".namespace_cache"
+
+def namespace_lines(oldns, newns, lines):
+  oldstr = r"(.*)namespace %s\b(.*)" % oldns
+  newstr = r"\1namespace %s\2" % newns
+  return [re.sub(oldstr, newstr, line) for line in lines]
+
+#reads fn once, returns its hash and namespace and, when fix is set and the
+#namespace is not the expected one, rewrites it in a single buffered write.
+#a file whose content has the hash of its cache entry (touched, or checked
+#out again) is not parsed, the cached namespace is used
+def scan_file(item):
+  (fn, expected, fix, cached) = item
+  try:
+    st = os.stat(fn)
+    f = open(fn, "rb")
+    data = f.read()
+    f.close()
+    digest = hashlib.sha1(data).hexdigest()
+    lines = data.splitlines(True)
+    if cached != None and cached[2] == digest:
+      this_ns = cached[3]
+    else:
+      this_ns = get_namespace(lines)
+    if fix and this_ns != None and this_ns != expected:
+      data = "".join(namespace_lines(this_ns, expected, lines))
+      (tempf, tempn) = tempfile.mkstemp(dir = os.path.dirname(fn) or os.curdir)
+      tempf = os.fdopen(tempf, "wb")
+      tempf.write(data)
+      tempf.close()
+      os.chmod(tempn, st.st_mode & 07777)
+      os.rename(tempn, fn)
+      st = os.stat(fn)
+      digest = hashlib.sha1(data).hexdigest()
+      return (fn, [st.st_mtime, st.st_size, digest, expected], this_ns)
+    return (fn, [st.st_mtime, st.st_size, digest, this_ns], this_ns)
+  except (IOError, OSError), e:
+    return (fn, None, e)
+
+def load_cache(fn):
+  try:
+    return json.load(open(fn))
+  except (IOError, ValueError):
+    return {}
+
+def save_cache(cache, fn):
+  (tempf, tempn) = tempfile.mkstemp(dir = os.path.dirname(fn) or os.curdir)
+  tempf = os.fdopen(tempf, "w")
+  json.dump(cache, tempf)
+  tempf.close()
+  os.rename(tempn, fn)
+
+def tree_files(base, ftype = ".cs"):
+  for (dpath, dnames, fnames) in os.walk(os.curdir):
+    nslist = rec_split(dpath, [])
+    nslist[0] = base
+    ns = ".".join(nslist)
+    for fn in fnames:
+      if fn.endswith(ftype):
+        yield (os.path.join(dpath, fn), ns)
+
+#check_tree / change_tree reading each file once in a pool of processes, files
+#whose mtime and size are in the cache are not read at all and the ones whose
+#content hash is are not parsed
+#args: base [--jobs=<processes>] [--cache=<file>]
+def fast_tree_main(fix, args):
+  (optlist, rest) = getopt.gnu_getopt(args[1:], "", ["jobs=", "cache="])
+  opts = dict(optlist)
+  base = rest[0]
+  jobs = int(opts.get("--jobs", cpu_count()))
+  cache_fn = opts.get("--cache", CACHE_FILE)
+  cache = load_cache(cache_fn)
+  newcache = {}
+  errors = 0
+  todo = []
+  for (fn, ns) in tree_files(base):
+    entry = cache.get(fn)
+    if entry != None:
+      st = os.stat(fn)
+      if entry[0] == st.st_mtime and entry[1] == st.st_size:
+        newcache[fn] = entry
+        if entry[3] != ns:
+          if fix:
+            todo.append((fn, ns, fix, entry))
+          else:
+            print_error(fn, entry[3], ns)
+            errors += 1
+        continue
+    todo.append((fn, ns, fix, entry))
+  expected = dict([(item[0], item[1]) for item in todo])
+  if len(todo) > 0:
+    pool = Pool(max(1, min(jobs, len(todo))))
+    try:
+      for (fn, entry, this_ns) in pool.imap_unordered(scan_file, todo, 16):
+        if entry == None:
+          print "%s: %s" % (fn, this_ns)
+          errors += 1
+          continue
+        newcache[fn] = entry
+        if this_ns != expected[fn] and not fix:
+          print_error(fn, this_ns, expected[fn])
+          errors += 1
+    finally:
+      pool.close()
+      pool.join()
+  save_cache(newcache, cache_fn)
+  if errors > 0:
+    sys.exit(1)
+
 if __name__ == "__main__":
   modes = { 'change_ns_f' : fixns_main,
             'print_ns_f' : printns_main,
             'check_tree' : partial(check_tree_main, print_error),
             'change_tree' : partial(check_tree_main, change_ns),
             'add_using' : add_using_main,
+            'fast_check_tree' : partial(fast_tree_main, False),
+            'fast_change_tree' : partial(fast_tree_main, True),
           }
   mode = sys.argv.pop(1)
   modes[mode](sys.argv)
@@ -3,23 +3,38 @@
 also determines if the ring is consistent, does a node agree with its two
 neighbors on a given side about their positioning.  This can be used by other
 python programs if they call crawl and use the nodes that are returned. """
-import xmlrpclib, pybru, sys, getopt, time
+import xmlrpclib, rpcstats, pybru, sys, os, getopt, time, json
 
 usage = """usage:
-python crawl.py [--debug] [--debug2] [--port=<xmlrpc port of a brunet node>]
+python crawl.py [--debug] [--debug2] [--mapreduce] [--port=<xmlrpc port of a brunet node>]
+  [--connections] [--output=<filename>]
 debug = print the current node crawling
 debug2 = debug + print the neighbors of current node
+mapreduce = collect the nodes with a map-reduce broadcast instead of walking
+  the ring
 port = the xmlrpc port for a brunet node to be used for crawling
+connections = also record each node's structured connections, including
+  shortcuts (always included by --mapreduce)
+output = save the crawled nodes as a snapshot for other tools
 help = this message"""
 
+# the members of Information.Info (and GetNeighbors) the crawler uses, the rest
+# of each response is skipped while parsing unless debugging
+INFO_FIELDS = ["self", "neighbors", "localips", "geo_loc", "type", "Virtual IP",
+  "IpopNamespace", "structured"]
+
 # Default starting point
 def main():
   try:
-    optlist, args = getopt.getopt(sys.argv[1:], "", ["debug", "port=", "debug2"])
+    optlist, args = getopt.getopt(sys.argv[1:], "", ["debug", "port=", "debug2", \
+      "mapreduce", "output=", "connections"])
 
     logger = null_logger
     port = 10000
     debug = False
+    crawler = crawl
+    output = None
+    connections = False
 
     for k,v in optlist:
       if k == "--port":
@@ -29,11 +44,19 @@ def main():
       elif k == "--debug2":
         logger = print_logger
         debug = True
+      elif k == "--mapreduce":
+        crawler = crawl_mapreduce
+      elif k == "--output":
+        output = v
+      elif k == "--connections":
+        connections = True
   except:
     print usage
     return
 
-  nodes = crawl(port, logger, debug)
+  nodes = crawler(port, logger, debug, connections)
+  if output:
+    save_snapshot(nodes, output)
   count, consistency = check_results(nodes)
 
   print "Consistent Nodes: " + str(consistency)
@@ -53,24 +76,54 @@ def check_results(nodes):
 
   return consistency, count
 
+# A snapshot is the nodes returned by crawl stored as json, so other tools can
+# work from a crawl without walking the ring again.
+def save_snapshot(nodes, filename):
+  f = open(filename, "w")
+  json.dump(nodes, f)
+  f.close()
+
+def load_snapshot(filename):
+  f = open(filename)
+  nodes = json.load(f)
+  f.close()
+  return nodes
+
 def print_logger(msg):
   print msg
 
 def null_logger(msg):
   pass
 
+# The nodes of the latest crawl.  With BRUNET_CRAWL_SERVICE set to the url of
+# a crawlservice.py they come from its snapshot, so tools running at the same
+# time share one crawl of the ring, and the ring is only crawled here if the
+# service can't be reached.
+def latest(port = 10000, logger = null_logger):
+  url = os.environ.get("BRUNET_CRAWL_SERVICE")
+  if url:
+    try:
+      import crawlservice
+      return crawlservice.fetch(url)
+    except Exception, e:
+      logger("Crawl service %s failed: %s, crawling\n" % (url, e))
+  return crawl(port, logger)
+
 # crawls the network using the xmlrpc at the specified port.  Logger is a
 # generic function / method thats only parameter is a single string which
 # contains some logging output.  This file provides print_logger which calls
-# print on the msg and null logger which doesn't do anything.
+# print on the msg and null logger which doesn't do anything.  If connections
+# is set, each node's structured connections are stored in 'connections' as a
+# list of [address, subtype].
 #
 # @todo currently this script does not handle nodes not having left2 and right2
 # and nodes will not be skipped until the set of four (right, right2, left,
 # left2).  This could make the crawlers results slightly wrong.
-def crawl(port = 10000, logger = null_logger, debug = False):
+def crawl(port = 10000, logger = null_logger, debug = False, connections = False):
   port = str(port)
   #gain access to the xmlrpc server
-  rpc = xmlrpclib.Server("http://127.0.0.1:" + port + "/xm.rem")
+  rpc = rpcstats.Server("http://127.0.0.1:" + port + "/xm.rem", \
+    select = None if debug else INFO_FIELDS)
   #a list of nodes we have looked up
   nodes = {}
 
@@ -94,35 +147,13 @@ def crawl(port = 10000, logger = null_logger, debug = False):
       if debug:
         logger(str(res))
       neighbors = res['neighbors']
-      info = {}
-      info['right'] = neighbors['right']
-      info['left'] = neighbors['left']
-
-      try:
-        info['right2'] = neighbors['right2']
-      except:
-        info['right2'] = ""
-
-      try:
-        info['left2'] = neighbors['left2']
-      except:
-        info['left2'] = ""
-
-      ip_list = res['localips']
-      ips = ""
-      for ip in ip_list:
-        ips += ip + ", "
-      ips = ips[:-2]
-      info['ips'] = ips
-
-      info['geo_loc'] = res['geo_loc']
-      info['type'] = res['type']
-      if info['type'] == "IpopNode":
+      info = parse_info(res)
+      if connections:
         try:
-          info['virtual_ip'] = res['Virtual IP']
+          cons = rpc.proxy(node, 3, 1, "ConnectionTable.GetConnections", "structured")
+          info['connections'] = parse_connections(cons[0])
         except:
-          info['virtual_ip'] = ""
-        info['namespace'] = res['IpopNamespace']
+          pass
       info['retries'] = no_response_count * (retry_count + 1)
 
       no_resonse_count = 0
@@ -156,6 +187,61 @@ def crawl(port = 10000, logger = null_logger, debug = False):
     last = node
     node = info['right']
 
+  check_consistency(nodes)
+  return nodes
+
+# Extracts the fields the crawler keeps from an Information.Info result
+def parse_info(res):
+  neighbors = res['neighbors']
+  info = {}
+  info['right'] = neighbors['right']
+  info['left'] = neighbors['left']
+
+  try:
+    info['right2'] = neighbors['right2']
+  except:
+    info['right2'] = ""
+
+  try:
+    info['left2'] = neighbors['left2']
+  except:
+    info['left2'] = ""
+
+  ip_list = res['localips']
+  ips = ""
+  for ip in ip_list:
+    ips += ip + ", "
+  ips = ips[:-2]
+  info['ips'] = ips
+
+  info['geo_loc'] = res['geo_loc']
+  info['type'] = res['type']
+  if info['type'] == "IpopNode":
+    try:
+      info['virtual_ip'] = res['Virtual IP']
+    except:
+      info['virtual_ip'] = ""
+    info['namespace'] = res['IpopNamespace']
+  if 'structured' in res:
+    info['connections'] = parse_connections(res['structured'])
+  return info
+
+# Converts a ConnectionList.ToList, [type, keys, values1, values2, ...], into a
+# list of [address, subtype]
+def parse_connections(con_list):
+  keys = con_list[1]
+  addr_idx = keys.index("address")
+  type_idx = keys.index("subtype")
+  cons = []
+  for values in con_list[2:]:
+    #an empty list is sent when there are no connections
+    if len(values) == len(keys):
+      cons.append([values[addr_idx], values[type_idx]])
+  return cons
+
+# Sets 'consistency' on each node, the fraction of its left and left2
+# neighbors that agree that this node is their right and right2 neighbor.
+def check_consistency(nodes):
   for addr in nodes:
     node = nodes[addr]
     lcons = 0.0
@@ -167,6 +253,40 @@ def crawl(port = 10000, logger = null_logger, debug = False):
       lcons /= 2.0
     nodes[addr]['consistency'] = lcons
 
+# Same as crawl, but rather than walking the ring one node at a time this starts
+# a MapReduceCrawl task at the local node.  The task broadcasts over
+# the whole ring using a bounded broadcast tree, each node maps to its
+# Information.Info and the results are concatenated on the way up the tree,
+# so the collection time grows with the depth of the tree rather than the
+# size of the ring.  The returned nodes are in the same format as crawl, the
+# task always sends the structured connections so connections is ignored.
+def crawl_mapreduce(port = 10000, logger = null_logger, debug = False, \
+  connections = True):
+  port = str(port)
+  rpc = rpcstats.Server("http://127.0.0.1:" + port + "/xm.rem", \
+    select = None if debug else INFO_FIELDS)
+  node = rpc.localproxy("sys:link.GetNeighbors")['self']
+  #the bounded broadcast covers [start, end), so end just left of the start
+  #node to cover the whole ring (class 0 addresses are always even)
+  end = pybru.Address((long(pybru.Address(node)) - 2) % (2 ** 160))
+  args = { 'task_name' : 'Brunet.Services.MapReduce.MapReduceCrawl',
+           'gen_arg' : str(end) }
+  logger("Starting map-reduce crawl at " + node + "\n")
+  results = rpc.localproxy("mapreduce.Start", args)
+
+  nodes = {}
+  for res in results:
+    if debug:
+      logger(str(res))
+    try:
+      info = parse_info(res)
+    except:
+      #a node without the usual fields, skip it like an unresponsive node
+      continue
+    info['retries'] = 0
+    nodes[res['neighbors']['self']] = info
+
+  check_consistency(nodes)
   return nodes
 
 if __name__ == "__main__":
@@ -0,0 +1,541 @@
+#!/usr/bin/python
+""" A daemon crawling the ring on a schedule and serving the results, so tools
+share one crawl instead of each walking every node.  It keeps the latest
+snapshot, in the format of crawl.crawl, and the changes between the last
+snapshots in memory.  The version only goes up when a crawl found a node
+added, removed or with changed fields, the retries of a crawl do not count.
+
+Queries are answered over HTTP as json on GET and as XML-RPC on POST, on
+the same port:
+  GET /version                  version, time of the snapshot, time of the
+                                last crawl
+  GET /snapshot                 version, time and nodes
+  GET /diff?since=<version>     the nodes changed since that version and the
+                                removed ones, 410 if it is older than the
+                                kept changes
+  GET /node/<address>           one node
+  GET /neighbors/<address>      left, left2, right, right2 and connections
+  GET /consistency              consistency of the ring and the nodes not
+                                agreeing with their neighbors
+  GET /history                  a summary of every crawl kept
+The snapshot, diff, node, neighbors and consistency GETs have the version as
+their ETag, a request with If-None-Match of the current version gets a 304 and
+nothing else.  /version and /history change with every crawl, not only with
+the version, so their ETag is a hash of the body.  A client asking for gzip
+gets the body compressed.  The XML-RPC methods have the same names,
+snapshot(version) and diff(version) return modified False rather than the
+nodes when version is current.
+
+Client keeps a copy of the snapshot in step with a service by fetching diffs
+and fetch(url) returns the nodes like crawl.crawl.  crawl.latest uses the
+service named by BRUNET_CRAWL_SERVICE. """
+import crawl, xmlrpclib, SimpleXMLRPCServer, SocketServer, urllib2, urlparse, threading, \
+  json, gzip, cStringIO, hashlib, sys, getopt, time, unittest
+
+usage = """usage:
+python crawlservice.py [--port=<xmlrpc port of a brunet node>]
+  [--listen=<port>] [--interval=<seconds>] [--keep=<versions>] [--mapreduce]
+  [--connections] [--output=<filename>]
+python crawlservice.py test
+port = the xmlrpc port for a brunet node to be used for crawling
+listen = port to serve queries on, default 10080
+interval = seconds from the start of a crawl to the start of the next,
+  default 300
+keep = number of versions whose changes are kept for diffs, default 100
+mapreduce = crawl with a map-reduce broadcast (see crawl.py)
+connections = also record each node's structured connections
+output = save each new snapshot here (see crawl.py --output)"""
+
+# fields that differ from one crawl to the next without the node changing
+VOLATILE = ["retries"]
+
+def main():
+  try:
+    optlist, args = getopt.getopt(sys.argv[1:], "", ["port=", "listen=", \
+      "interval=", "keep=", "mapreduce", "connections", "output="])
+    o_d = {}
+    for k,v in optlist:
+      o_d[k] = v
+    if len(args) > 0 and args[0] == "test":
+      suite = unittest.TestLoader().loadTestsFromTestCase(TestCrawlService)
+      unittest.TextTestRunner(verbosity=1).run(suite)
+      return
+    port = int(o_d.get("--port", 10000))
+    listen = int(o_d.get("--listen", 10080))
+    interval = float(o_d.get("--interval", 300))
+    keep = int(o_d.get("--keep", 100))
+  except:
+    print usage
+    return
+
+  crawler = crawl.crawl
+  if "--mapreduce" in o_d:
+    crawler = crawl.crawl_mapreduce
+  connections = "--connections" in o_d
+  def _crawl():
+    return crawler(port, connections = connections)
+  service = CrawlService(_crawl, History(keep), interval, o_d.get("--output"), \
+    crawl.print_logger)
+  service.start()
+  server = make_server(service.history, listen)
+  print "Serving crawls of port %i on port %i" % (port, listen)
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+
+def stable(record):
+  return dict([(k, v) for k, v in record.items() if k not in VOLATILE])
+
+class History:
+  """The latest snapshot and the changes that led to it, thread safe"""
+  def __init__(self, keep = 100):
+    self.keep = keep
+    self.lock = threading.Lock()
+    self.version = 0
+    self.nodes = None
+    self.time = None
+    self.checked = None
+    # (version, time, {address : record, None if it was removed}), oldest first
+    self.changes = []
+    # (version, time, nodes, consistent nodes, seconds, error) of every crawl
+    self.crawls = []
+    # version -> (json, gzipped json) of the snapshot
+    self.encoded = {}
+
+  def update(self, nodes, seconds = 0.0, error = None):
+    """Makes nodes, a crawl that took seconds, the latest snapshot if it
+    differs from it.  A failed crawl only goes in the history."""
+    now = time.time()
+    with self.lock:
+      old = self.nodes or {}
+    changed = {}
+    if error == None:
+      for addr, record in nodes.iteritems():
+        if addr not in old or stable(old[addr]) != stable(record):
+          changed[addr] = record
+      for addr in old:
+        if addr not in nodes:
+          changed[addr] = None
+    with self.lock:
+      if error == None:
+        self.checked = now
+        if len(changed) > 0 or self.nodes == None:
+          self.version += 1
+          self.nodes = nodes
+          self.time = now
+          self.changes.append((self.version, now, changed))
+          del self.changes[:-self.keep]
+          self.encoded = {}
+      count = consistent = 0
+      if self.nodes != None:
+        count, consistent = len(self.nodes), crawl.check_results(self.nodes)[0]
+      self.crawls.append((self.version, now, count, consistent, seconds, error))
+      del self.crawls[:-self.keep]
+      return self.version
+
+  def get(self):
+    """(version, time, nodes), nodes is None before the first crawl"""
+    with self.lock:
+      return self.version, self.time, self.nodes
+
+  def diff(self, since):
+    """(version, {address : record}, [removed addresses]) since version since
+    or None if its changes are no longer kept"""
+    with self.lock:
+      version = self.version
+      if since > version or since < 0:
+        return None
+      changes = [c for c in self.changes if c[0] > since]
+      if since < version and (len(changes) == 0 or changes[0][0] != since + 1):
+        return None
+    merged = {}
+    for (v, t, changed) in changes:
+      merged.update(changed)
+    nodes = dict([(a, r) for a, r in merged.iteritems() if r != None])
+    removed = sorted([a for a, r in merged.iteritems() if r == None])
+    return version, nodes, removed
+
+  def encode(self, version, nodes, t, compressed):
+    """The json of a snapshot, kept for the version so the consumers of one
+    snapshot share the work"""
+    with self.lock:
+      cached = self.encoded.get(version)
+    if cached == None:
+      body = json.dumps({'version' : version, 'time' : t, 'nodes' : nodes})
+      buf = cStringIO.StringIO()
+      f = gzip.GzipFile(fileobj = buf, mode = "wb", compresslevel = 6)
+      f.write(body)
+      f.close()
+      cached = (body, buf.getvalue())
+      with self.lock:
+        if self.version == version:
+          self.encoded[version] = cached
+    return cached[1] if compressed else cached[0]
+
+class CrawlService:
+  """Runs crawler every interval seconds into history"""
+  def __init__(self, crawler, history, interval = 300, output = None, \
+    logger = crawl.null_logger):
+    self.crawler = crawler
+    self.history = history
+    self.interval = interval
+    self.output = output
+    self.logger = logger
+
+  def refresh(self):
+    start = time.time()
+    before = self.history.version
+    try:
+      nodes = self.crawler()
+      if len(nodes) == 0:
+        raise ValueError("crawl found no nodes")
+    except Exception, e:
+      self.history.update(None, time.time() - start, str(e))
+      self.logger("Crawl failed: %s" % e)
+      return self.history.version
+    version = self.history.update(nodes, time.time() - start)
+    if version != before:
+      self.logger("Version %i, %i nodes, crawled in %.1f seconds" % \
+        (version, len(nodes), time.time() - start))
+      if self.output:
+        crawl.save_snapshot(nodes, self.output)
+    return version
+
+  def start(self):
+    def _run():
+      while True:
+        start = time.time()
+        self.refresh()
+        time.sleep(max(0, self.interval - (time.time() - start)))
+    t = threading.Thread(target = _run)
+    t.daemon = True
+    t.start()
+
+class NotModified(Exception):
+  pass
+
+class QueryError(Exception):
+  def __init__(self, code, msg):
+    Exception.__init__(self, msg)
+    self.code = code
+
+class Queries:
+  """The queries, also the XML-RPC methods"""
+  def __init__(self, history):
+    self.store = history
+
+  def _current(self):
+    version, t, nodes = self.store.get()
+    if nodes == None:
+      raise QueryError(503, "no crawl yet")
+    return version, t, nodes
+
+  def version(self):
+    version, t, nodes = self._current()
+    return {'version' : version, 'time' : t, 'checked' : self.store.checked}
+
+  def snapshot(self, version = -1):
+    current, t, nodes = self._current()
+    if version == current:
+      return {'version' : current, 'modified' : False}
+    return {'version' : current, 'modified' : True, 'time' : t, 'nodes' : nodes}
+
+  def diff(self, since):
+    current, t, nodes = self._current()
+    res = self.store.diff(since)
+    if res == None:
+      raise QueryError(410, "changes since version %i are not kept" % since)
+    version, changed, removed = res
+    if since == version:
+      return {'version' : version, 'modified' : False}
+    return {'version' : version, 'modified' : True, 'since' : since, \
+      'nodes' : changed, 'removed' : removed}
+
+  def node(self, addr):
+    version, t, nodes = self._current()
+    if addr not in nodes:
+      raise QueryError(404, "no node " + addr)
+    return nodes[addr]
+
+  def neighbors(self, addr):
+    record = self.node(addr)
+    return dict([(k, record[k]) for k in \
+      ("left", "left2", "right", "right2", "connections") if k in record])
+
+  def consistency(self):
+    version, t, nodes = self._current()
+    count, consistent = len(nodes), crawl.check_results(nodes)[0]
+    return {'version' : version, 'nodes' : count, 'consistent' : consistent,
+            'consistency' : consistent / float(max(count, 1)),
+            'inconsistent' : sorted([a for a in nodes \
+              if nodes[a]['consistency'] < 1])}
+
+  def history(self):
+    with self.store.lock:
+      crawls = list(self.store.crawls)
+    return [{'version' : c[0], 'time' : c[1], 'nodes' : c[2], \
+      'consistent' : c[3], 'seconds' : c[4], 'error' : c[5] or ""} for c in crawls]
+
+# the GETs that only change with the snapshot version
+VERSIONED_QUERIES = ("snapshot", "diff", "node", "neighbors", "consistency")
+
+class QueryHandler(SimpleXMLRPCServer.SimpleXMLRPCRequestHandler):
+  rpc_paths = ("/", "/RPC2")
+  protocol_version = "HTTP/1.1"
+
+  def do_GET(self):
+    queries = self.server.queries
+    url = urlparse.urlparse(self.path)
+    parts = url.path.strip("/").split("/", 1)
+    params = urlparse.parse_qs(url.query)
+    try:
+      etag = None
+      if parts[0] in VERSIONED_QUERIES:
+        version = queries._current()[0]
+        etag = '"%i"' % version
+        if self.headers.get("If-None-Match") == etag:
+          raise NotModified()
+      compressed = "gzip" in self.headers.get("Accept-Encoding", "")
+      if parts[0] == "snapshot":
+        #the snapshot may have moved on, the etag is the version sent
+        version, t, nodes = queries._current()
+        etag = '"%i"' % version
+        body = queries.store.encode(version, nodes, t, compressed)
+        return self.reply(200, body, etag, compressed)
+      elif parts[0] == "diff":
+        res = queries.diff(int(params.get("since", ["0"])[0]))
+        if not res['modified']:
+          raise NotModified()
+        etag = '"%i"' % res['version']
+      elif parts[0] in ("node", "neighbors") and len(parts) == 2:
+        res = getattr(queries, parts[0])(parts[1])
+      elif parts[0] in ("version", "consistency", "history") and len(parts) == 1:
+        res = getattr(queries, parts[0])()
+      else:
+        raise QueryError(404, "no query " + url.path)
+    except NotModified:
+      return self.reply(304, "", etag)
+    except QueryError, e:
+      return self.reply(e.code, json.dumps({'error' : str(e)}))
+    except ValueError, e:
+      return self.reply(400, json.dumps({'error' : str(e)}))
+    body = json.dumps(res)
+    if etag == None:
+      etag = '"%s"' % hashlib.sha1(body).hexdigest()
+      if self.headers.get("If-None-Match") == etag:
+        return self.reply(304, "", etag)
+    if compressed:
+      buf = cStringIO.StringIO()
+      f = gzip.GzipFile(fileobj = buf, mode = "wb", compresslevel = 6)
+      f.write(body)
+      f.close()
+      body = buf.getvalue()
+    self.reply(200, body, etag, compressed)
+
+  def reply(self, code, body, etag = None, compressed = False):
+    self.send_response(code)
+    if code != 304:
+      self.send_header("Content-Type", "application/json")
+    if etag:
+      self.send_header("ETag", etag)
+      self.send_header("Cache-Control", "no-cache")
+    if compressed and code == 200:
+      self.send_header("Content-Encoding", "gzip")
+    self.send_header("Content-Length", str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, format, *args):
+    pass
+
+class QueryServer(SocketServer.ThreadingMixIn, SimpleXMLRPCServer.SimpleXMLRPCServer):
+  daemon_threads = True
+  allow_reuse_address = True
+
+  def __init__(self, history, port):
+    SimpleXMLRPCServer.SimpleXMLRPCServer.__init__(self, ('', port), \
+      QueryHandler, logRequests = False, allow_none = True)
+    self.queries = Queries(history)
+    self.register_instance(self.queries)
+
+  def _dispatch(self, method, params):
+    try:
+      return SimpleXMLRPCServer.SimpleXMLRPCServer._dispatch(self, method, params)
+    except QueryError, e:
+      raise xmlrpclib.Fault(e.code, str(e))
+
+def make_server(history, port = 10080):
+  return QueryServer(history, port)
+
+class Client:
+  """A copy of a service's snapshot, brought up to date with a diff when it
+  changed and not fetched at all when it did not"""
+  def __init__(self, url):
+    self.url = url.rstrip("/")
+    self.version = None
+    self.nodes = None
+
+  def get(self, path, etag = None):
+    request = urllib2.Request(self.url + path)
+    request.add_header("Accept-Encoding", "gzip")
+    if etag:
+      request.add_header("If-None-Match", etag)
+    try:
+      response = urllib2.urlopen(request)
+    except urllib2.HTTPError, e:
+      if e.code == 304:
+        return None
+      raise
+    body = response.read()
+    if response.info().get("Content-Encoding") == "gzip":
+      body = gzip.GzipFile(fileobj = cStringIO.StringIO(body)).read()
+    return json.loads(body)
+
+  def update(self):
+    """The latest nodes, returns whether they changed"""
+    if self.version != None:
+      try:
+        res = self.get("/diff?since=%i" % self.version, '"%i"' % self.version)
+        if res == None:
+          return False
+        for addr in res['removed']:
+          self.nodes.pop(addr, None)
+        self.nodes.update(res['nodes'])
+        self.version = res['version']
+        return True
+      except urllib2.HTTPError, e:
+        if e.code != 410:
+          raise
+    res = self.get("/snapshot")
+    self.version = res['version']
+    self.nodes = res['nodes']
+    return True
+
+# a Client per service url, so repeated fetches only get the changes
+_clients = {}
+
+def fetch(url):
+  """The latest nodes of the service at url, like crawl.crawl returns"""
+  if url not in _clients:
+    _clients[url] = Client(url)
+  client = _clients[url]
+  client.update()
+  return dict(client.nodes)
+
+#############################
+# Here are the unit tests
+#############################
+
+class TestCrawlService(unittest.TestCase):
+  def nodes(self, addrs):
+    res = {}
+    for i, addr in enumerate(addrs):
+      res[addr] = {'left' : addrs[i - 1], 'left2' : addrs[i - 2], \
+        'right' : addrs[(i + 1) % len(addrs)], 'right2' : addrs[(i + 2) % len(addrs)], \
+        'retries' : i % 2, 'ips' : "", 'geo_loc' : ",", 'type' : "BasicNode"}
+    crawl.check_consistency(res)
+    return res
+
+  def testHistory(self):
+    history = History(3)
+    self.assertEqual(history.update(self.nodes(["a", "b", "c", "d"])), 1)
+    #only the retries changed
+    same = self.nodes(["a", "b", "c", "d"])
+    for record in same.values():
+      record['retries'] += 1
+    self.assertEqual(history.update(same), 1)
+    self.assertEqual(history.update(None, 1, "timed out"), 1)
+    self.assertEqual(history.update(self.nodes(["a", "b", "c"])), 2)
+    self.assertEqual(history.update(self.nodes(["a", "b", "c", "e"])), 3)
+    version, changed, removed = history.diff(1)
+    self.assertEqual(version, 3)
+    self.assertEqual(removed, ["d"])
+    self.assertEqual(sorted(changed), ["a", "b", "c", "e"])
+    self.assertEqual(history.diff(3)[1:], ({}, []))
+    self.assertEqual(history.update(self.nodes(["a", "b", "e"])), 4)
+    self.assertEqual(history.update(self.nodes(["b", "e"])), 5)
+    #the changes of versions 2 to 5 are kept, not those of 1
+    self.assertEqual(history.diff(1), None)
+    self.assertEqual(history.diff(2)[0], 5)
+    self.assertEqual(len(history.crawls), 3)
+
+  def testService(self):
+    import ringemu, pybru, xmlrpclib
+    ring = ringemu.VirtualRing(30)
+    node = ringemu.make_server(ring, 0)
+    t = threading.Thread(target = node.serve_forever)
+    t.daemon = True
+    t.start()
+    port = node.server_address[1]
+    history = History()
+    crawls = []
+    def _crawl():
+      crawls.append(1)
+      return crawl.crawl(port)
+    service = CrawlService(_crawl, history)
+    server = make_server(history, 0)
+    t = threading.Thread(target = server.serve_forever)
+    t.daemon = True
+    t.start()
+    url = "http://127.0.0.1:%i" % server.server_address[1]
+    try:
+      client = Client(url)
+      self.assertRaises(urllib2.HTTPError, client.update)
+      self.assertEqual(service.refresh(), 1)
+      self.assertTrue(client.update())
+      self.assertEqual(sorted(client.nodes), sorted([str(pybru.Address(a)) \
+        for a in ring.addrs]))
+      #a second consumer and a crawl with no change do not crawl or send again
+      self.assertEqual(service.refresh(), 1)
+      self.assertFalse(client.update())
+      self.assertEqual(fetch(url), client.nodes)
+      self.assertEqual(len(crawls), 2)
+      ring.churn_once()
+      self.assertEqual(service.refresh(), 2)
+      self.assertTrue(client.update())
+      self.assertEqual(client.version, 2)
+      self.assertEqual(sorted(client.nodes), sorted([str(pybru.Address(a)) \
+        for a in ring.addrs]))
+      self.assertEqual(json.loads(json.dumps(history.get()[2])), client.nodes)
+      addr = str(pybru.Address(ring.addrs[0]))
+      neighbors = client.get("/neighbors/" + addr)
+      self.assertEqual(neighbors['left'], str(pybru.Address(ring.addrs[1])))
+      self.assertEqual(client.get("/snapshot", '"2"'), None)
+      self.assertEqual(client.get("/consistency")['consistency'], 1.0)
+      rpc = xmlrpclib.Server(url)
+      self.assertEqual(rpc.snapshot(2), {'version' : 2, 'modified' : False})
+      self.assertEqual(len(rpc.snapshot(1)['nodes']), 30)
+      self.assertEqual(rpc.node(addr)['right'], neighbors['right'])
+      self.assertEqual(len(rpc.history()), 3)
+      #/history changes with a crawl that keeps the version, so does its etag
+      def _history(etag = None):
+        request = urllib2.Request(url + "/history")
+        if etag:
+          request.add_header("If-None-Match", etag)
+        try:
+          response = urllib2.urlopen(request)
+        except urllib2.HTTPError, e:
+          return e.code, e.info().get("ETag")
+        response.read()
+        return response.code, response.info().get("ETag")
+      code, etag = _history('"2"')
+      self.assertEqual(code, 200)
+      self.assertEqual(_history(etag), (304, etag))
+      self.assertEqual(service.refresh(), 2)
+      code, new_etag = _history(etag)
+      self.assertEqual(code, 200)
+      self.assertNotEqual(new_etag, etag)
+      try:
+        rpc.node("brunet:node:none")
+        self.fail()
+      except xmlrpclib.Fault, f:
+        self.assertEqual(f.faultCode, 404)
+    finally:
+      server.shutdown()
+      server.server_close()
+      node.shutdown()
+      node.server_close()
+
+if __name__ == "__main__":
+  main()
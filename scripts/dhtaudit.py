@@ -0,0 +1,382 @@
+#!/usr/bin/python
+""" Audits that the DHT holds the records it is expected to.  The expected
+records are streamed from a file of key<tab>value[<tab>ttl[<tab>put time]]
+lines, with the lines of a key next to each other, or from a dhtkeeper.py
+store.  Keys are queried concurrently, with DhtClient.Get or, with
+--progressive, BeginGet / ContinueGet which also times how long the expected
+values take to show up.  Each key is classified as
+  complete = every expected value was returned
+  partial = some of the expected values are missing
+  missing = none of the expected values were returned
+  stale = every value is there but with less ttl left than the last put gave
+    it (an older copy), or under --min_ttl when the put time is unknown
+With --replicas every replica of the key (Dht.MapToRing) is also asked with
+dht.Get for the replicas that lack the data; this sends a null argument so the
+node's xmlrpc server must accept <nil/>.
+
+Summaries are printed per range of the address space, by the first replica of
+the key, and per time window, both by the age of the last put and by when the
+key was audited. """
+import xmlrpclib, rpcstats, pybru, dhtplace, dhtkeeper, sys, getopt, time, \
+  threading, itertools, json, unittest
+from multiprocessing.pool import ThreadPool
+
+usage = """usage:
+python dhtaudit.py [--port=<xmlrpc port>] [--parallel=<in flight keys>]
+  [--progressive] [--replicas] [--degree=<n>] [--ranges=<count>]
+  [--window=<seconds>] [--min_ttl=<seconds>] [--ttl_slack=<seconds>]
+  [--problems=<filename>] [--output=<filename>] <records file, - for stdin>
+python dhtaudit.py --db=<dhtkeeper store> [options]
+python dhtaudit.py test
+port = the xmlrpc port for the local brunet node
+parallel = maximum number of keys audited at once, default 64
+progressive = use BeginGet / ContinueGet and time the arrival of the values
+replicas = also check each replica of the key with dht.Get
+degree = replicas per key, default 8 (BasicNode uses 2^3)
+ranges = number of address ranges to summarize, default 16
+window = seconds per time window, default 600
+min_ttl = without a put time, values with less ttl left are stale, default 60
+ttl_slack = with a put time, values with this much less ttl than expected are
+  stale, default 120
+problems = write key<tab>class<tab>details for every key not complete
+output = write the summaries as json
+db = read the expected records from a dhtkeeper.py store"""
+
+CLASSES = ["complete", "partial", "missing", "stale", "error"]
+
+def main():
+  try:
+    optlist, args = getopt.getopt(sys.argv[1:], "", ["port=", "parallel=", \
+      "progressive", "replicas", "degree=", "ranges=", "window=", "min_ttl=", \
+      "ttl_slack=", "problems=", "output=", "db="])
+    o_d = {}
+    for k,v in optlist:
+      o_d[k] = v
+    port = int(o_d.get("--port", 10000))
+    parallel = int(o_d.get("--parallel", 64))
+    degree = int(o_d.get("--degree", 8))
+    ranges = int(o_d.get("--ranges", 16))
+    window = float(o_d.get("--window", 600))
+    min_ttl = int(o_d.get("--min_ttl", 60))
+    ttl_slack = int(o_d.get("--ttl_slack", 120))
+    if "--db" not in o_d and args[0] == "test":
+      suite = unittest.TestLoader().loadTestsFromTestCase(TestDhtAudit)
+      unittest.TextTestRunner(verbosity=2).run(suite)
+      return
+    if "--db" in o_d:
+      expected = read_store(dhtkeeper.Store(o_d["--db"]))
+    elif args[0] == "-":
+      expected = read_expected(sys.stdin)
+    else:
+      expected = read_expected(open(args[0]))
+  except:
+    print usage
+    return
+
+  auditor = Auditor(port, "--progressive" in o_d, "--replicas" in o_d, degree, \
+    min_ttl, ttl_slack)
+  summary = Summary(ranges, window)
+  problems = None
+  if "--problems" in o_d:
+    problems = open(o_d["--problems"], "w")
+  for res in auditor.audit_all(expected, parallel):
+    summary.add(res)
+    if problems and res['class'] != "complete":
+      problems.write("%s\t%s\t%s\n" % (res['key'], res['class'], \
+        json.dumps(res.get('details', {}))))
+  if problems:
+    problems.close()
+  summary.print_report()
+  if "--output" in o_d:
+    f = open(o_d["--output"], "w")
+    json.dump(summary.to_dict(), f)
+    f.close()
+
+def read_expected(f):
+  """Yields (key, [(value, ttl, put time)]), ttl and put time may be None"""
+  lines = (line.rstrip("\r\n").split("\t") for line in f if line.strip())
+  for key, group in itertools.groupby(lines, lambda fields: fields[0]):
+    values = []
+    for fields in group:
+      ttl = put_time = None
+      if len(fields) > 2:
+        ttl = int(fields[2])
+      if len(fields) > 3:
+        put_time = float(fields[3])
+      values.append((fields[1], ttl, put_time))
+    yield key, values
+
+def read_store(store):
+  """The same from a dhtkeeper store, the last put was one refresh period
+  before the next"""
+  rows = store.db.execute("SELECT key, value, ttl, next_put FROM records ORDER BY key")
+  for key, group in itertools.groupby(rows, lambda row: row[0]):
+    values = []
+    for k, value, ttl, next_put in group:
+      put_time = None
+      if next_put > 0:
+        put_time = next_put - dhtkeeper.refresh_after(ttl)
+      values.append((value, ttl, put_time))
+    yield key, values
+
+class Auditor:
+  def __init__(self, port = 10000, progressive = False, replicas = False, \
+    degree = 8, min_ttl = 60, ttl_slack = 120):
+    self.url = "http://127.0.0.1:%i/xm.rem" % port
+    self.progressive = progressive
+    self.replicas = replicas
+    self.degree = degree
+    self.min_ttl = min_ttl
+    self.ttl_slack = ttl_slack
+    self.local = threading.local()
+
+  def rpc(self):
+    if not hasattr(self.local, "rpc"):
+      self.local.rpc = rpcstats.Server(self.url, allow_none = True)
+    return self.local.rpc
+
+  def get(self, key, wanted):
+    """{value : ttl} of the results and, when progressive, the seconds until
+    the first and the last of the wanted values arrived"""
+    rpc = self.rpc()
+    key = xmlrpclib.Binary(key)
+    found = {}
+    times = {}
+    if not self.progressive:
+      for res in rpc.localproxy("DhtClient.Get", key):
+        found[res['value'].data] = res['ttl']
+      return found, times
+    start = time.time()
+    token = rpc.localproxy("DhtClient.BeginGet", key)
+    try:
+      res = rpc.localproxy("DhtClient.ContinueGet", token)
+      while len(res) > 0:
+        value = res['value'].data
+        found[value] = res['ttl']
+        if value in wanted:
+          times.setdefault('first', time.time() - start)
+          if len([v for v in wanted if v in found]) == len(wanted):
+            times['last'] = time.time() - start
+        res = rpc.localproxy("DhtClient.ContinueGet", token)
+    finally:
+      rpc.localproxy("DhtClient.EndGet", token)
+    return found, times
+
+  def check_replicas(self, key, wanted):
+    """The replica indexes that are missing some wanted value"""
+    rpc = self.rpc()
+    lacking = []
+    for k, target in enumerate(dhtplace.map_to_ring(key, self.degree)):
+      addr = pybru.Address(target)
+      try:
+        res = rpc.proxy(str(addr), 3, 1, "dht.Get", \
+          xmlrpclib.Binary(addr.bindata), 1024, None)
+        values = set()
+        if len(res) > 0 and isinstance(res[0], list) and len(res[0]) > 0:
+          values = set([v['value'].data for v in res[0][0]])
+        if not wanted.issubset(values):
+          lacking.append(k)
+      except Exception:
+        lacking.append(k)
+    return lacking
+
+  def audit(self, item):
+    key, values = item
+    now = time.time()
+    res = {'key' : key, 'time' : now, 'target' : dhtplace.map_to_ring(key, 1)[0]}
+    puts = [v[2] for v in values if v[2] != None]
+    if len(puts) > 0:
+      res['age'] = now - max(puts)
+    wanted = set([v[0] for v in values])
+    try:
+      found, times = self.get(key, wanted)
+    except Exception, e:
+      res['class'] = "error"
+      res['details'] = {'error' : str(e)}
+      return res
+    res.update(times)
+    present = [v for v in values if v[0] in found]
+    stale = []
+    for value, ttl, put_time in present:
+      if ttl != None and put_time != None:
+        if found[value] < put_time + ttl - now - self.ttl_slack:
+          stale.append(value)
+      elif found[value] < self.min_ttl:
+        stale.append(value)
+    if len(present) == 0:
+      res['class'] = "missing"
+    elif len(present) < len(values):
+      res['class'] = "partial"
+      res['details'] = {'missing' : [v[0] for v in values if v[0] not in found]}
+    elif len(stale) > 0:
+      res['class'] = "stale"
+      res['details'] = {'stale' : stale}
+    else:
+      res['class'] = "complete"
+    if self.replicas and res['class'] != "complete":
+      res.setdefault('details', {})['lacking_replicas'] = \
+        self.check_replicas(key, wanted)
+    return res
+
+  def audit_all(self, expected, parallel = 64):
+    """Yields the result of every key as they finish, only a few batches of
+    keys are read ahead of the calls"""
+    pool = ThreadPool(parallel)
+    try:
+      while True:
+        batch = list(itertools.islice(expected, parallel * 16))
+        if len(batch) == 0:
+          break
+        for res in pool.imap_unordered(self.audit, batch):
+          yield res
+    finally:
+      pool.close()
+
+def percentile(values, q):
+  values = sorted(values)
+  return values[int(q * (len(values) - 1))]
+
+class Summary:
+  """Class counts per address range, per age window and per audit window"""
+  def __init__(self, ranges = 16, window = 600):
+    self.ranges = ranges
+    self.window = window
+    self.start = time.time()
+    self.total = dict([(c, 0) for c in CLASSES])
+    self.by_range = [dict([(c, 0) for c in CLASSES]) for i in xrange(ranges)]
+    self.by_age = {}
+    self.by_audit = {}
+    self.replicas = {}
+    self.first = []
+    self.last = []
+
+  def count(self, table, key, cls):
+    if key not in table:
+      table[key] = dict([(c, 0) for c in CLASSES])
+    table[key][cls] += 1
+
+  def add(self, res):
+    cls = res['class']
+    self.total[cls] += 1
+    self.by_range[res['target'] * self.ranges >> 160][cls] += 1
+    if 'age' in res:
+      self.count(self.by_age, int(res['age'] // self.window), cls)
+    self.count(self.by_audit, int((res['time'] - self.start) // self.window), cls)
+    for k in res.get('details', {}).get('lacking_replicas', []):
+      self.replicas[k] = self.replicas.get(k, 0) + 1
+    if 'first' in res:
+      self.first.append(res['first'])
+    if 'last' in res:
+      self.last.append(res['last'])
+
+  def to_dict(self):
+    return {'total' : self.total, 'by_range' : self.by_range,
+            'by_age' : self.by_age, 'by_audit' : self.by_audit,
+            'window' : self.window, 'lacking_replicas' : self.replicas}
+
+  def print_report(self):
+    keys = sum(self.total.values())
+    print "Keys: %i in %.1f seconds" % (keys, time.time() - self.start)
+    print format_counts("total", self.total)
+    print "By address range (first replica):"
+    for i in xrange(self.ranges):
+      low = pybru.Address((i << 160) / self.ranges)
+      print format_counts("  %s" % low, self.by_range[i])
+    if len(self.by_age) > 0:
+      print "By age of the last put:"
+      for w in sorted(self.by_age):
+        print format_counts("  %is-%is" % (w * self.window, (w + 1) * self.window), \
+          self.by_age[w])
+    print "By audit time:"
+    for w in sorted(self.by_audit):
+      print format_counts("  +%is" % (w * self.window), self.by_audit[w])
+    if len(self.replicas) > 0:
+      print "Replicas lacking data: " + ", ".join(["%i: %i" % (k, self.replicas[k]) \
+        for k in sorted(self.replicas)])
+    for name, times in (("first value", self.first), ("all values", self.last)):
+      if len(times) > 0:
+        print "Time to %s: p50=%.3fs p90=%.3fs p99=%.3fs max=%.3fs" % (name, \
+          percentile(times, 0.5), percentile(times, 0.9), \
+          percentile(times, 0.99), max(times))
+
+def format_counts(name, counts):
+  total = sum(counts.values())
+  fields = ["%s=%i" % (c, counts[c]) for c in CLASSES if counts[c] > 0]
+  complete = counts['complete'] / float(total) if total > 0 else 0
+  return "%s: %i keys, %.3f complete %s" % (name, total, complete, " ".join(fields))
+
+#############################
+# Here are the unit tests
+#############################
+
+class TestDhtAudit(unittest.TestCase):
+  def setUp(self):
+    import ringemu
+    self.ring = ringemu.VirtualRing(100)
+    self.server = ringemu.make_server(self.ring, 0)
+    t = threading.Thread(target = self.server.serve_forever)
+    t.daemon = True
+    t.start()
+    self.port = self.server.server_address[1]
+
+  def tearDown(self):
+    self.server.shutdown()
+    self.server.server_close()
+
+  def testReadExpected(self):
+    lines = ["a\t1\n", "a\t2\t600\n", "\n", "b\t3\t600\t1000.5\r\n", \
+      "a\t4\n"]
+    self.assertEqual(list(read_expected(lines)), [
+      ("a", [("1", None, None), ("2", 600, None)]),
+      ("b", [("3", 600, 1000.5)]),
+      #only lines next to each other are grouped
+      ("a", [("4", None, None)])])
+
+  def testClasses(self):
+    now = time.time()
+    for (key, value, ttl) in [("complete", "1", 3000), ("complete", "2", 3000), \
+      ("partial", "1", 3000), ("stale", "1", 100), ("old", "1", 100)]:
+      self.ring.dht_put(key, value, ttl)
+    expected = [("complete", [("1", None, None), ("2", 3000, now)]),
+      ("partial", [("1", 3000, now), ("2", 3000, now)]),
+      ("missing", [("1", None, None)]),
+      #put with 3000 seconds, only 100 are left
+      ("stale", [("1", 3000, now)]),
+      #no put time, under min_ttl
+      ("old", [("1", None, None)])]
+    for progressive in (False, True):
+      auditor = Auditor(self.port, progressive, True, 8, 200)
+      results = dict([(res['key'], res) for res in \
+        auditor.audit_all(iter(expected), 4)])
+      self.assertEqual(sorted(results), sorted([k for (k, v) in expected]))
+      classes = [results[k]['class'] for (k, v) in expected]
+      self.assertEqual(classes, ["complete", "partial", "missing", "stale", "stale"])
+      self.assertEqual(results['partial']['details']['missing'], ["2"])
+      self.assertEqual(results['stale']['details']['stale'], ["1"])
+      #the emulated replicas all hold the key or none do
+      self.assertEqual(results['missing']['details']['lacking_replicas'], range(8))
+      self.assertEqual(results['stale']['details']['lacking_replicas'], [])
+      self.assertFalse('details' in results['complete'])
+      self.assertTrue(results['complete']['age'] < 5)
+      self.assertEqual('first' in results['complete'], progressive)
+      self.assertEqual('last' in results['complete'], progressive)
+      self.assertEqual(results['missing']['target'], \
+        dhtplace.map_to_ring("missing", 1)[0])
+    self.assertEqual(len(self.ring.gets), 0)
+    summary = Summary(4)
+    for res in results.values():
+      summary.add(res)
+    self.assertEqual(summary.total, {'complete' : 1, 'partial' : 1, \
+      'missing' : 1, 'stale' : 2, 'error' : 0})
+    self.assertEqual(sum([sum(r.values()) for r in summary.by_range]), 5)
+    self.assertEqual(summary.replicas, dict([(k, 2) for k in xrange(8)]))
+
+  def testError(self):
+    self.server.shutdown()
+    self.server.server_close()
+    res = Auditor(self.port).audit(("key", [("1", None, None)]))
+    self.assertEqual(res['class'], "error")
+    self.assertTrue('error' in res['details'])
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,346 @@
+#!/usr/bin/python
+""" Keeps client owned DHT records alive by putting them again shortly before
+they expire, so the refresh state lives here rather than inside the node as it
+does with RpcDhtProxy.Register.  The desired key / value / ttl of each record
+and the time of its next put are kept in an sqlite file, and the pending
+refreshes in a hierarchical timing wheel holding only record ids, so millions
+of records cost a few arrays in memory.
+
+Due records are put in concurrent batches limited to a number of puts per
+second; anything over the limit waits for the next tick.  On start records
+keep the refresh times saved in the store, and the ones that became due while
+the keeper was down are spread over a window instead of being put all at
+once.  Records added or removed with the add / remove actions are picked up
+by a running keeper. """
+import xmlrpclib, rpcstats, multinode, sys, getopt, time, random, sqlite3, \
+  threading, unittest
+from array import array
+from multiprocessing.pool import ThreadPool
+
+usage = """usage:
+python dhtkeeper.py [--db=<file>] add [--ttl=<seconds>] <key> <value>
+python dhtkeeper.py [--db=<file>] import [--ttl=<seconds>] <file, - for stdin>
+python dhtkeeper.py [--db=<file>] remove <key> [<value>]
+python dhtkeeper.py [--db=<file>] list
+python dhtkeeper.py [--db=<file>] run [--port=<xmlrpc port>] [--rate=<puts/s>]
+  [--parallel=<in flight puts>] [--spread=<seconds>] [--multinode]
+python dhtkeeper.py test
+db = the record store, default dhtkeeper.db
+ttl = ttl of the record in seconds, default 3600
+import = add a record for every key<tab>value line
+run = keep the records alive until killed
+port = the xmlrpc port for the local brunet node
+rate = maximum puts per second, default 100
+parallel = maximum number of outstanding puts, default 16
+spread = records overdue at start are put over this many seconds, default 300
+multinode = spread the puts over all the local nodes (see multinode.py)"""
+
+# refresh this fraction of the ttl before a record expires
+REFRESH_MARGIN = 0.1
+# seconds to wait before trying a failed put again
+RETRY_DELAY = 30
+
+def main():
+  try:
+    optlist, args = getopt.getopt(sys.argv[1:], "", ["db=", "ttl=", "port=", \
+      "rate=", "parallel=", "spread=", "multinode"])
+    o_d = {}
+    for k,v in optlist:
+      o_d[k] = v
+    action = args[0]
+    #options may also follow the action
+    optlist, args = getopt.getopt(args[1:], "", ["db=", "ttl=", "port=", \
+      "rate=", "parallel=", "spread=", "multinode"])
+    for k,v in optlist:
+      o_d[k] = v
+    db = o_d.get("--db", "dhtkeeper.db")
+    ttl = int(o_d.get("--ttl", 3600))
+    port = int(o_d.get("--port", 10000))
+    rate = float(o_d.get("--rate", 100))
+    parallel = int(o_d.get("--parallel", 16))
+    spread = float(o_d.get("--spread", 300))
+    if action == "add":
+      key, value = args
+    elif action == "import":
+      filename = args[0]
+    elif action == "remove":
+      key = args[0]
+      value = None
+      if len(args) > 1:
+        value = args[1]
+    elif action not in ("list", "run", "test"):
+      raise ValueError(action)
+  except:
+    print usage
+    return
+
+  if action == "test":
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestDhtKeeper)
+    unittest.TextTestRunner(verbosity=1).run(suite)
+    return
+  store = Store(db)
+  if action == "add":
+    store.add([(key, value, ttl)])
+  elif action == "import":
+    if filename == "-":
+      f = sys.stdin
+    else:
+      f = open(filename)
+    store.add(read_records(f, ttl))
+  elif action == "remove":
+    print "Removed %i records" % store.remove(key, value)
+  elif action == "list":
+    for rid, key, value, ttl, next_put in store.records():
+      print "%s\t%s\tttl=%i\tnext=%s" % (key, value, ttl, \
+        time.ctime(next_put) if next_put > 0 else "now")
+  else:
+    if "--multinode" in o_d:
+      client = multinode.MultiNodeClient(port, multinode.Affinity(), parallel)
+    else:
+      client = SingleNode(port)
+    Keeper(store, client, rate, parallel, spread).run()
+
+def read_records(f, ttl):
+  for line in f:
+    key, sep, value = line.rstrip("\r\n").partition("\t")
+    yield key, value, ttl
+
+class Store:
+  """The desired records, next_put is 0 for a record that was never put"""
+  def __init__(self, filename):
+    self.db = sqlite3.connect(filename)
+    self.db.text_factory = str
+    self.db.execute("""CREATE TABLE IF NOT EXISTS records (
+      id INTEGER PRIMARY KEY, key BLOB, value BLOB, ttl INTEGER,
+      next_put REAL DEFAULT 0, UNIQUE(key, value))""")
+    self.db.commit()
+
+  def add(self, records):
+    self.db.executemany("""INSERT OR REPLACE INTO records (key, value, ttl)
+      VALUES (?, ?, ?)""", records)
+    self.db.commit()
+
+  def remove(self, key, value = None):
+    if value == None:
+      c = self.db.execute("DELETE FROM records WHERE key = ?", (key,))
+    else:
+      c = self.db.execute("DELETE FROM records WHERE key = ? AND value = ?", \
+        (key, value))
+    self.db.commit()
+    return c.rowcount
+
+  def records(self, after = 0):
+    return self.db.execute("""SELECT id, key, value, ttl, next_put FROM records
+      WHERE id > ? ORDER BY id""", (after,))
+
+  def get(self, ids):
+    """The (id, key, value, ttl) of the given records that still exist"""
+    res = []
+    #sqlite limits the number of variables in a statement
+    for i in xrange(0, len(ids), 500):
+      part = ids[i:i + 500]
+      res.extend(self.db.execute("""SELECT id, key, value, ttl FROM records
+        WHERE id IN (%s)""" % ",".join("?" * len(part)), part))
+    return res
+
+  def set_next(self, updates):
+    """updates is a list of (next_put, id)"""
+    self.db.executemany("UPDATE records SET next_put = ? WHERE id = ?", updates)
+    self.db.commit()
+
+class TimingWheel:
+  """A hierarchical timing wheel over integer ticks.  Level l has slots buckets
+  of slots^l ticks each, an item goes to the lowest level whose span covers
+  its due tick and moves down a level each time the level below wraps.  Each
+  bucket is a pair of arrays, due ticks and item ids."""
+  def __init__(self, now, bits = 8, levels = 4):
+    self.now = now
+    self.bits = bits
+    self.slots = 1 << bits
+    self.mask = self.slots - 1
+    self.levels = levels
+    self.wheel = [[(array('l'), array('l')) for s in xrange(self.slots)] \
+      for l in xrange(levels)]
+    self.count = 0
+
+  def add(self, due, item):
+    #the slot of the current tick has already expired
+    self.insert(max(due, self.now + 1), item)
+
+  def insert(self, due, item):
+    delta = due - self.now
+    level = 0
+    while level < self.levels - 1 and delta >= 1 << (self.bits * (level + 1)):
+      level += 1
+    #past the last level it waits in the furthest slot and cascades again
+    due_slot = min(due, self.now + (1 << (self.bits * self.levels)) - 1)
+    slot = (due_slot >> (self.bits * level)) & self.mask
+    dues, items = self.wheel[level][slot]
+    dues.append(due)
+    items.append(item)
+    self.count += 1
+
+  def take(self, level, slot):
+    bucket = self.wheel[level][slot]
+    self.wheel[level][slot] = (array('l'), array('l'))
+    self.count -= len(bucket[1])
+    return bucket
+
+  def advance(self, now):
+    """Moves the wheel to the now tick and returns the items that came due"""
+    expired = array('l')
+    while self.now < now:
+      self.now += 1
+      #cascade the levels whose lower level just wrapped, highest first
+      for level in xrange(self.levels - 1, 0, -1):
+        if self.now & ((1 << (self.bits * level)) - 1) == 0:
+          dues, items = self.take(level, (self.now >> (self.bits * level)) & self.mask)
+          for i in xrange(len(items)):
+            self.insert(dues[i], items[i])
+      dues, items = self.take(0, self.now & self.mask)
+      for i in xrange(len(items)):
+        if dues[i] <= self.now:
+          expired.append(items[i])
+        else:
+          self.add(dues[i], items[i])
+    return expired
+
+class SingleNode:
+  """Puts through the local node, one proxy per thread"""
+  def __init__(self, port = 10000):
+    self.url = "http://127.0.0.1:%i/xm.rem" % port
+    self.local = threading.local()
+
+  def localproxy(self, method, *args):
+    if not hasattr(self.local, "rpc"):
+      self.local.rpc = rpcstats.Server(self.url)
+    return self.local.rpc.localproxy(method, *args)
+
+def refresh_after(ttl):
+  return max(1, ttl - int(ttl * REFRESH_MARGIN))
+
+class Keeper:
+  def __init__(self, store, client, rate = 100, parallel = 16, spread = 300):
+    self.store = store
+    self.client = client
+    self.rate = rate
+    self.parallel = parallel
+    self.spread = spread
+    self.wheel = TimingWheel(int(time.time()))
+    #due records held back by the rate limit
+    self.backlog = array('l')
+    self.last_id = 0
+    self.puts = 0
+    self.failures = 0
+
+  def load(self, now):
+    """Schedules the records added since the last load, overdue ones spread
+    over the next spread seconds"""
+    count = 0
+    for rid, key, value, ttl, next_put in self.store.records(self.last_id):
+      self.last_id = rid
+      if next_put <= now:
+        next_put = now + random.uniform(0, self.spread)
+      self.wheel.add(int(next_put), rid)
+      count += 1
+    return count
+
+  def put(self, record):
+    rid, key, value, ttl = record
+    try:
+      ok = self.client.localproxy("DhtClient.Put", xmlrpclib.Binary(key), \
+        xmlrpclib.Binary(value), ttl)
+    except Exception, e:
+      ok = False
+    return rid, ttl, ok == True
+
+  def send(self, pool, ids):
+    """Puts the records in ids, reschedules them and saves the next put times"""
+    records = self.store.get(list(ids))
+    now = time.time()
+    updates = []
+    for rid, ttl, ok in pool.imap_unordered(self.put, records):
+      if ok:
+        self.puts += 1
+        next_put = now + refresh_after(ttl)
+      else:
+        self.failures += 1
+        next_put = now + RETRY_DELAY
+      self.wheel.add(int(next_put), rid)
+      updates.append((next_put, rid))
+    self.store.set_next(updates)
+    #records removed from the store are simply not rescheduled
+    return len(records)
+
+  def step(self, pool, now):
+    """One tick, sends at most rate puts of the due and backlogged records"""
+    self.backlog.extend(self.wheel.advance(int(now)))
+    budget = max(1, int(self.rate))
+    batch = self.backlog[:budget]
+    del self.backlog[:budget]
+    if len(batch) > 0:
+      return self.send(pool, batch)
+    return 0
+
+  def run(self, rescan = 60, report = 60):
+    pool = ThreadPool(self.parallel)
+    print "Loaded %i records" % self.load(time.time())
+    last_scan = last_report = time.time()
+    while True:
+      start = time.time()
+      self.step(pool, start)
+      if start - last_scan >= rescan:
+        self.load(start)
+        last_scan = start
+      if start - last_report >= report:
+        print "%s: %i scheduled, %i backlogged, %i puts, %i failures" % \
+          (time.ctime(start), self.wheel.count, len(self.backlog), self.puts, \
+          self.failures)
+        last_report = start
+      time.sleep(max(0, 1 - (time.time() - start)))
+
+#############################
+# Here are the unit tests
+#############################
+
+class TestDhtKeeper(unittest.TestCase):
+  def testWheel(self):
+    """Items come out at their due tick whatever level they start in"""
+    wheel = TimingWheel(1000, bits = 4, levels = 3)
+    due = {}
+    for i in xrange(2000):
+      due[i] = 1000 + random.randint(1, 6000)
+      wheel.add(due[i], i)
+    seen = {}
+    for now in xrange(1001, 7100, 7):
+      for item in wheel.advance(now):
+        seen[item] = now
+    self.assertEqual(len(seen), 2000)
+    self.assertEqual(wheel.count, 0)
+    for i in due:
+      self.assertTrue(due[i] <= seen[i] < due[i] + 7)
+  def testKeeper(self):
+    class FakeClient:
+      def __init__(self):
+        self.puts = []
+      def localproxy(self, method, key, value, ttl):
+        self.puts.append(key.data)
+        return True
+    store = Store(":memory:")
+    store.add([("k%i" % i, "v", 100) for i in xrange(50)])
+    client = FakeClient()
+    keeper = Keeper(store, client, rate = 20, parallel = 4, spread = 10)
+    now = int(time.time())
+    self.assertEqual(keeper.load(now), 50)
+    pool = ThreadPool(4)
+    for t in xrange(1, 12):
+      self.assertTrue(keeper.step(pool, now + t) <= 20)
+    pool.close()
+    #all put once, after the spread, and rescheduled before the ttl runs out
+    self.assertEqual(sorted(client.puts), sorted(["k%i" % i for i in xrange(50)]))
+    self.assertEqual(keeper.wheel.count, 50)
+    for rid, key, value, ttl, next_put in store.records():
+      self.assertTrue(now < next_put < now + 12 + 100)
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,196 @@
+#!/usr/bin/python
+""" Analyzes where DHT keys land on the ring.  Keys are mapped to addresses the
+way Dht.MapToRing does (SHA1 of the key as the first replica, then DEGREE
+replicas spaced evenly around the ring) and each replica is assigned to the two
+nodes of a crawl snapshot on either side of it, which is where TableServer
+keeps the data.  Reports the per node key and byte load, imbalance statistics
+and, for simulated random node loss, the keys that lose every copy and the load
+once the survivors take over.  Keys are streamed so memory only grows with the
+size of the ring. """
+import pybru, crawl, sys, getopt, random, hashlib, math, unittest
+from bisect import bisect_left
+from array import array
+
+usage = """usage:
+python dhtplace.py [--degree=<n>] [--values] [--fail=<f1,f2,...>] [--top=<count>]
+  <crawl snapshot> <key file, - for stdin>
+python dhtplace.py test
+degree = replicas per key, default 8 (BasicNode uses 2^3)
+values = each line is key<tab>value rather than only a key, the value size is
+  counted in the byte load
+fail = fractions of nodes to remove in the node loss simulations, default 0.1
+top = number of the most loaded nodes to print, default 10"""
+
+RING = 2 ** 160
+
+def main():
+  try:
+    optlist, args = getopt.getopt(sys.argv[1:], "", ["degree=", "values", \
+      "fail=", "top="])
+    o_d = {}
+    for k,v in optlist:
+      o_d[k] = v
+    degree = int(o_d.get("--degree", 8))
+    fail = [float(f) for f in o_d.get("--fail", "0.1").split(",")]
+    top = int(o_d.get("--top", 10))
+    if args == ["test"]:
+      suite = unittest.TestLoader().loadTestsFromTestCase(TestDhtPlace)
+      unittest.TextTestRunner(verbosity=2).run(suite)
+      return
+    snapshot, keyfile = args
+  except:
+    print usage
+    return
+
+  addrs = sorted([long(pybru.Address(addr)) for addr in crawl.load_snapshot(snapshot)])
+  if keyfile == "-":
+    f = sys.stdin
+  else:
+    f = open(keyfile)
+  placement = Placement(addrs, degree, fail)
+  placement.add_all(read_keys(f, "--values" in o_d))
+  placement.print_report(top)
+
+def read_keys(f, values = False):
+  """Yields (key, value size) from a key per line or key<tab>value file"""
+  for line in f:
+    line = line.rstrip("\r\n")
+    if values:
+      key, sep, value = line.partition("\t")
+      yield key, len(value)
+    else:
+      yield line, 0
+
+def map_to_ring(key, degree):
+  """Same as Dht.MapToRing, the class 0 address of each replica"""
+  first = pybru.bytes_to_int(hashlib.sha1(key).digest()) & ~1
+  inc = RING / degree
+  return [((first + k * inc) % RING) & ~1 for k in xrange(degree)]
+
+class Placement:
+  def __init__(self, addrs, degree = 8, fail = []):
+    self.addrs = addrs
+    self.degree = degree
+    n = len(addrs)
+    self.keys = 0
+    self.key_load = array('l', [0] * n)
+    self.byte_load = array('d', [0.0] * n)
+    #each scenario keeps the sorted surviving addresses, their index in addrs,
+    #a flag per node and the load after the survivors take over
+    self.scenarios = []
+    for fraction in fail:
+      dead = set(random.sample(xrange(n), int(fraction * n)))
+      alive = [i for i in xrange(n) if i not in dead]
+      self.scenarios.append({'fraction' : fraction,
+        'alive_addrs' : [addrs[i] for i in alive],
+        'alive_idx' : array('l', alive),
+        'dead' : array('b', [1 if i in dead else 0 for i in xrange(n)]),
+        'lost' : 0,
+        'key_load' : array('l', [0] * n)})
+
+  def holders(self, addrs, target):
+    """Indexes of the nodes on either side of target"""
+    i = bisect_left(addrs, target)
+    n = len(addrs)
+    right = i % n
+    if i < n and addrs[i] == target:
+      #a node exactly at the target and its left neighbor
+      return (right, (i - 1) % n)
+    return ((i - 1) % n, right)
+
+  def add_all(self, keys):
+    addrs = self.addrs
+    for key, size in keys:
+      self.keys += 1
+      nbytes = len(key) + size
+      targets = map_to_ring(key, self.degree)
+      placed = set()
+      for target in targets:
+        placed.update(self.holders(addrs, target))
+      for i in placed:
+        self.key_load[i] += 1
+        self.byte_load[i] += nbytes
+      for sc in self.scenarios:
+        dead = sc['dead']
+        if all([dead[i] for i in placed]):
+          sc['lost'] += 1
+        alive_addrs = sc['alive_addrs']
+        alive_idx = sc['alive_idx']
+        replaced = set()
+        for target in targets:
+          for j in self.holders(alive_addrs, target):
+            replaced.add(alive_idx[j])
+        for i in replaced:
+          sc['key_load'][i] += 1
+
+  def print_report(self, top = 10):
+    n = len(self.addrs)
+    print "Nodes: %i, Keys: %i, Replicas: %i" % (n, self.keys, self.degree)
+    print_load("Keys per node", self.key_load)
+    print_load("Bytes per node", self.byte_load)
+    ranked = sorted(xrange(n), key = lambda i: self.key_load[i], reverse = True)
+    for i in ranked[:top]:
+      print "  %s keys=%i bytes=%i" % (pybru.Address(self.addrs[i]), \
+        self.key_load[i], self.byte_load[i])
+    for sc in self.scenarios:
+      survivors = [sc['key_load'][i] for i in sc['alive_idx']]
+      print "Losing %g of the nodes (%i): %i keys lose every copy" % \
+        (sc['fraction'], n - len(survivors), sc['lost'])
+      print_load("  Keys per surviving node", survivors)
+
+def print_load(name, load):
+  load = sorted(load)
+  n = len(load)
+  if n == 0:
+    return
+  total = float(sum(load))
+  mean = total / n
+  std = math.sqrt(sum([(x - mean) ** 2 for x in load]) / n)
+  #gini coefficient from the sorted loads
+  gini = 0.0
+  if total > 0:
+    gini = sum([(2 * (i + 1) - n - 1) * load[i] for i in xrange(n)]) / (n * total)
+  print "%s: mean=%.1f min=%g p50=%g p99=%g max=%g max/mean=%.2f cv=%.3f gini=%.3f" % \
+    (name, mean, load[0], load[n / 2], load[int(0.99 * (n - 1))], load[-1], \
+    load[-1] / mean if mean > 0 else 0, std / mean if mean > 0 else 0, gini)
+
+#############################
+# Here are the unit tests
+#############################
+
+class TestDhtPlace(unittest.TestCase):
+  def testMapToRing(self):
+    #sha1("abc") = a9993e36...9cd0d89d, the class bit (lowest) is cleared and
+    #the other replicas are 2^160 / 8 apart, wrapping around the ring
+    first = 0xa9993e364706816aba3e25717850c26c9cd0d89cL
+    self.assertEqual(map_to_ring("abc", 1), [first])
+    expected = [first, 0xc9993e364706816aba3e25717850c26c9cd0d89cL,
+      0xe9993e364706816aba3e25717850c26c9cd0d89cL,
+      0x09993e364706816aba3e25717850c26c9cd0d89cL,
+      0x29993e364706816aba3e25717850c26c9cd0d89cL,
+      0x49993e364706816aba3e25717850c26c9cd0d89cL,
+      0x69993e364706816aba3e25717850c26c9cd0d89cL,
+      0x89993e364706816aba3e25717850c26c9cd0d89cL]
+    self.assertEqual(map_to_ring("abc", 8), expected)
+    #sha1("") = da39a3ee...afd80709
+    self.assertEqual(map_to_ring("", 2), [0xda39a3ee5e6b4b0d3255bfef95601890afd80708L,
+      0x5a39a3ee5e6b4b0d3255bfef95601890afd80708L])
+    for target in map_to_ring("key", 16):
+      self.assertEqual(target % 2, 0)
+
+  def testHolders(self):
+    addrs = [k * 2 ** 156 for k in xrange(16)]
+    placement = Placement(addrs, 4)
+    self.assertEqual(placement.holders(addrs, 2 ** 156 + 2), (1, 2))
+    self.assertEqual(placement.holders(addrs, 2 ** 156), (1, 0))
+    self.assertEqual(placement.holders(addrs, 2 ** 160 - 2), (15, 0))
+    placement.add_all([("abc", 10), ("", 0)])
+    #each replica lands on two nodes
+    self.assertEqual(sum(placement.key_load), 16)
+    self.assertEqual(sum(placement.byte_load), 8 * 13)
+    #"abc" at 10.6, 14.6, 2.6 and 6.6 node spacings, "" at 13.6, 1.6, 5.6, 9.6
+    self.assertEqual(list(placement.key_load), \
+      [0, 1, 2, 1, 0, 1, 2, 1, 0, 1, 2, 1, 0, 1, 2, 1])
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,483 @@
+#!/usr/bin/python
+""" Records the DHT calls the python tools make and replays them against a
+node, so performance changes can be measured under the traffic we really see
+rather than DhtProxyTest.py's uniform keys.
+
+Recording hangs off rpcstats.py: with BRUNET_DHT_TRACE=<file> set (or
+enable(file) called) every DhtClient.Put / Create / Get / BeginGet and
+RpcDhtProxy.Register / Unregister going through an rpcstats.Server, MultiNode
+clients included, is recorded.  Each process writes its own segment of the
+trace, <file>.<pid>, so the children a tool forks or runs with the variable
+inherited never truncate each other's calls.  A trace keeps no keys or values,
+only for each call:
+  when it started and how long it took, the first 8 bytes of the sha1 of the
+  key, the value size (for gets the bytes returned), the ttl, the number of
+  results, the operation and its outcome (ok, fault, error, timeout)
+in 32 byte records after a header with the time recording started.  print
+and replay read every segment of a trace together, the offsets moved onto the
+earliest start.
+
+The replayer issues the calls of a trace from a single asyncbru.py event
+loop at the times they were made, divided by the speed, so the inter-arrival
+times and with them the concurrency of the trace are kept.  With speed 0
+every call is issued at once and the connections bound the concurrency.
+Keys and values are made up from the key hashes and sizes, the same key hash
+always gives the same key.  BeginGet is replayed with an EndGet after it.
+Latency is reported per segment of the trace next to the recorded latency. """
+import xmlrpclib, rpcstats, asyncbru, multinode, struct, hashlib, threading, \
+  atexit, subprocess, sys, os, getopt, time, unittest
+
+usage = """usage:
+python dhttrace.py record <trace file> <command> [<args>]
+python dhttrace.py print <trace file>
+python dhttrace.py replay [--port=<xmlrpc port>] [--multinode]
+  [--speed=<factor>] [--segment=<seconds>] [--connections=<count>]
+  [--timeout=<seconds>] <trace file>
+python dhttrace.py test
+record = run the command with its DHT calls recorded to the trace, a
+  segment <trace file>.<pid> for each process, replacing an earlier recording
+print = summarize a trace
+replay = issue the calls of a trace and report their latency
+port = the xmlrpc port for the local brunet node
+multinode = spread the calls over the local nodes of a MultiNode by key
+speed = 1 replays in real time, N N times faster, 0 as fast as possible,
+  default 1
+segment = seconds of trace time per report line, default 60
+connections = maximum number of connections to each node, default 256
+timeout = deadline of each call in seconds, default 60"""
+
+MAGIC = "DHTTRC1\0"
+HEADER = struct.Struct("<8sd")
+# start offset, seconds, key hash, size, ttl, results, operation, outcome
+RECORD = struct.Struct("<dfQIiHBB")
+OPS = ["DhtClient.Put", "DhtClient.Create", "DhtClient.Get",
+       "DhtClient.BeginGet", "RpcDhtProxy.Register", "RpcDhtProxy.Unregister"]
+OP_CODES = dict([(op, i) for (i, op) in enumerate(OPS)])
+OUTCOMES = ["ok", "fault", "error", "timeout"]
+OUTCOME_CODES = dict([(o, i) for (i, o) in enumerate(OUTCOMES)])
+
+def main():
+  try:
+    action = sys.argv[1]
+    if action == "record":
+      filename = sys.argv[2]
+      command = sys.argv[3:]
+      if len(command) == 0:
+        raise ValueError("no command")
+    elif action in ("print", "replay"):
+      optlist, args = getopt.getopt(sys.argv[2:], "", ["port=", "multinode", \
+        "speed=", "segment=", "connections=", "timeout="])
+      o_d = {}
+      for k,v in optlist:
+        o_d[k] = v
+      filename = args[0]
+      port = int(o_d.get("--port", 10000))
+      speed = float(o_d.get("--speed", 1))
+      segment = float(o_d.get("--segment", 60))
+      connections = int(o_d.get("--connections", 256))
+      timeout = float(o_d.get("--timeout", 60))
+    elif action != "test":
+      raise ValueError(action)
+  except:
+    print usage
+    sys.exit(1)
+
+  if action == "test":
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestDhtTrace)
+    unittest.TextTestRunner(verbosity=1).run(suite)
+  elif action == "record":
+    for segment in segments(filename):
+      os.remove(segment)
+    env = dict(os.environ)
+    env["BRUNET_DHT_TRACE"] = filename
+    sys.exit(subprocess.call(command, env = env))
+  elif action == "print":
+    print_trace(read_trace(filename)[1])
+  else:
+    start, records = read_trace(filename)
+    loop = asyncbru.Loop()
+    if "--multinode" in o_d:
+      clients = [asyncbru.Client(port, path = "/%s.rem" % node, loop = loop, \
+        connections = connections) for node in multinode.list_nodes(port)]
+    else:
+      clients = [asyncbru.Client(port, loop = loop, connections = connections)]
+    results = Replayer(clients, speed, timeout).run(records)
+    print_report(records, results, segment)
+
+def enable(filename):
+  """Records the DHT calls of rpcstats proxies to filename, turning rpcstats
+  on if it is off"""
+  stats = rpcstats.stats() or rpcstats.enable()
+  recorder = Recorder(filename)
+  stats.observers.append(recorder.observe)
+  atexit.register(recorder.close)
+  return recorder
+
+def _data(value):
+  if isinstance(value, xmlrpclib.Binary):
+    return value.data
+  if isinstance(value, memoryview):
+    return value.tobytes()
+  return str(value)
+
+def key_hash(key):
+  return struct.unpack("<Q", hashlib.sha1(key).digest()[:8])[0]
+
+def segment_name(filename, pid):
+  return "%s.%i" % (filename, pid)
+
+def segments(filename):
+  """The segment files of the trace filename, one per recording process"""
+  directory = os.path.dirname(filename)
+  prefix = os.path.basename(filename) + "."
+  return sorted([os.path.join(directory, name) for name in \
+    os.listdir(directory or ".") if name.startswith(prefix) and \
+    name[len(prefix):].isdigit()])
+
+class Recorder:
+  """Writes the calls passed to observe as trace records to the segment of
+  filename for the process, the records are buffered and written in blocks.
+  A forked child starts a segment of its own on its first call."""
+  def __init__(self, filename, buffered = 256):
+    self.filename = filename
+    self.start = time.time()
+    self.buffered = buffered
+    self.lock = threading.Lock()
+    self.open()
+
+  def open(self):
+    self.pid = os.getpid()
+    self.file = open(segment_name(self.filename, self.pid), "wb")
+    self.file.write(HEADER.pack(MAGIC, self.start))
+    self.pending = []
+
+  def observe(self, call, method, args, start, seconds, outcome, result = None):
+    if method not in OP_CODES or len(args) == 0:
+      return
+    size = ttl = results = 0
+    if method in ("DhtClient.Get", "DhtClient.BeginGet"):
+      if isinstance(result, list):
+        results = len(result)
+        size = sum([len(_data(r.get('value', ""))) for r in result])
+    else:
+      if len(args) > 1:
+        size = len(_data(args[1]))
+      if len(args) > 2:
+        ttl = int(args[2])
+      results = 1 if outcome == "ok" else 0
+    record = RECORD.pack(start - self.start, seconds, key_hash(_data(args[0])), \
+      size, ttl, min(results, 0xFFFF), OP_CODES[method], OUTCOME_CODES[outcome])
+    with self.lock:
+      if self.file == None:
+        return
+      if os.getpid() != self.pid:
+        #the parent writes the records pending at the fork
+        self.file.close()
+        self.open()
+      self.pending.append(record)
+      if len(self.pending) >= self.buffered:
+        self.flush()
+
+  def flush(self):
+    self.file.write("".join(self.pending))
+    self.file.flush()
+    self.pending = []
+
+  def close(self):
+    with self.lock:
+      if self.file != None:
+        if os.getpid() == self.pid:
+          self.flush()
+        self.file.close()
+        self.file = None
+
+def read_segment(filename):
+  """(start time, records) of one segment"""
+  f = open(filename, "rb")
+  data = f.read()
+  f.close()
+  if len(data) < HEADER.size:
+    raise ValueError("%s is not a dht trace" % filename)
+  (magic, start) = HEADER.unpack_from(data, 0)
+  if magic != MAGIC:
+    raise ValueError("%s is not a dht trace" % filename)
+  records = []
+  for pos in xrange(HEADER.size, len(data) - RECORD.size + 1, RECORD.size):
+    records.append(RECORD.unpack_from(data, pos))
+  return start, records
+
+def read_trace(filename):
+  """(start time, records sorted by offset), each a tuple of the RECORD
+  fields, from every segment of the trace filename or from filename itself
+  if it is a segment.  The offsets are from the earliest start."""
+  files = segments(filename)
+  if os.path.isfile(filename):
+    files.append(filename)
+  if len(files) == 0:
+    raise ValueError("No dht trace %s" % filename)
+  read = [read_segment(f) for f in files]
+  start = min([s for (s, records) in read])
+  records = []
+  for (s, rs) in read:
+    shift = s - start
+    for r in rs:
+      records.append((r[0] + shift,) + r[1:])
+  records.sort()
+  return start, records
+
+def peak_concurrency(records):
+  events = []
+  for r in records:
+    events.append((r[0], 1))
+    events.append((r[0] + r[1], -1))
+  events.sort()
+  peak = current = 0
+  for (t, d) in events:
+    current += d
+    peak = max(peak, current)
+  return peak
+
+def percentile(values, q):
+  values = sorted(values)
+  return values[int(q * (len(values) - 1))]
+
+def print_trace(records):
+  if len(records) == 0:
+    print "Empty trace"
+    return
+  span = max([r[0] + r[1] for r in records]) - records[0][0]
+  print "%i calls over %.1f seconds, %i keys, peak concurrency %i" % \
+    (len(records), span, len(set([r[2] for r in records])), \
+    peak_concurrency(records))
+  print "%-24s %8s %9s %9s %9s %8s %6s" % ("operation", "count", "p50 ms", \
+    "p99 ms", "mean size", "mean ttl", "fail")
+  for op in xrange(len(OPS)):
+    rs = [r for r in records if r[6] == op]
+    if len(rs) == 0:
+      continue
+    times = [1000 * r[1] for r in rs]
+    print "%-24s %8i %9.1f %9.1f %9.0f %8.0f %6i" % (OPS[op], len(rs), \
+      percentile(times, 0.5), percentile(times, 0.99), \
+      sum([r[3] for r in rs]) / float(len(rs)), \
+      sum([r[4] for r in rs]) / float(len(rs)), len([r for r in rs if r[7] != 0]))
+
+def replay_key(h):
+  return "dhttrace:%016x" % h
+
+def replay_value(i, size):
+  return ("%i:" % i).ljust(size, "x")[:size]
+
+class Replayer:
+  """Issues trace records from the clients' loop, each with the client its
+  key hash picks"""
+  def __init__(self, clients, speed = 1.0, timeout = 60):
+    self.clients = clients
+    self.loop = clients[0].loop
+    self.speed = speed
+    self.timeout = timeout
+
+  def issue(self, i, record):
+    (offset, seconds, h, size, ttl, results, op, outcome) = record
+    client = self.clients[h % len(self.clients)]
+    key = replay_key(h)
+    method = OPS[op]
+    if method == "DhtClient.Put":
+      return client.put(key, replay_value(i, size), ttl, timeout = self.timeout)
+    elif method == "DhtClient.Create":
+      return client.create(key, replay_value(i, size), ttl, timeout = self.timeout)
+    elif method == "DhtClient.Get":
+      return client.get(key, timeout = self.timeout)
+    elif method == "DhtClient.BeginGet":
+      call = client.begin_get(key, timeout = self.timeout)
+      def _end(call):
+        if call.error == None:
+          client.end_get(call.result(), timeout = self.timeout)
+      call.add_callback(_end)
+      return call
+    elif method == "RpcDhtProxy.Register":
+      return client.localproxy(method, xmlrpclib.Binary(key), \
+        xmlrpclib.Binary(replay_value(i, size)), ttl, timeout = self.timeout)
+    return client.localproxy(method, xmlrpclib.Binary(key), \
+      xmlrpclib.Binary(replay_value(i, size)), timeout = self.timeout)
+
+  def run(self, records):
+    """Replays records, returns for each (seconds late it was issued, the
+    finished asyncbru.Call)"""
+    if len(records) == 0:
+      return []
+    calls = [None] * len(records)
+    late = [0.0] * len(records)
+    base = records[0][0]
+    start = time.time()
+    next = [0]
+    #one timer at a time issues the records that are due and waits for the
+    #next, so a long trace costs no more than the calls in flight
+    def _feed():
+      now = time.time()
+      i = next[0]
+      while i < len(records):
+        due = start
+        if self.speed > 0:
+          due += (records[i][0] - base) / self.speed
+        if due > now:
+          self.loop.call_at(due, _feed)
+          break
+        late[i] = now - due
+        calls[i] = self.issue(i, records[i])
+        i += 1
+      next[0] = i
+    _feed()
+    self.loop.run(lambda: next[0] == len(records) and \
+      all([c.outstanding() == 0 for c in self.clients]))
+    return zip(late, calls)
+
+def print_report(records, results, segment = 60):
+  if len(records) == 0:
+    print "Empty trace"
+    return
+  base = records[0][0]
+  segments = {}
+  for record, (late, call) in zip(records, results):
+    segments.setdefault(int((record[0] - base) / segment), []).append( \
+      (record, late, call))
+  print "%9s %7s %8s %9s %9s %9s %9s %6s %8s" % ("segment", "calls", "calls/s", \
+    "p50 ms", "p90 ms", "p99 ms", "trace p50", "fail", "late ms")
+  for s in sorted(segments):
+    items = segments[s]
+    times = [1000 * call.seconds() for (record, late, call) in items]
+    recorded = [1000 * record[1] for (record, late, call) in items]
+    failed = len([call for (record, late, call) in items if call.error != None])
+    print "%8gs %7i %8.1f %9.1f %9.1f %9.1f %9.1f %6i %8.1f" % (s * segment, \
+      len(items), len(items) / float(segment), percentile(times, 0.5), \
+      percentile(times, 0.9), percentile(times, 0.99), percentile(recorded, 0.5), \
+      failed, 1000 * max([late for (record, late, call) in items]))
+  changed = [(OUTCOMES[record[7]], call) for (record, (late, call)) in \
+    zip(records, results) if (call.error == None) != (record[7] == 0)]
+  if len(changed) > 0:
+    print "%i calls had a different outcome than in the trace" % len(changed)
+
+#############################
+# Here are the unit tests
+#############################
+
+class TestDhtTrace(unittest.TestCase):
+  def setUp(self):
+    import ringemu, tempfile
+    self.ring = ringemu.VirtualRing(100)
+    self.server = ringemu.make_server(self.ring, 0)
+    t = threading.Thread(target = self.server.serve_forever)
+    t.daemon = True
+    t.start()
+    self.port = self.server.server_address[1]
+    self.dir = tempfile.mkdtemp()
+    self.filename = os.path.join(self.dir, "calls.trace")
+
+  def tearDown(self):
+    import shutil
+    self.server.shutdown()
+    self.server.server_close()
+    shutil.rmtree(self.dir)
+
+  def testRecord(self):
+    stats = rpcstats.RpcStats(10)
+    recorder = Recorder(self.filename, 4)
+    stats.observers.append(recorder.observe)
+    rpc = rpcstats.InstrumentedServer("http://127.0.0.1:%i/xm.rem" % self.port, stats)
+    for i in xrange(10):
+      rpc.localproxy("DhtClient.Put", xmlrpclib.Binary("key%i" % (i % 3)), \
+        xmlrpclib.Binary("v" * i), 100 + i)
+    rpc.localproxy("DhtClient.Get", xmlrpclib.Binary("key0"))
+    import pybru
+    rpc.proxy(str(pybru.Address(self.ring.addrs[0])), 3, 1, "Information.Info")
+    try:
+      rpc.localproxy("DhtClient.Create", xmlrpclib.Binary("key1"), \
+        xmlrpclib.Binary("v"), 60)
+    except xmlrpclib.Fault:
+      pass
+    recorder.close()
+    start, records = read_trace(self.filename)
+    self.assertEqual(start, recorder.start)
+    self.assertEqual(len(records), 12)
+    puts = [r for r in records if OPS[r[6]] == "DhtClient.Put"]
+    self.assertEqual([r[3] for r in puts], range(10))
+    self.assertEqual([r[4] for r in puts], range(100, 110))
+    self.assertEqual(len(set([r[2] for r in puts])), 3)
+    get = [r for r in records if OPS[r[6]] == "DhtClient.Get"][0]
+    self.assertEqual(get[2], puts[0][2])
+    #values 0, 3, 6 and 9 bytes were put under key0
+    self.assertEqual((get[3], get[5]), (18, 4))
+    self.assertEqual(OUTCOMES[records[-1][7]], "fault")
+    #a segment can be read on its own
+    segment = segment_name(self.filename, os.getpid())
+    self.assertEqual(segments(self.filename), [segment])
+    self.assertEqual(read_trace(segment), (start, records))
+
+  def testSegments(self):
+    url = "http://127.0.0.1:%i/xm.rem" % self.port
+    stats = rpcstats.RpcStats(10)
+    recorder = Recorder(self.filename, 1)
+    stats.observers.append(recorder.observe)
+    rpc = rpcstats.InstrumentedServer(url, stats)
+    rpc.localproxy("DhtClient.Put", xmlrpclib.Binary("a"), \
+      xmlrpclib.Binary("x"), 60)
+    #a forked child records to its own segment
+    pid = os.fork()
+    if pid == 0:
+      try:
+        rpc.localproxy("DhtClient.Put", xmlrpclib.Binary("b"), \
+          xmlrpclib.Binary("xx"), 60)
+        recorder.close()
+      finally:
+        os._exit(0)
+    os.waitpid(pid, 0)
+    time.sleep(0.05)
+    #and so does a command run with the variable set, like record does
+    env = dict(os.environ)
+    env["BRUNET_DHT_TRACE"] = self.filename
+    script = "import rpcstats, xmlrpclib\n" + \
+      "rpc = rpcstats.Server('%s')\n" % url + \
+      "rpc.localproxy('DhtClient.Put', xmlrpclib.Binary('c'), " + \
+      "xmlrpclib.Binary('xxx'), 60)\n"
+    self.assertEqual(subprocess.call([sys.executable, "-c", script], env = env, \
+      cwd = os.path.dirname(os.path.abspath(__file__))), 0)
+    rpc.localproxy("DhtClient.Get", xmlrpclib.Binary("a"))
+    recorder.close()
+    self.assertEqual(len(segments(self.filename)), 3)
+    start, records = read_trace(self.filename)
+    self.assertEqual(start, recorder.start)
+    self.assertEqual([(OPS[r[6]], r[3]) for r in records], \
+      [("DhtClient.Put", 1), ("DhtClient.Put", 2), ("DhtClient.Put", 3), \
+      ("DhtClient.Get", 1)])
+    self.assertEqual([r[2] for r in records[:3]], \
+      [key_hash("a"), key_hash("b"), key_hash("c")])
+    #the command's segment started later, its offset is moved onto ours
+    self.assertTrue(records[2][0] > records[1][0] + 0.05)
+
+  def testReplay(self):
+    #two keys put and then read by 50 concurrent gets, 0.4 seconds apart
+    records = []
+    for i in xrange(2):
+      records.append((0.01 * i, 0.001, i, 10, 600, 1, OP_CODES["DhtClient.Put"], 0))
+    for i in xrange(100):
+      records.append((0.1 + 0.4 * (i % 2), 0.002, i % 2, 10, 0, 1, \
+        OP_CODES["DhtClient.Get"], 0))
+    records.append((0.6, 0.001, 5, 0, 0, 0, OP_CODES["DhtClient.BeginGet"], 0))
+    records.sort()
+    client = asyncbru.Client(self.port, connections = 64)
+    start = time.time()
+    results = Replayer([client], 2.0).run(records)
+    elapsed = time.time() - start
+    self.assertTrue(0.3 < elapsed < 2, elapsed)
+    self.assertEqual([c.error for (late, c) in results], [None] * len(records))
+    gets = [c.result() for (late, c) in results if isinstance(c.value, list)]
+    self.assertEqual(len(gets), 100)
+    self.assertEqual([len(g) for g in gets], [1] * 100)
+    self.assertEqual(len(self.ring.gets), 0)
+    #as fast as possible
+    start = time.time()
+    results = Replayer([client], 0).run(records)
+    self.assertTrue(time.time() - start < elapsed)
+    client.close()
+
+if __name__ == "__main__":
+  main()
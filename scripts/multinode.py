@@ -0,0 +1,268 @@
+#!/usr/bin/python
+""" A client for a host running several virtual nodes behind one xmlrpc port
+(MultiNode).  The local nodes are discovered with listNodes on xmserver.rem and
+each is reached on its own <address>.rem endpoint.  Calls are spread over the
+nodes by a policy:
+  round_robin = each call goes to the next node
+  least_outstanding = the node with the fewest calls in flight
+  affinity = DHT calls go to the node nearest the key's first replica and
+    calls for an address to the node nearest it, other calls round robin
+and batches of calls run in parallel, so the request handling load does not
+all land on one node. """
+import xmlrpclib, rpcstats, pybru, dhtplace, sys, getopt, threading, \
+  itertools, unittest
+from multiprocessing.pool import ThreadPool
+
+usage = """usage:
+python multinode.py [--port=<xmlrpc port>] [--policy=<policy>]
+  [--parallel=<in flight calls>] [--ttl=<seconds>] <action> <args>
+action is one of
+  put <key> <value> [<key> <value> ...]
+  get <key> [<key> ...]
+  info <address> [<address> ...]
+  nodes = print the local nodes
+  test = run the unit tests
+port = the xmlrpc port of the MultiNode
+policy = round_robin, least_outstanding or affinity, default affinity
+parallel = maximum number of outstanding calls, default 16
+ttl = ttl for put in seconds, default 1 day"""
+
+RING = 2 ** 160
+
+def main():
+  try:
+    optlist, args = getopt.getopt(sys.argv[1:], "", ["port=", "policy=", \
+      "parallel=", "ttl="])
+    o_d = {}
+    for k,v in optlist:
+      o_d[k] = v
+    port = int(o_d.get("--port", 10000))
+    policy = POLICIES[o_d.get("--policy", "affinity")]
+    parallel = int(o_d.get("--parallel", 16))
+    ttl = int(o_d.get("--ttl", 86400))
+    action = args[0]
+    if action == "test":
+      suite = unittest.TestLoader().loadTestsFromTestCase(TestMultiNode)
+      unittest.TextTestRunner(verbosity=2).run(suite)
+      return
+    if action == "put":
+      pairs = zip(args[1::2], args[2::2])
+    elif action not in ("get", "info", "nodes"):
+      raise ValueError(action)
+  except:
+    print usage
+    return
+
+  client = MultiNodeClient(port, policy(), parallel)
+  if action == "nodes":
+    for addr in client.nodes:
+      print addr
+  elif action == "put":
+    for (key, value), res in zip(pairs, client.put_many(pairs, ttl)):
+      print key, res
+  elif action == "get":
+    for key, values in zip(args[1:], client.get_many(args[1:])):
+      for value in values:
+        print key, value['value'].data
+  else:
+    for addr, info in zip(args[1:], client.info_many(args[1:])):
+      print addr, info
+
+def list_nodes(port = 10000):
+  rpc = xmlrpclib.Server("http://127.0.0.1:%i/xmserver.rem" % port)
+  return rpc.listNodes()
+
+class RoundRobin:
+  def __init__(self):
+    self.counter = itertools.count()
+
+  def choose(self, client, target):
+    return self.counter.next() % len(client.nodes)
+
+class LeastOutstanding:
+  def choose(self, client, target):
+    outstanding = client.outstanding
+    return min(xrange(len(outstanding)), key = lambda i: outstanding[i])
+
+class Affinity:
+  """The node nearest target, round robin for calls without one"""
+  def __init__(self):
+    self.fallback = RoundRobin()
+
+  def choose(self, client, target):
+    if target == None:
+      return self.fallback.choose(client, target)
+    best = 0
+    best_dist = RING
+    for i in xrange(len(client.addrs)):
+      d = (client.addrs[i] - target) % RING
+      d = min(d, RING - d)
+      if d < best_dist:
+        best = i
+        best_dist = d
+    return best
+
+POLICIES = {'round_robin' : RoundRobin, 'least_outstanding' : LeastOutstanding,
+            'affinity' : Affinity}
+
+# the brunet methods whose first argument is a DHT key
+DHT_METHODS = set(["DhtClient.Put", "DhtClient.Create", "DhtClient.Get", \
+  "DhtClient.BeginGet", "RpcDhtProxy.Register", "RpcDhtProxy.Unregister"])
+# the methods whose first argument is a token from BeginGet at the same node
+TOKEN_METHODS = set(["DhtClient.ContinueGet", "DhtClient.EndGet"])
+
+class MultiNodeClient:
+  def __init__(self, port = 10000, policy = None, parallel = 16, nodes = None):
+    self.port = port
+    if nodes == None:
+      nodes = list_nodes(port)
+    if len(nodes) == 0:
+      raise ValueError("No local nodes on port %i" % port)
+    self.nodes = nodes
+    self.addrs = [long(pybru.Address(n)) for n in nodes]
+    self.policy = policy or Affinity()
+    self.parallel = parallel
+    self.outstanding = [0] * len(nodes)
+    self.lock = threading.Lock()
+    #BeginGet token -> index of the node that issued it
+    self.tokens = {}
+    #each thread keeps a proxy per node, xmlrpclib connections aren't thread safe
+    self.local = threading.local()
+
+  def rpc(self, i):
+    if not hasattr(self.local, "rpcs"):
+      self.local.rpcs = {}
+    if i not in self.local.rpcs:
+      self.local.rpcs[i] = rpcstats.Server("http://127.0.0.1:%i/%s.rem" % \
+        (self.port, self.nodes[i]))
+    return self.local.rpcs[i]
+
+  def target(self, method, args):
+    """The address a call is about, if any"""
+    if method in DHT_METHODS and len(args) > 0:
+      key = args[0]
+      if isinstance(key, xmlrpclib.Binary):
+        key = key.data
+      return dhtplace.map_to_ring(key, 1)[0]
+    return None
+
+  def call(self, call, method, args, target = None):
+    token = None
+    if call == "localproxy" and method in TOKEN_METHODS and len(args) > 0:
+      token = args[0]
+      if isinstance(token, xmlrpclib.Binary):
+        token = token.data
+    with self.lock:
+      if token in self.tokens:
+        i = self.tokens[token]
+      else:
+        i = self.policy.choose(self, target)
+      self.outstanding[i] += 1
+    try:
+      rpc = self.rpc(i)
+      if call == "proxy":
+        return rpc.proxy(args[0], 3, 1, method, *args[1:])
+      res = rpc.localproxy(method, *args)
+      if method == "DhtClient.BeginGet" and isinstance(res, xmlrpclib.Binary):
+        with self.lock:
+          self.tokens[res.data] = i
+      return res
+    finally:
+      with self.lock:
+        self.outstanding[i] -= 1
+        if method == "DhtClient.EndGet":
+          self.tokens.pop(token, None)
+
+  def localproxy(self, method, *args):
+    return self.call("localproxy", method, args, self.target(method, args))
+
+  def proxy(self, addr, method, *args):
+    """proxy with the usual options (3, 1) at the node nearest addr under
+    affinity, returns the list of results like XmlRpcManager.proxy"""
+    return self.call("proxy", method, (addr,) + args, long(pybru.Address(addr)))
+
+  def map(self, func, items):
+    """Runs func on every item with up to parallel calls in flight, the results
+    are in the order of items"""
+    pool = ThreadPool(self.parallel)
+    try:
+      return pool.map(func, items)
+    finally:
+      pool.close()
+
+  def put_many(self, pairs, ttl = 86400):
+    def _put(pair):
+      return self.localproxy("DhtClient.Put", xmlrpclib.Binary(pair[0]), \
+        xmlrpclib.Binary(pair[1]), ttl)
+    return self.map(_put, pairs)
+
+  def get_many(self, keys):
+    def _get(key):
+      return self.localproxy("DhtClient.Get", xmlrpclib.Binary(key))
+    return self.map(_get, keys)
+
+  def info_many(self, addrs):
+    def _info(addr):
+      res = self.proxy(addr, "Information.Info")
+      if len(res) == 0:
+        return None
+      return res[0]
+    return self.map(_info, addrs)
+
+class TestMultiNode(unittest.TestCase):
+  def setUp(self):
+    import ringemu
+    self.ring = ringemu.VirtualRing(64, 4)
+    self.server = ringemu.make_server(self.ring, 0)
+    self.port = self.server.server_address[1]
+    t = threading.Thread(target = self.server.serve_forever)
+    t.daemon = True
+    t.start()
+
+  def tearDown(self):
+    self.server.shutdown()
+    self.server.server_close()
+
+  def testNodes(self):
+    client = MultiNodeClient(self.port)
+    self.assertEqual(sorted(client.nodes), sorted(list_nodes(self.port)))
+    self.assertEqual(len(client.nodes), 4)
+
+  def testAffinity(self):
+    client = MultiNodeClient(self.port, Affinity())
+    for i in xrange(len(client.addrs)):
+      self.assertEqual(client.policy.choose(client, client.addrs[i]), i)
+      self.assertEqual(client.policy.choose(client, client.addrs[i] + 2), i)
+    #the ring wraps, the node just below 0 is nearest to 0
+    top = max(xrange(len(client.addrs)), key = lambda i: client.addrs[i])
+    low = min(xrange(len(client.addrs)), key = lambda i: client.addrs[i])
+    if RING - client.addrs[top] < client.addrs[low]:
+      self.assertEqual(client.policy.choose(client, 0), top)
+    #calls without a target round robin over every node
+    chosen = [client.policy.choose(client, None) for i in xrange(8)]
+    self.assertEqual(sorted(set(chosen)), range(4))
+
+  def testTokens(self):
+    client = MultiNodeClient(self.port, RoundRobin())
+    served = []
+    rpc = client.rpc
+    def _rpc(i):
+      served.append(i)
+      return rpc(i)
+    client.rpc = _rpc
+    client.put_many([("key", "value")], 60)
+    for n in xrange(3):
+      del served[:]
+      token = client.localproxy("DhtClient.BeginGet", xmlrpclib.Binary("key"))
+      self.assertEqual(client.tokens[token.data], served[0])
+      res = client.localproxy("DhtClient.ContinueGet", token)
+      self.assertEqual(res['value'].data, "value")
+      #round robin would have moved on, the token keeps its node
+      client.localproxy("DhtClient.ContinueGet", token)
+      client.localproxy("DhtClient.EndGet", token)
+      self.assertEqual(served, [served[0]] * 4)
+      self.assertEqual(client.tokens, {})
+    self.assertEqual(client.outstanding, [0] * 4)
+
+if __name__ == "__main__":
+  main()
@@ -1,5 +1,21 @@
 #!/usr/bin/python
-import SimpleXMLRPCServer, BaseHTTPServer, SimpleHTTPServer, os, sys, re, subprocess
+import SimpleXMLRPCServer, BaseHTTPServer, SimpleHTTPServer, SocketServer, os, \
+  sys, re, subprocess, threading, socket, select, errno, unittest
+
+# files are served to at most this many clients at a time, the rest get a 503
+MAX_CONNECTIONS = 64
+# idle keep alive connections are closed after this many seconds
+IDLE_TIMEOUT = 30
+
+# python 2 has no os.sendfile, use libc's through ctypes when it is there
+try:
+  import ctypes
+  _sendfile = ctypes.CDLL(None, use_errno = True).sendfile64
+  _sendfile.argtypes = [ctypes.c_int, ctypes.c_int, \
+    ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t]
+  _sendfile.restype = ctypes.c_ssize_t
+except Exception:
+  _sendfile = None
 
 def main():
   whoami = sys.argv[1]
@@ -9,17 +25,22 @@ def main():
     port = 44387
   elif whoami == "ufl_wow":
     port = 44389
+  elif whoami == "test":
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestFileServer)
+    unittest.TextTestRunner(verbosity=2).run(suite)
+    return
   else:
     sys.exit()
+  # both servers run in one process so get_stats can report what was served
   pid = os.fork()
   if pid == 0:
-    XMLRPCServer(port)
-  else:
-    pid = os.fork()
-    if pid == 0:
-      HTTPServer(port + 1)
+    counters = Counters()
+    http = threading.Thread(target = HTTPServer, args = (port + 1, counters))
+    http.setDaemon(True)
+    http.start()
+    XMLRPCServer(port, counters)
 
-def XMLRPCServer(port):
+def XMLRPCServer(port, counters = None):
   space_re = re.compile('\s+')
   data_re = re.compile('\S+')
   # Create server
@@ -54,6 +75,8 @@ def XMLRPCServer(port):
           rv['error'] = True
           rv['count'] = count
           break
+      if counters != None:
+        rv['http'] = counters.snapshot()
       return rv
 
   server.register_instance(simplenode())
@@ -61,13 +84,289 @@ def XMLRPCServer(port):
   # Run the server's main loop
   server.serve_forever()
 
-def HTTPServer(port):
-  HandlerClass = SimpleHTTPServer.SimpleHTTPRequestHandler
-  ServerClass = BaseHTTPServer.HTTPServer
-  protocol="HTTP/1.0"
-  HandlerClass.protocol_version = protocol
-  server = ServerClass(('', port), HandlerClass)
+def HTTPServer(port, counters = None):
+  server = FileServer(('', port), FileHandler, counters or Counters())
   server.serve_forever()
 
+class Counters:
+  """What the file server has done, shared by its threads"""
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.values = {'requests' : 0, 'bytes' : 0, 'partial' : 0, \
+      'not_modified' : 0, 'rejected' : 0, 'active' : 0}
+
+  def add(self, name, count = 1):
+    self.lock.acquire()
+    self.values[name] += count
+    self.lock.release()
+
+  def snapshot(self):
+    self.lock.acquire()
+    rv = dict(self.values)
+    self.lock.release()
+    # xmlrpc integers are 32 bits
+    rv['bytes'] = float(rv['bytes'])
+    return rv
+
+class FileServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  """A thread per connection, up to max_connections"""
+  daemon_threads = True
+  allow_reuse_address = True
+  request_queue_size = 128
+
+  def __init__(self, address, handler, counters, max_connections = MAX_CONNECTIONS):
+    BaseHTTPServer.HTTPServer.__init__(self, address, handler)
+    self.counters = counters
+    self.slots = threading.Semaphore(max_connections)
+
+  def process_request(self, request, client_address):
+    if not self.slots.acquire(False):
+      self.counters.add('rejected')
+      try:
+        request.sendall("HTTP/1.1 503 Service Unavailable\r\nRetry-After: 5\r\n" + \
+          "Content-Length: 0\r\nConnection: close\r\n\r\n")
+      except socket.error:
+        pass
+      self.shutdown_request(request)
+      return
+    SocketServer.ThreadingMixIn.process_request(self, request, client_address)
+
+  def process_request_thread(self, request, client_address):
+    self.counters.add('active')
+    try:
+      SocketServer.ThreadingMixIn.process_request_thread(self, request, client_address)
+    finally:
+      self.counters.add('active', -1)
+      self.slots.release()
+
+class FileHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+  """Serves the current directory over keep alive connections, files are
+  sent with sendfile and support ETag / If-None-Match and single byte ranges
+  (with If-Range) so interrupted downloads resume"""
+  protocol_version = "HTTP/1.1"
+  timeout = IDLE_TIMEOUT
+
+  def do_GET(self):
+    self.serve(True)
+
+  def do_HEAD(self):
+    self.serve(False)
+
+  def serve(self, body):
+    path = self.translate_path(self.path)
+    if os.path.isdir(path):
+      f = SimpleHTTPServer.SimpleHTTPRequestHandler.send_head(self)
+      if f:
+        if body:
+          self.copyfile(f, self.wfile)
+        f.close()
+      return
+    try:
+      f = open(path, 'rb')
+    except IOError:
+      self.send_error(404, "File not found")
+      return
+    counters = self.server.counters
+    counters.add('requests')
+    try:
+      st = os.fstat(f.fileno())
+      size = st.st_size
+      etag = '"%x-%x"' % (int(st.st_mtime), size)
+      tags = [t.strip() for t in self.headers.get('If-None-Match', '').split(',')]
+      if etag in tags or '*' in tags:
+        counters.add('not_modified')
+        self.send_response(304)
+        self.send_header("ETag", etag)
+        self.end_headers()
+        return
+      start, end = 0, size - 1
+      byte_range = None
+      if 'Range' in self.headers and self.headers.get('If-Range', etag) == etag:
+        byte_range = parse_range(self.headers['Range'], size)
+      if byte_range == False:
+        self.send_response(416)
+        self.send_header("Content-Range", "bytes */%i" % size)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+        return
+      if byte_range:
+        start, end = byte_range
+        counters.add('partial')
+        self.send_response(206)
+        self.send_header("Content-Range", "bytes %i-%i/%i" % (start, end, size))
+      else:
+        self.send_response(200)
+      self.send_header("Content-Type", self.guess_type(path))
+      self.send_header("Content-Length", str(end - start + 1))
+      self.send_header("Last-Modified", self.date_time_string(st.st_mtime))
+      self.send_header("ETag", etag)
+      self.send_header("Accept-Ranges", "bytes")
+      self.end_headers()
+      if body and end >= start:
+        self.wfile.flush()
+        if send_file(self.connection, f, start, end - start + 1, counters) > 0:
+          # the file shrank, the client can not tell where this reply ends
+          self.close_connection = 1
+    finally:
+      f.close()
+
+# Parses a Range header, returns (first, last) byte, None to ignore it (not a
+# single byte range) or False if it can not be satisfied
+def parse_range(header, size):
+  m = re.match('bytes=(\d*)-(\d*)$', header.strip())
+  if m == None or m.group(1) == m.group(2) == '':
+    return None
+  if m.group(1) == '':
+    length = int(m.group(2))
+    if length == 0 or size == 0:
+      return False
+    return max(size - length, 0), size - 1
+  start = int(m.group(1))
+  end = size - 1
+  if m.group(2) != '':
+    if int(m.group(2)) < start:
+      return None
+    end = min(int(m.group(2)), end)
+  if start >= size:
+    return False
+  return start, end
+
+# Sends count bytes of f from offset over sock without copying them through
+# python when sendfile is available, returns the count of bytes not sent
+def send_file(sock, f, offset, count, counters):
+  if _sendfile == None:
+    f.seek(offset)
+    while count > 0:
+      data = f.read(min(count, 65536))
+      if not data:
+        break
+      sock.sendall(data)
+      counters.add('bytes', len(data))
+      count -= len(data)
+    return count
+  pos = ctypes.c_int64(offset)
+  while count > 0:
+    sent = _sendfile(sock.fileno(), f.fileno(), ctypes.byref(pos), min(count, 1 << 30))
+    if sent < 0:
+      err = ctypes.get_errno()
+      if err == errno.EINTR:
+        continue
+      if err != errno.EAGAIN:
+        raise socket.error(err, os.strerror(err))
+      # sockets with a timeout are non blocking underneath
+      if len(select.select([], [sock], [], sock.gettimeout())[1]) == 0:
+        raise socket.timeout("timed out")
+      continue
+    if sent == 0:
+      break
+    counters.add('bytes', sent)
+    count -= sent
+  return count
+
+#############################
+# Here are the unit tests
+#############################
+
+class QuietFileHandler(FileHandler):
+  def log_message(self, format, *args):
+    pass
+
+class TestFileServer(unittest.TestCase):
+  DATA = "".join([chr(i % 251) for i in xrange(100000)])
+
+  def setUp(self):
+    import tempfile
+    self.cwd = os.getcwd()
+    self.dir = tempfile.mkdtemp()
+    os.chdir(self.dir)
+    f = open("node.tgz", "wb")
+    f.write(self.DATA)
+    f.close()
+    self.counters = Counters()
+    self.server = FileServer(('127.0.0.1', 0), QuietFileHandler, self.counters)
+    t = threading.Thread(target = self.server.serve_forever)
+    t.daemon = True
+    t.start()
+
+  def tearDown(self):
+    import shutil
+    self.server.shutdown()
+    self.server.server_close()
+    os.chdir(self.cwd)
+    shutil.rmtree(self.dir)
+
+  def get(self, conn, headers = {}, method = "GET"):
+    conn.request(method, "/node.tgz", headers = headers)
+    res = conn.getresponse()
+    return res.status, dict(res.getheaders()), res.read()
+
+  def testParseRange(self):
+    self.assertEqual(parse_range("bytes=0-99", 1000), (0, 99))
+    self.assertEqual(parse_range(" bytes=10-2000 ", 1000), (10, 999))
+    #open ended
+    self.assertEqual(parse_range("bytes=500-", 1000), (500, 999))
+    #suffix, the last bytes
+    self.assertEqual(parse_range("bytes=-100", 1000), (900, 999))
+    self.assertEqual(parse_range("bytes=-5000", 1000), (0, 999))
+    #unsatisfiable
+    self.assertEqual(parse_range("bytes=1000-", 1000), False)
+    self.assertEqual(parse_range("bytes=-0", 1000), False)
+    self.assertEqual(parse_range("bytes=-10", 0), False)
+    #ignored, the whole file is sent
+    self.assertEqual(parse_range("bytes=-", 1000), None)
+    self.assertEqual(parse_range("bytes=5-1", 1000), None)
+    self.assertEqual(parse_range("bytes=0-1,5-6", 1000), None)
+    self.assertEqual(parse_range("items=0-1", 1000), None)
+
+  def testETag(self):
+    import httplib
+    conn = httplib.HTTPConnection("127.0.0.1", self.server.server_address[1])
+    status, headers, body = self.get(conn)
+    self.assertEqual((status, body), (200, self.DATA))
+    etag = headers['etag']
+    self.assertEqual(headers['accept-ranges'], "bytes")
+    #the same connection is kept alive
+    status, headers, body = self.get(conn, {'If-None-Match' : '"x", ' + etag})
+    self.assertEqual((status, body), (304, ""))
+    status, headers, body = self.get(conn, {'If-None-Match' : '"x"'})
+    self.assertEqual(status, 200)
+    status, headers, body = self.get(conn, {}, "HEAD")
+    self.assertEqual((status, headers['content-length'], body), \
+      (200, str(len(self.DATA)), ""))
+    self.assertEqual(self.counters.values['not_modified'], 1)
+    self.assertEqual(self.counters.values['requests'], 4)
+    conn.close()
+
+  def testRange(self):
+    import httplib
+    global _sendfile
+    real = _sendfile
+    ways = [real]
+    if real != None:
+      #and without sendfile
+      ways.append(None)
+    try:
+      for sendfile in ways:
+        _sendfile = sendfile
+        conn = httplib.HTTPConnection("127.0.0.1", self.server.server_address[1])
+        etag = self.get(conn, {}, "HEAD")[1]['etag']
+        status, headers, body = self.get(conn, {'Range' : "bytes=10-19"})
+        self.assertEqual((status, body), (206, self.DATA[10:20]))
+        self.assertEqual(headers['content-range'], "bytes 10-19/%i" % len(self.DATA))
+        status, headers, body = self.get(conn, {'Range' : "bytes=-5", \
+          'If-Range' : etag})
+        self.assertEqual((status, body), (206, self.DATA[-5:]))
+        #the file changed since, the whole of it is sent
+        status, headers, body = self.get(conn, {'Range' : "bytes=50000-", \
+          'If-Range' : '"0-0"'})
+        self.assertEqual((status, body), (200, self.DATA))
+        status, headers, body = self.get(conn, {'Range' : "bytes=100000-"})
+        self.assertEqual((status, body), (416, ""))
+        self.assertEqual(headers['content-range'], "bytes */%i" % len(self.DATA))
+        conn.close()
+    finally:
+      _sendfile = real
+    self.assertEqual(self.counters.values['partial'], 2 * len(ways))
+
 if __name__ == '__main__':
     main()
@@ -1,6 +1,6 @@
 #!/usr/bin/python
 # adds all nodes to one ore more slices
-import xmlrpclib
+import xmlrpclib, plab_inventory
  
 api_server = xmlrpclib.ServerProxy('https://www.planet-lab.org/PLCAPI/', allow_none=True)
  
@@ -23,11 +23,9 @@ authorized = api_server.AuthCheck(auth)
 if authorized:
   print 'We are authorized!'
  
-# This may take a while.
-all_nodes = api_server.GetNodes(auth, {}, ['hostname'])
- 
-# Create an array of string hostnames
-node_hostnames = [node['hostname'] for node in all_nodes]
+# The hostnames from the host inventory, which only asks the PLC API for the
+# changes since it was last refreshed
+node_hostnames = plab_inventory.Inventory().hosts(all = True)
  
 print "Enter Slice Name(s) - separated by commas: "
 slices = raw_input(">")
@@ -1,24 +1,54 @@
 #!/usr/bin/python
 usage = """usage:
 plab_assistant [--path_to_files=<filename>] [--username=<username>]
-  [--port=<number>] --path_to_nodes=<filename> [--ssh_key=<filename>] action
+  [--port=<number>] --path_to_nodes=<filename> [--ssh_key=<filename>]
+  [--probe] [--probe_cache=<filename>] [--dead=<skip|defer>]
+  [--inventory=<filename>] [--api=<url>] [--distribute=<fanout>]
+  [--checksum=<sha1>] [--delta] [--timeline=<filename>] action
 action = check, install, uninstall, gather_stats, get_logs (check attempts to add the
   boot strap software to nodes that do not have it yet... a common problem on
   planetlab)
 path_to_nodes = a file containing a new line delimited file containing hosts
-  to install basic node to... optional, use plab list if unspecified.
+  to install basic node to... optional, use the hosts of the inventory, best
+  first, if unspecified.
 username = the user name for the hosts
 path_to_files = the path to a downloadable file that contains the installation
   files A sample is available at http://www.acis.ufl.edu/~ipop/planetlab/ipop/
 port = port the stats app is running on
 ssh_key = path to the ssh key to be used
+probe = probe all the hosts first (see plab_probe.py) and run the action on
+  the responsive hosts, fastest first
+probe_cache = file the probe results are cached in, default plab_probe.json
+dead = skip unresponsive hosts or defer them until the rest are done, default
+  skip
+inventory = host inventory (see plab_inventory.py) that install, probe and
+  stats results are recorded in, plab_inventory.db when the hosts come from
+  the inventory, nothing is recorded otherwise
+api = url of the PLC API the inventory is refreshed from
+distribute = install and check only: hosts that finished installing serve the
+  tarball to fanout later hosts each with the HTTPServer of node/server.py (on
+  port + 1), the origin serves at most fanout hosts at a time, port is needed
+checksum = sha1 of the tarball (see plab_distribute.py), computed from
+  path_to_files if unspecified with distribute, a host whose copy does not
+  match downloads it again from the origin
+delta = install only: hosts that have a previous version built by
+  plab_deployer fetch only the delta to the current one (see plab_bundle.py)
+  from next to path_to_files and keep their other files
+timeline = file the time of every step on every host is appended to (see
+  plab_timeline.py), steps are not timed if unspecified
 """
 
-import os, sys, time, signal, subprocess, re, getopt, xmlrpclib
+import os, sys, time, signal, subprocess, re, getopt, xmlrpclib, plab_probe, \
+  plab_inventory, plab_distribute, plab_bundle, plab_timeline
+
+# an install running longer than this is killed when distributing
+INSTALL_TIMEOUT = 900
 
 def main():
   optlist, args = getopt.getopt(sys.argv[1:], "", ["path_to_files=", \
-    "username=", "port=", "path_to_nodes=", "ssh_key="])
+    "username=", "port=", "path_to_nodes=", "ssh_key=", "probe", \
+    "probe_cache=", "dead=", "inventory=", "api=", "distribute=", "checksum=", \
+    "delta", "timeline="])
 
   o_d = {}
   for k,v in optlist:
@@ -36,9 +66,18 @@ def main():
         nodes.append(line.rstrip('\n\r '))
       f.close()
 
+    probe = None
+    if "--probe" in o_d:
+      probe = o_d.get("--probe_cache", "plab_probe.json")
+    dead = o_d.get("--dead", "skip")
+    inventory = o_d.get("--inventory")
+    api = o_d.get("--api", plab_inventory.PLC_API)
+    timeline = o_d.get("--timeline")
+
     action = args[0]
     if action == "gather_stats":
-      plab = plab_assistant(action, nodes, port=(o_d["--port"]))
+      plab = plab_assistant(action, nodes, port=(o_d["--port"]), probe=probe, \
+        dead=dead, inventory=inventory, api=api, timeline=timeline)
     else:
       username = o_d["--username"]
       ssh_key = None
@@ -47,8 +86,15 @@ def main():
       path_to_files = None
       if "--path_to_files" in o_d:
         path_to_files = o_d["--path_to_files"]
-      plab = plab_assistant(action, nodes, username=username, \
-        path_to_files=path_to_files, ssh_key=ssh_key)
+      distribute = int(o_d.get("--distribute", 0))
+      port = str(0)
+      if distribute:
+        port = o_d["--port"]
+      plab = plab_assistant(action, nodes, username=username, port=port, \
+        path_to_files=path_to_files, ssh_key=ssh_key, probe=probe, dead=dead, \
+        inventory=inventory, api=api, distribute=distribute, \
+        checksum=o_d.get("--checksum"), delta="--delta" in o_d, \
+        timeline=timeline)
   except:
     print_usage()
 
@@ -60,7 +106,9 @@ def print_usage():
 
 class plab_assistant:
   def __init__(self, action, nodes = None, username = "", path_to_files = "", \
-    port = str(0), update_callback = False, ssh_key=None):
+    port = str(0), update_callback = False, ssh_key=None, probe=None, \
+    dead="skip", inventory=None, api=plab_inventory.PLC_API, \
+    distribute=0, checksum=None, delta=False, timeline=None):
     if action == "install":
       self.task = self.install_node
     elif action == "check":
@@ -78,11 +126,12 @@ class plab_assistant:
       print_usage()
 
     self.port = str(port)
+    # inventory is the inventory file, None to not record anything, the
+    # results for hosts taken from the inventory go back into it
     if nodes == None:
-      nodes = []
-      plab_rpc = xmlrpclib.ServerProxy('https://www.planet-lab.org/PLCAPI/', allow_none=True)
-      for node in plab_rpc.GetNodes({'AuthMethod': "anonymous"}, {}, ['hostname']):
-        nodes.append(node['hostname'])
+      inventory = inventory or "plab_inventory.db"
+      nodes = plab_inventory.Inventory(inventory, api).ranked()
+    self.inventory = inventory
     self.nodes = nodes
     self.username = username
     self.path_to_files = path_to_files
@@ -91,12 +140,64 @@ class plab_assistant:
       self.ssh_key = "-o IdentityFile=" + ssh_key + " "
     else:
       self.ssh_key = ""
+    # probe is the probe cache file, None to not probe
+    self.probe = probe
+    self.dead = dead
+    # distribute is the fanout of the download tree, 0 to have every host
+    # download from path_to_files
+    self.distribute = distribute
+    self.checksum = checksum
+    # where the next forked install downloads from
+    self.source = path_to_files
+    # the version at path_to_files, found in run when using deltas
+    self.delta = delta and action == "install"
+    self.version = None
+    # timeline is the file step times are appended to, None to not time them
+    self.action = action
+    self.timeline = timeline
+    self.run_id = plab_timeline.new_run()
+
+  # Probes the nodes concurrently with short time outs and orders them with the
+  # responsive ones first, dead ones are dropped or go last
+  def preflight(self):
+    port = None
+    if self.task == self.get_stats:
+      port = int(self.port)
+    results = plab_probe.probe_cached(self.nodes, self.probe, port)
+    if self.inventory:
+      events = []
+      for res in results.values():
+        events.append((res['host'], "probe", res['ssh'] != None, res['ssh']))
+        if 'stats' in res:
+          events.append((res['host'], "stats", res['stats'] != "unreachable", None))
+      plab_inventory.Inventory(self.inventory).record_many(events)
+    alive, dead = plab_probe.order_nodes(self.nodes, results)
+    print "Probed %i hosts: %i responsive, %i dead" % (len(self.nodes), \
+      len(alive), len(dead))
+    if self.dead == "defer":
+      return alive + dead
+    return alive
 
 # Runs 32 threads at the same time, this works well because half of the ndoes
 # contacted typically are unresponsive and take tcp time out to fail or in
 # other cases, they are bandwidth limited while downloading the data for
 # install
   def run(self):
+    with self.step(plab_timeline.ROLLOUT, "rollout"):
+      self.run_action()
+
+  def run_action(self):
+    if self.probe:
+      self.nodes = self.preflight()
+    if self.delta:
+      try:
+        self.version = plab_bundle.remote_version(self.path_to_files)
+      except Exception, e:
+        print "No version next to %s, installing in full: %s" % (self.path_to_files, e)
+        self.delta = False
+    if self.distribute and self.task in (self.install_node, self.check_node):
+      self.run_tree()
+      return
     # process each node
     pids = []
     for node in self.nodes:
@@ -109,7 +210,7 @@ class plab_assistant:
         to_remove = []
         for pid in pids:
           try:
-            if os.waitpid(pid, os.P_NOWAIT) == (pid, 0):
+            if os.waitpid(pid, os.P_NOWAIT)[0] == pid:
               to_remove.append(pid)
           except:
             to_remove.append(pid)
@@ -124,7 +225,7 @@ class plab_assistant:
       for pid in pids:
         to_remove = []
         try:
-          if os.waitpid(pid, os.P_NOWAIT) == (pid, 0):
+          if os.waitpid(pid, os.P_NOWAIT)[0] == pid:
             to_remove.append(pid)
         except:
           to_remove.append(pid)
@@ -144,6 +245,56 @@ class plab_assistant:
       count += 1
       time.sleep(10)
 
+  # Installs with the download sources handed out by a SourceTree, a node is
+  # only started when a source has a free slot.  The exit status of the child
+  # tells whether the host now serves the tarball.
+  def run_tree(self):
+    if self.checksum == None:
+      self.checksum = plab_distribute.checksum(self.path_to_files)
+    tree = plab_distribute.SourceTree(self.path_to_files, int(self.port) + 1, \
+      self.distribute)
+    pending = list(self.nodes)
+    running = {}
+    start = time.time()
+    while len(pending) > 0 or len(running) > 0:
+      while len(pending) > 0 and len(running) < 64:
+        self.source = tree.acquire()
+        if self.source == None:
+          break
+        node = pending.pop(0)
+        pid = os.fork()
+        if pid == 0:
+          self.task(node)
+        running[pid] = (node, self.source, time.time())
+
+      done = False
+      for pid, (node, source, started) in running.items():
+        try:
+          wpid, status = os.waitpid(pid, os.P_NOWAIT)
+          if wpid == pid:
+            if os.WIFEXITED(status):
+              status = os.WEXITSTATUS(status)
+            else:
+              status = plab_distribute.FAILED
+          elif time.time() - started > INSTALL_TIMEOUT:
+            os.kill(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+            status = plab_distribute.FAILED
+          else:
+            continue
+        except:
+          status = plab_distribute.FAILED
+        tree.release(source, node, status)
+        del running[pid]
+        done = True
+      if not done:
+        time.sleep(1)
+    print "Distributed to %i hosts in %.0f seconds" % (tree.peers(), \
+      time.time() - start)
+
+  def step(self, node, name):
+    return plab_timeline.step(self.timeline, self.run_id, self.action, node, name)
+
   def check_node(self, node):
     self.node_install(node, True)
 
@@ -159,39 +310,109 @@ class plab_assistant:
       "-o HostbasedAuthentication=no -o CheckHostIP=no " + self.username + \
       "@" + node + " "
     if check:
-      try: 
-        # This prints something if all is good ending this install attempt
-        ssh_cmd(base_ssh + "ps uax | grep basicnode | grep -v grep")
-      except:
+      with self.step(node, "check"):
+        try: 
+          # This prints something if all is good ending this install attempt
+          ssh_cmd(base_ssh + "ps uax | grep basicnode | grep -v grep")
+          running = False
+        except:
+          running = True
+      if running:
         #print node + " already installed or fail..."
-        sys.exit()
+        sys.exit(plab_distribute.SKIPPED)
+    status = plab_distribute.INSTALLED
     try:
       # this helps us leave early in case the node is unaccessible
-      ssh_cmd(base_ssh + "pkill -KILL basicnode &> /dev/null")
-      ssh_cmd(base_ssh + "/home/" + self.username + "/node/clean.sh &> /dev/null")
-      ssh_cmd(base_ssh + "rm -rf /home/" + self.username + "/* &> /dev/null")
-      ssh_cmd(base_ssh + "wget --quiet " + self.path_to_files + " -O ~/node.tgz")
-      ssh_cmd(base_ssh + "tar -zxf node.tgz")
-      ssh_cmd(base_ssh + "/home/" + self.username + "/node/clean.sh &> /dev/null")
+      with self.step(node, "kill"):
+        ssh_cmd(base_ssh + "pkill -KILL basicnode &> /dev/null")
+      with self.step(node, "clean"):
+        ssh_cmd(base_ssh + "/home/" + self.username + "/node/clean.sh &> /dev/null")
+      if self.delta and self.apply_delta(node, base_ssh):
+        status = plab_distribute.UPDATED
+      else:
+        with self.step(node, "remove"):
+          ssh_cmd(base_ssh + "rm -rf /home/" + self.username + "/* &> /dev/null")
+        if self.source == self.path_to_files:
+          with self.step(node, "download"):
+            self.download(base_ssh, self.path_to_files)
+        else:
+          try:
+            with self.step(node, "peer"):
+              self.download(base_ssh, self.source)
+          except:
+            status = plab_distribute.PEER_FAILED
+            with self.step(node, "download"):
+              self.download(base_ssh, self.path_to_files)
+        with self.step(node, "extract"):
+          ssh_cmd(base_ssh + "tar -zxf node.tgz")
+      with self.step(node, "clean"):
+        ssh_cmd(base_ssh + "/home/" + self.username + "/node/clean.sh &> /dev/null")
+      if self.distribute and status != plab_distribute.UPDATED:
+        # server.py serves the node directory to the hosts after this one
+        with self.step(node, "publish"):
+          ssh_cmd(base_ssh + "cp node.tgz node/node.tgz")
 
   # this won't end unless we force it to!  It should never take more than 20
   # seconds for this to run... or something bad happened.
-      cmd = base_ssh + " /home/" + self.username + "/node/start_node.sh &> /dev/null"
-      pid = os.spawnvp(os.P_NOWAIT, 'ssh', cmd.split(' '))
-      time.sleep(20)
-      try:
-        if os.waitpid(pid, os.P_NOWAIT) != (pid, 0):
-          os.kill(pid, signal.SIGKILL)
-      except:
-        pass
+      with self.step(node, "start"):
+        cmd = base_ssh + " /home/" + self.username + "/node/start_node.sh &> /dev/null"
+        pid = os.spawnvp(os.P_NOWAIT, 'ssh', cmd.split(' '))
+        time.sleep(20)
+        try:
+          if os.waitpid(pid, os.P_NOWAIT) != (pid, 0):
+            os.kill(pid, signal.SIGKILL)
+        except:
+          pass
       print node + " done!"
+      self.record(node, "install", True)
       if self.update_callback:
         self.update_callback(node, 1)
     except:
       print node + " failed!"
+      status = plab_distribute.FAILED
+      self.record(node, "install", False)
       if self.update_callback:
        self.update_callback(node, 0)
-    sys.exit()
+    sys.exit(status)
+
+  # Brings the node directory on the host from its version to self.version
+  # with a delta, returns False when the host has no version, there is no
+  # delta for it or the result does not match the manifest
+  def apply_delta(self, node, base_ssh):
+    try:
+      with self.step(node, "delta"):
+        return self.fetch_delta(base_ssh)
+    except:
+      return False
+
+  def fetch_delta(self, base_ssh):
+    old = ssh_output(base_ssh + "cat node/" + plab_bundle.VERSION).strip()
+    if old == self.version:
+      # nothing to fetch, but the files may have been changed since
+      ssh_cmd(base_ssh + "cd node && sha1sum -c --quiet " + plab_bundle.MANIFEST)
+      return True
+    url = plab_bundle.sibling_url(self.path_to_files, \
+      plab_bundle.delta_name(old, self.version))
+    ssh_cmd(base_ssh + "wget --quiet --timeout=60 --tries=2 " + url + " -O ~/delta.tgz")
+    ssh_cmd(base_ssh + "tar -zxf delta.tgz")
+    # sha1sum only prints the files that do not match
+    ssh_cmd(base_ssh + "cd node && xargs -r rm -f < " + plab_bundle.REMOVED + \
+      " && sha1sum -c --quiet " + plab_bundle.MANIFEST + " && rm -f ../delta.tgz node.tgz " + \
+      plab_bundle.REMOVED)
+    return True
+
+  # Fetches the tarball from url to ~/node.tgz on the host and, if there is a
+  # checksum, verifies the copy
+  def download(self, base_ssh, url):
+    ssh_cmd(base_ssh + "wget --quiet --timeout=60 --tries=2 " + url + " -O ~/node.tgz")
+    if self.checksum:
+      out = ssh_output(base_ssh + "sha1sum node.tgz")
+      if out.split(' ')[0] != self.checksum:
+        raise KeyboardInterrupt
+
+  def record(self, node, kind, ok):
+    if self.inventory:
+      plab_inventory.record_event(self.inventory, node, kind, ok)
 
   def uninstall_node(self, node):
     base_ssh = "/usr/bin/ssh -o StrictHostKeyChecking=no " + self.ssh_key + \
@@ -199,9 +420,12 @@ class plab_assistant:
       "@" + node + " "
     try:
       # this helps us leave early in case the node is unaccessible
-      ssh_cmd(base_ssh + "pkill -KILL basicnode &> /dev/null")
-      ssh_cmd(base_ssh + "/home/" + self.username + "/node/clean.sh &> /dev/null")
-      ssh_cmd(base_ssh + "rm -rf /home/" + self.username + "/* &> /dev/null")
+      with self.step(node, "kill"):
+        ssh_cmd(base_ssh + "pkill -KILL basicnode &> /dev/null")
+      with self.step(node, "clean"):
+        ssh_cmd(base_ssh + "/home/" + self.username + "/node/clean.sh &> /dev/null")
+      with self.step(node, "remove"):
+        ssh_cmd(base_ssh + "rm -rf /home/" + self.username + "/* &> /dev/null")
       if self.update_callback:
         self.update_callback(node, 0)
       else:
@@ -216,7 +440,8 @@ class plab_assistant:
   def get_stats(self, node):
     try:
       server = xmlrpclib.Server('http://' + node + ':' + self.port)
-      stats = server.get_stats()
+      with self.step(node, "stats"):
+        stats = server.get_stats()
       if 'dead' in stats:
         mem = 0
         cpu = 0.0
@@ -226,6 +451,7 @@ class plab_assistant:
     except:
       mem = -1
       cpu = -1.1
+    self.record(node, "stats", mem != -1)
 
     data_points = {'host' : node, 'mem' : mem, 'cpu': cpu}
     if self.update_callback:
@@ -241,7 +467,8 @@ class plab_assistant:
       "@" + node + ":/home/" + self.username + "/node/node.log.* logs/" + node + \
       "/."
     try:
-      ssh_cmd(cmd)
+      with self.step(node, "copy"):
+        ssh_cmd(cmd)
     except :
       pass
     sys.exit()
@@ -260,5 +487,14 @@ def ssh_cmd(cmd):
     #print "Out: " + out
     raise KeyboardInterrupt
 
+# Runs an ssh command that is expected to print, returns what it printed
+def ssh_output(cmd):
+  p = subprocess.Popen(cmd.split(' '), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+  out, err = p.communicate()
+  good_err = re.compile("Warning: Permanently added")
+  if (good_err.search(err) == None and err != '') or p.returncode != 0:
+    raise KeyboardInterrupt
+  return out
+
 if __name__ == "__main__":
   main()
@@ -0,0 +1,227 @@
+#!/usr/bin/python
+usage = """usage:
+plab_bundle manifest <directory> = print the manifest and version of a directory
+plab_bundle gzip <source> <destination> = gzip a file with every processor
+plab_bundle test = run the unit tests
+"""
+
+import os, sys, gzip, hashlib, tarfile, urllib2, StringIO, unittest
+from multiprocessing import Pool, cpu_count
+
+# files kept in the node directory describing the bundle, the manifest is in
+# sha1sum format so hosts verify the files with sha1sum -c
+MANIFEST = "MANIFEST"
+VERSION = "VERSION"
+# a delta lists the files that went away here
+REMOVED = "REMOVED"
+BLOCK_SIZE = 1 << 20
+
+def main():
+  try:
+    action = sys.argv[1]
+    if action == "manifest":
+      m = manifest(sys.argv[2])
+      for path in sorted(m):
+        print "%s  %s" % (m[path], path)
+      print "version " + version(m)
+    elif action == "gzip":
+      parallel_gzip(sys.argv[2], sys.argv[3])
+    elif action == "test":
+      suite = unittest.TestLoader().loadTestsFromTestCase(TestBundle)
+      unittest.TextTestRunner(verbosity=2).run(suite)
+    else:
+      raise ValueError(action)
+  except (IndexError, ValueError):
+    print usage
+    sys.exit()
+
+def hash_file(path):
+  h = hashlib.sha1()
+  f = open(path, "rb")
+  data = f.read(BLOCK_SIZE)
+  while data:
+    h.update(data)
+    data = f.read(BLOCK_SIZE)
+  f.close()
+  return h.hexdigest()
+
+# The sha1 of every file under directory, by path relative to it
+def manifest(directory):
+  m = {}
+  for root, dirs, files in os.walk(directory):
+    for name in files:
+      path = os.path.relpath(os.path.join(root, name), directory)
+      if path in (MANIFEST, VERSION, REMOVED):
+        continue
+      m[path] = hash_file(os.path.join(root, name))
+  return m
+
+def manifest_text(m):
+  return "".join(["%s  %s\n" % (m[path], path) for path in sorted(m)])
+
+def write_manifest(m, filename):
+  f = open(filename, "w")
+  f.write(manifest_text(m))
+  f.close()
+
+def read_manifest(filename):
+  m = {}
+  f = open(filename)
+  for line in f:
+    if line.strip():
+      digest, path = line.rstrip("\n").split("  ", 1)
+      m[path] = digest
+  f.close()
+  return m
+
+# A version is named by its content
+def version(m):
+  return hashlib.sha1(manifest_text(m)).hexdigest()[:16]
+
+# The key of a set of build inputs: the command and the name and content of
+# each file, so an unchanged set of assemblies is bundled once
+def inputs_key(paths, command = ""):
+  h = hashlib.sha1(command)
+  for path in sorted(paths):
+    h.update("\0%s\0%s" % (path, hash_file(path)))
+  return h.hexdigest()
+
+def delta(old, new):
+  """The paths that changed or are new in new and the ones it removed"""
+  changed = sorted([path for path in new if old.get(path) != new[path]])
+  removed = sorted([path for path in old if path not in new])
+  return changed, removed
+
+def _gzip_block(data):
+  buf = StringIO.StringIO()
+  g = gzip.GzipFile(fileobj = buf, mode = "wb", mtime = 0)
+  g.write(data)
+  g.close()
+  return buf.getvalue()
+
+# Compresses blocks of source on every processor, each block is a gzip member
+# and their concatenation is a gzip file tar -z and gunzip read as usual
+def parallel_gzip(source, destination, processes = None):
+  src = open(source, "rb")
+  dst = open(destination, "wb")
+  pool = Pool(processes or cpu_count())
+  try:
+    blocks = iter(lambda: src.read(BLOCK_SIZE), "")
+    for data in pool.imap(_gzip_block, blocks):
+      dst.write(data)
+  finally:
+    pool.close()
+    pool.join()
+    src.close()
+    dst.close()
+
+# Writes a tgz of the paths under directory, relative to it, stored under the
+# directory's own name
+def make_tarball(directory, paths, destination, processes = None):
+  directory = os.path.normpath(directory)
+  name = os.path.basename(directory)
+  tmp = destination + ".tar"
+  tar = tarfile.open(tmp, "w")
+  for path in sorted(paths):
+    tar.add(os.path.join(directory, path), os.path.join(name, path), False)
+  tar.close()
+  try:
+    parallel_gzip(tmp, destination, processes)
+  finally:
+    os.remove(tmp)
+
+def delta_name(old, new):
+  return "delta-%s-%s.tgz" % (old, new)
+
+# The url of a file next to the tarball at path_to_files
+def sibling_url(path_to_files, name):
+  return path_to_files.rsplit("/", 1)[0] + "/" + name
+
+def remote_version(path_to_files):
+  f = urllib2.urlopen(sibling_url(path_to_files, VERSION))
+  res = f.read().strip()
+  f.close()
+  return res
+
+#############################
+# Here are the unit tests
+#############################
+
+class TestBundle(unittest.TestCase):
+  def setUp(self):
+    import tempfile
+    self.dir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    import shutil
+    shutil.rmtree(self.dir)
+
+  def write(self, path, data):
+    path = os.path.join(self.dir, path)
+    if not os.path.isdir(os.path.dirname(path)):
+      os.makedirs(os.path.dirname(path))
+    f = open(path, "wb")
+    f.write(data)
+    f.close()
+
+  def testManifest(self):
+    self.write("node/a.dll", "a")
+    self.write("node/lib/b.dll", "b")
+    self.write("node/c.exe", "c")
+    node = os.path.join(self.dir, "node")
+    old = manifest(node)
+    self.assertEqual(sorted(old), ["a.dll", "c.exe", "lib/b.dll"])
+    self.assertEqual(old["a.dll"], hashlib.sha1("a").hexdigest())
+    write_manifest(old, os.path.join(node, MANIFEST))
+    self.write("node/" + VERSION, version(old))
+    #the bundle's own files are not in it
+    self.assertEqual(manifest(node), old)
+    self.assertEqual(read_manifest(os.path.join(node, MANIFEST)), old)
+    self.write("node/a.dll", "a2")
+    self.write("node/lib/d.dll", "d")
+    os.remove(os.path.join(node, "c.exe"))
+    new = manifest(node)
+    self.assertNotEqual(version(new), version(old))
+    self.assertEqual(delta(old, new), (["a.dll", "lib/d.dll"], ["c.exe"]))
+    self.assertEqual(delta(new, new), ([], []))
+    #applying the delta to the old manifest gives the new one
+    changed, removed = delta(old, new)
+    applied = dict(old)
+    for path in removed:
+      del applied[path]
+    for path in changed:
+      applied[path] = new[path]
+    self.assertEqual(applied, new)
+    self.assertEqual(version(applied), version(new))
+
+  def testGzip(self):
+    import random
+    rng = random.Random(1)
+    data = "".join([chr(rng.randrange(32)) for i in xrange(BLOCK_SIZE / 2)]) * 5
+    self.write("source", data)
+    source = os.path.join(self.dir, "source")
+    destination = os.path.join(self.dir, "source.gz")
+    parallel_gzip(source, destination, 2)
+    g = gzip.open(destination)
+    self.assertEqual(g.read(), data)
+    g.close()
+    #an empty file gives an empty gzip
+    self.write("empty", "")
+    parallel_gzip(os.path.join(self.dir, "empty"), destination, 2)
+    g = gzip.open(destination)
+    self.assertEqual(g.read(), "")
+    g.close()
+
+  def testTarball(self):
+    self.write("node/a.dll", "a")
+    self.write("node/lib/b.dll", "b" * 1000)
+    destination = os.path.join(self.dir, "delta.tgz")
+    make_tarball(os.path.join(self.dir, "node") + "/", ["lib/b.dll"], destination, 2)
+    tar = tarfile.open(destination, "r:gz")
+    self.assertEqual(tar.getnames(), ["node/lib/b.dll"])
+    self.assertEqual(tar.extractfile("node/lib/b.dll").read(), "b" * 1000)
+    tar.close()
+    self.assertFalse(os.path.exists(destination + ".tar"))
+
+if __name__ == "__main__":
+  main()
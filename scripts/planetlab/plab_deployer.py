@@ -1,5 +1,9 @@
 #!/usr/bin/python
-import sys, os, crawl, csv, datetime, time, re, subprocess, plab_assistant, signal
+import sys, os, crawl, csv, datetime, time, re, subprocess, plab_assistant, signal, \
+  plab_inventory, plab_bundle, shutil
+
+# deltas are made from this many of the previous versions
+DELTA_HISTORY = 5
 
 usage = """usage:
 plab_deployer slice_name base_path unique_name path_to_files
@@ -19,28 +23,71 @@ class plab_deployer:
     self.ssh_key = ssh_key
     
   def build(self):
-    """  Compiles the files in the zip file using mkbundle, and compress to tgz file. """
+    """  Compiles the files in the zip file using mkbundle, and compress to tgz file.
+         The bundle is cached by the hash of its inputs and upload/ gets the
+         VERSION of the node directory and deltas from the previous versions. """
     os.chdir(self.base_path)
     os.system("unzip -o -d binary input.zip")
     os.chdir("binary")
     dlls = "Mono.Posix.dll "
+    inputs = ["BasicNode.exe"]
     for i in os.walk('.'):
       files = i[2]
       for file in files:
         if file.endswith(".dll"):
           dlls += file + " "
+          inputs.append(os.path.join(i[0], file))
 
-    os.system("mkbundle2 -o basicnode --deps --config-dir . --static -z BasicNode.exe " + dlls)
-    os.system("cp basicnode ../node/.")
+    cmd = "mkbundle2 -o basicnode --deps --config-dir . --static -z BasicNode.exe " + dlls
+    cached = os.path.join(self.base_path, "cache", "basicnode." + \
+      plab_bundle.inputs_key(inputs, cmd))
+    if not os.path.exists(cached) and os.system(cmd) == 0:
+      if not os.path.isdir(os.path.dirname(cached)):
+        os.makedirs(os.path.dirname(cached))
+      shutil.copy2("basicnode", cached)
+    if os.path.exists(cached):
+      shutil.copy2(cached, "../node/basicnode")
     os.chdir("..")
     os.system("sed 's/BRUNETNAMESPACE/" + self.name + "/' -i node/node.config." + self.slice_name)
-    os.system("tar -czf output.tgz node")
+
+    m = plab_bundle.manifest("node")
+    version = plab_bundle.version(m)
+    plab_bundle.write_manifest(m, os.path.join("node", plab_bundle.MANIFEST))
+    f = open(os.path.join("node", plab_bundle.VERSION), "w")
+    f.write(version + "\n")
+    f.close()
+    meta = [plab_bundle.MANIFEST, plab_bundle.VERSION]
+    plab_bundle.make_tarball("node", m.keys() + meta, "output.tgz")
+
+    # every version built here is kept for making deltas to later ones
+    if not os.path.isdir("versions"):
+      os.makedirs("versions")
+    previous = [v for v in os.listdir("versions") if v != version]
+    previous.sort(key = lambda v: os.path.getmtime(os.path.join("versions", v)))
+    plab_bundle.write_manifest(m, os.path.join("versions", version))
+    shutil.rmtree("upload", True)
+    os.makedirs("upload")
+    shutil.copy2(os.path.join("node", plab_bundle.VERSION), "upload")
+    for old in previous[-DELTA_HISTORY:]:
+      changed, removed = plab_bundle.delta( \
+        plab_bundle.read_manifest(os.path.join("versions", old)), m)
+      f = open(os.path.join("node", plab_bundle.REMOVED), "w")
+      f.write("".join([path + "\n" for path in removed]))
+      f.close()
+      plab_bundle.make_tarball("node", changed + meta + [plab_bundle.REMOVED], \
+        os.path.join("upload", plab_bundle.delta_name(old, version)))
+      os.remove(os.path.join("node", plab_bundle.REMOVED))
 
   def run(self):
     """  deploys bundled basicnode module to plab nodes using plab_assistant.
          crawls the ring continuously for 48 hours and then gathers logs. """
-    plab = plab_assistant.plab_assistant("install", nodes=None, username=self.slice_name, \
-        path_to_files=self.path_to_files, ssh_key=self.ssh_key)
+    # the host list is read once, from the inventory, for all the steps
+    inventory = os.path.join(self.base_path, "plab_inventory.db")
+    self.nodes = plab_inventory.Inventory(inventory).ranked()
+    timeline = os.path.join(self.base_path, "plab_timeline.log")
+    plab = plab_assistant.plab_assistant("install", nodes=self.nodes, username=self.slice_name, \
+        path_to_files=self.path_to_files, ssh_key=self.ssh_key, inventory=inventory, \
+        delta=True, timeline=timeline)
     plab.run()
     os.chdir(self.base_path + "/node")
     os.system("sed 's/<Enabled>false/<Enabled>true/' -i node.config." + self.slice_name)
@@ -57,7 +104,7 @@ class plab_deployer:
     port_line = re.search("<XmlRpcManager>.*</XmlRpcManager>", content, re.S).group()
     port =  int(re.search("\d+", port_line).group())
     while datetime.datetime.utcnow() - start_utc < test_length:
-      nodes = crawl.crawl(port)
+      nodes = crawl.latest(port)
       consistency, count = crawl.check_results(nodes)
       os.chdir(self.base_path)
       f = open("crawl.csv", "a")
@@ -65,13 +112,13 @@ class plab_deployer:
       f.close()
       time.sleep(60 * 15)
     # done with the test, start getting logs and cleaning up.
-    plab = plab_assistant.plab_assistant("get_logs", nodes=None, username=self.slice_name, \
-        path_to_files=self.path_to_files, ssh_key=self.ssh_key)
+    plab = plab_assistant.plab_assistant("get_logs", nodes=self.nodes, username=self.slice_name, \
+        path_to_files=self.path_to_files, ssh_key=self.ssh_key, inventory=inventory, timeline=timeline)
     plab.run()
     os.system("zip -r9 results.zip logs output.log crawl.csv")
     # Actually not necessary because installation cleans nodes first.
-    plab = plab_assistant.plab_assistant("uninstall", nodes=None, username=self.slice_name, \
-        path_to_files=self.path_to_files, ssh_key=self.ssh_key)
+    plab = plab_assistant.plab_assistant("uninstall", nodes=self.nodes, username=self.slice_name, \
+        path_to_files=self.path_to_files, ssh_key=self.ssh_key, inventory=inventory, timeline=timeline)
     plab.run()
     try:
       os.kill(self.local_basicnode_pid, signal.SIGKILL)
@@ -87,5 +134,6 @@ if __name__ == '__main__':
     sys.exit()
   plab.build()
   print "Upload output.tgz to " + plab.path_to_files + " a web server and provide the link."
+  print "Upload the files in upload/ next to it, hosts with a previous version only fetch a delta."
   raw_input("Press any key to continue")
   plab.run()
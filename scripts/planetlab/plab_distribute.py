@@ -0,0 +1,153 @@
+#!/usr/bin/python
+usage = """usage:
+plab_distribute <url or filename>
+prints the sha1 checksum of the node tarball, for plab_assistant --checksum
+plab_distribute test = run the unit tests
+"""
+
+import sys, hashlib, urllib2, unittest
+
+# how an install child exits, so the parent knows whether the host can now
+# serve the tarball to others
+INSTALLED = 0
+FAILED = 1
+# installed from the origin after the assigned peer failed or sent a bad copy
+PEER_FAILED = 2
+# check found the node already running, it is not a source
+SKIPPED = 3
+# updated with a delta, there is no tarball on the host to serve
+UPDATED = 4
+
+def main():
+  try:
+    location = sys.argv[1]
+  except:
+    print usage
+    sys.exit()
+  if location == "test":
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestSourceTree)
+    unittest.TextTestRunner(verbosity=2).run(suite)
+    return
+  print checksum(location)
+
+# sha1 of a url or a local file, read in blocks
+def checksum(location):
+  if "://" in location:
+    f = urllib2.urlopen(location)
+  else:
+    f = open(location, "rb")
+  h = hashlib.sha1()
+  data = f.read(65536)
+  while data:
+    h.update(data)
+    data = f.read(65536)
+  f.close()
+  return h.hexdigest()
+
+class SourceTree:
+  """Hands out download sources for a rollout.  The origin serves at most
+  fanout hosts at a time and every host that finishes its install serves
+  fanout more from its node/server.py HTTPServer, so the hosts form a tree
+  whose depth grows with the log of the fleet and the origin's load stays
+  constant.  Peers with the fewest downloads in flight are used first, the
+  origin only when no peer is free."""
+  def __init__(self, origin, port, fanout = 4):
+    self.origin = origin
+    # the port of server.py's HTTPServer on the peers
+    self.port = port
+    self.fanout = fanout
+    # source url -> downloads in flight
+    self.active = {origin : 0}
+
+  def peer_url(self, node):
+    return "http://%s:%i/node.tgz" % (node, self.port)
+
+  def acquire(self):
+    """A url with a free slot or None if every source is busy"""
+    free = [url for url, count in self.active.items() \
+      if url != self.origin and count < self.fanout]
+    if len(free) > 0:
+      url = min(free, key = lambda url: self.active[url])
+    elif self.active[self.origin] < self.fanout:
+      url = self.origin
+    else:
+      return None
+    self.active[url] += 1
+    return url
+
+  def release(self, url, node, status):
+    """Called when the install of node from url ended with status"""
+    if url in self.active:
+      self.active[url] -= 1
+    if status == PEER_FAILED and url != self.origin:
+      # several hosts may report the same peer
+      self.active.pop(url, None)
+    if status in (INSTALLED, PEER_FAILED):
+      self.active.setdefault(self.peer_url(node), 0)
+
+  def peers(self):
+    return len(self.active) - 1
+
+#############################
+# Here are the unit tests
+#############################
+
+class TestSourceTree(unittest.TestCase):
+  ORIGIN = "http://origin/node.tgz"
+
+  def testOrigin(self):
+    tree = SourceTree(self.ORIGIN, 15001, 2)
+    self.assertEqual([tree.acquire() for i in xrange(3)], \
+      [self.ORIGIN, self.ORIGIN, None])
+    tree.release(self.ORIGIN, "a", FAILED)
+    #a failed host frees its slot but serves nobody
+    self.assertEqual(tree.peers(), 0)
+    self.assertEqual(tree.acquire(), self.ORIGIN)
+    for status in (SKIPPED, UPDATED):
+      tree.release(self.ORIGIN, "b", status)
+      self.assertEqual(tree.peers(), 0)
+      self.assertEqual(tree.acquire(), self.ORIGIN)
+    self.assertEqual(tree.acquire(), None)
+
+  def testPeers(self):
+    tree = SourceTree(self.ORIGIN, 15001, 2)
+    a = tree.peer_url("a")
+    b = tree.peer_url("b")
+    self.assertEqual(a, "http://a:15001/node.tgz")
+    tree.acquire()
+    tree.release(self.ORIGIN, "a", INSTALLED)
+    self.assertEqual(tree.active, {self.ORIGIN : 0, a : 0})
+    #peers first, the origin only once they are full
+    self.assertEqual([tree.acquire() for i in xrange(5)], \
+      [a, a, self.ORIGIN, self.ORIGIN, None])
+    tree.release(a, "b", INSTALLED)
+    tree.release(self.ORIGIN, "c", FAILED)
+    #the least loaded peer
+    self.assertEqual(tree.acquire(), b)
+    self.assertEqual(tree.acquire(), a)
+    self.assertEqual(tree.acquire(), b)
+    self.assertEqual(tree.acquire(), self.ORIGIN)
+    self.assertEqual(tree.acquire(), None)
+    self.assertEqual(tree.active, {self.ORIGIN : 2, a : 2, b : 2})
+
+  def testPeerFailed(self):
+    tree = SourceTree(self.ORIGIN, 15001, 2)
+    a = tree.peer_url("a")
+    tree.acquire()
+    tree.release(self.ORIGIN, "a", INSTALLED)
+    self.assertEqual([tree.acquire(), tree.acquire()], [a, a])
+    #b and c got a bad copy from a and installed from the origin
+    tree.release(a, "b", PEER_FAILED)
+    self.assertFalse(a in tree.active)
+    tree.release(a, "c", PEER_FAILED)
+    self.assertEqual(tree.active, {self.ORIGIN : 0, tree.peer_url("b") : 0, \
+      tree.peer_url("c") : 0})
+    self.assertEqual(tree.peers(), 2)
+    #the origin is never dropped
+    self.assertEqual([tree.acquire() for i in xrange(6)].count(self.ORIGIN), 2)
+    tree.release(self.ORIGIN, "d", PEER_FAILED)
+    self.assertEqual(tree.active[self.ORIGIN], 1)
+    self.assertEqual(tree.peers(), 3)
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,368 @@
+#!/usr/bin/python
+usage = """usage:
+plab_inventory [--db=<filename>] [--api=<url>] action
+action = one of
+  refresh [--full] = update the host list from the PLC API, only the hosts
+    updated since the last refresh unless full
+  list [--count=<number>] [--all] = print the hosts best score first, only
+    hosts in the boot state unless all
+  show <hostname> = print the history of a host
+  standin --path_to_nodes=<filename> [--listen=<port>] = serve GetNodes for
+    the hosts in a file, a local stand-in of the PLC API for working offline
+  test = run the unit tests
+db = the inventory file, default plab_inventory.db
+api = url of the PLC API, default https://www.planet-lab.org/PLCAPI/
+"""
+
+import sys, time, getopt, sqlite3, xmlrpclib, SimpleXMLRPCServer, unittest
+
+PLC_API = 'https://www.planet-lab.org/PLCAPI/'
+FIELDS = ['hostname', 'node_id', 'boot_state', 'last_updated']
+# the host list is only fetched again after this many seconds
+MAX_AGE = 3600
+# and in full, which also drops removed hosts, after this many
+FULL_AGE = 86400
+# the weight of an event halves every week
+HALF_LIFE = 7 * 86400.0
+# the share of each kind of event in the score
+WEIGHTS = {'install' : 0.5, 'probe' : 0.3, 'stats' : 0.2}
+# probes this slow or slower take LATENCY_PENALTY off the score
+SLOW_PROBE = 1.0
+LATENCY_PENALTY = 0.1
+
+def main():
+  try:
+    optlist, args = getopt.gnu_getopt(sys.argv[1:], "", ["db=", "api=", "full", \
+      "count=", "all", "path_to_nodes=", "listen="])
+    o_d = {}
+    for k,v in optlist:
+      o_d[k] = v
+    action = args[0]
+    if action == "show":
+      host = args[1]
+    elif action not in ("refresh", "list", "standin", "test"):
+      raise ValueError(action)
+  except:
+    print usage
+    sys.exit()
+
+  if action == "test":
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestInventory)
+    unittest.TextTestRunner(verbosity=2).run(suite)
+    return
+  if action == "standin":
+    standin(o_d["--path_to_nodes"], int(o_d.get("--listen", 8010)))
+    return
+  inv = Inventory(o_d.get("--db", "plab_inventory.db"), o_d.get("--api", PLC_API))
+  if action == "refresh":
+    changed = inv.refresh(force = True, full = "--full" in o_d)
+    if changed != None:
+      print "%i hosts changed" % changed
+  elif action == "list":
+    count = None
+    if "--count" in o_d:
+      count = int(o_d["--count"])
+    for host, score in inv.ranked(count, "--all" in o_d, True):
+      print "%s %.3f" % (host, score)
+  else:
+    for t, kind, ok, value in inv.history(host):
+      print "%s %s %s %s" % (time.ctime(t), kind, "ok" if ok else "failed", \
+        value if value != None else "")
+
+class Inventory:
+  """Hosts from the PLC API and their history, kept in an sqlite file.  For
+  each host and kind of event (install, probe, stats) the decayed count of
+  events, of successes and the decayed sum of the values (probe latency) are
+  kept so scoring never goes over the history."""
+  def __init__(self, filename = "plab_inventory.db", api = PLC_API):
+    self.api = api
+    #forked plab_assistant children write here at the same time
+    self.db = sqlite3.connect(filename, timeout = 60)
+    self.db.executescript("""
+      CREATE TABLE IF NOT EXISTS hosts (hostname TEXT PRIMARY KEY,
+        node_id INTEGER, boot_state TEXT, last_updated INTEGER);
+      CREATE TABLE IF NOT EXISTS events (hostname TEXT, time REAL, kind TEXT,
+        ok INTEGER, value REAL);
+      CREATE INDEX IF NOT EXISTS events_host ON events (hostname);
+      CREATE TABLE IF NOT EXISTS health (hostname TEXT, kind TEXT, time REAL,
+        count REAL, ok REAL, value REAL, PRIMARY KEY (hostname, kind));
+      CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value REAL);""")
+    self.db.commit()
+
+  def get_meta(self, key, default = 0):
+    row = self.db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+    if row == None:
+      return default
+    return row[0]
+
+  def set_meta(self, key, value):
+    self.db.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", (key, value))
+
+  def refresh(self, max_age = MAX_AGE, full_age = FULL_AGE, force = False, \
+    full = False):
+    """Fetches the hosts changed since the last refresh if that is older than
+    max_age, returns the number of hosts fetched, None if the API could not be
+    reached and the cached list is used"""
+    now = time.time()
+    if not force and now - self.get_meta('last_refresh') < max_age:
+      return 0
+    count = self.db.execute("SELECT COUNT(*) FROM hosts").fetchone()[0]
+    full = full or count == 0 or now - self.get_meta('last_full') > full_age
+    since = self.get_meta('last_updated')
+    try:
+      api = xmlrpclib.ServerProxy(self.api, allow_none = True)
+      auth = {'AuthMethod' : "anonymous"}
+      if full:
+        nodes = api.GetNodes(auth, {}, FIELDS)
+      else:
+        nodes = api.GetNodes(auth, {'>last_updated' : int(since)}, FIELDS)
+    except Exception, e:
+      print "Unable to reach %s, using the cached hosts: %s" % (self.api, e)
+      return None
+    if full:
+      self.db.execute("DELETE FROM hosts")
+      self.set_meta('last_full', now)
+    self.db.executemany("INSERT OR REPLACE INTO hosts VALUES (?, ?, ?, ?)", \
+      [(n['hostname'], n.get('node_id'), n.get('boot_state'), \
+      n.get('last_updated') or 0) for n in nodes])
+    last = max([n.get('last_updated') or 0 for n in nodes] + [since])
+    self.set_meta('last_updated', last)
+    self.set_meta('last_refresh', now)
+    self.db.commit()
+    return len(nodes)
+
+  def hosts(self, all = False):
+    self.refresh()
+    if all:
+      rows = self.db.execute("SELECT hostname FROM hosts")
+    else:
+      rows = self.db.execute("SELECT hostname FROM hosts WHERE boot_state = 'boot'")
+    return [row[0] for row in rows]
+
+  def record(self, hostname, kind, ok, value = None, now = None):
+    """Adds an event, value is the latency of a probe"""
+    if now == None:
+      now = time.time()
+    self.add_event(hostname, kind, ok, value, now)
+    self.db.commit()
+
+  def record_many(self, events):
+    """events is a list of (hostname, kind, ok, value)"""
+    now = time.time()
+    for hostname, kind, ok, value in events:
+      self.add_event(hostname, kind, ok, value, now)
+    self.db.commit()
+
+  def add_event(self, hostname, kind, ok, value, now):
+    self.db.execute("INSERT INTO events VALUES (?, ?, ?, ?, ?)", \
+      (hostname, now, kind, int(bool(ok)), value))
+    row = self.db.execute("""SELECT time, count, ok, value FROM health
+      WHERE hostname = ? AND kind = ?""", (hostname, kind)).fetchone()
+    count = oks = total = 0.0
+    if row != None:
+      decay = 0.5 ** (max(now - row[0], 0) / HALF_LIFE)
+      count, oks, total = row[1] * decay, row[2] * decay, row[3] * decay
+    count += 1
+    if ok:
+      oks += 1
+      if value != None:
+        total += value
+    self.db.execute("INSERT OR REPLACE INTO health VALUES (?, ?, ?, ?, ?, ?)", \
+      (hostname, kind, now, count, oks, total))
+
+  def history(self, hostname):
+    return self.db.execute("""SELECT time, kind, ok, value FROM events
+      WHERE hostname = ? ORDER BY time""", (hostname,)).fetchall()
+
+  def scores(self):
+    """The score of every host in [0, 1], a host without history gets 0.5 for
+    each kind"""
+    health = {}
+    for hostname, kind, t, count, ok, value in self.db.execute("SELECT * FROM health"):
+      health.setdefault(hostname, {})[kind] = (count, ok, value)
+    scores = {}
+    for (hostname,) in self.db.execute("SELECT hostname FROM hosts"):
+      h = health.get(hostname, {})
+      score = 0.0
+      for kind, weight in WEIGHTS.items():
+        count, ok, value = h.get(kind, (0, 0, 0))
+        score += weight * (ok + 1) / (count + 2)
+      if 'probe' in h and h['probe'][1] > 0:
+        latency = h['probe'][2] / h['probe'][1]
+        score -= LATENCY_PENALTY * min(latency / SLOW_PROBE, 1)
+      scores[hostname] = score
+    return scores
+
+  def ranked(self, count = None, all = False, with_scores = False):
+    """The hosts best score first"""
+    #hosts refreshes the list the scores are computed for
+    hosts = self.hosts(all)
+    scores = self.scores()
+    hosts = sorted(hosts, key = lambda h: scores.get(h, 0), reverse = True)
+    if count != None:
+      hosts = hosts[:count]
+    if with_scores:
+      return [(h, scores.get(h, 0)) for h in hosts]
+    return hosts
+
+# Records a single event in its own connection, for forked children
+def record_event(filename, hostname, kind, ok, value = None):
+  try:
+    Inventory(filename).record(hostname, kind, ok, value)
+  except Exception, e:
+    print "Unable to record %s for %s: %s" % (kind, hostname, e)
+
+class StandinRequestHandler(SimpleXMLRPCServer.SimpleXMLRPCRequestHandler):
+  #answer on any path, the API is at /PLCAPI/
+  rpc_paths = ()
+
+  def log_message(self, format, *args):
+    pass
+
+def standin(path_to_nodes, port = 8010):
+  server = make_standin(path_to_nodes, port)
+  print "Serving %i hosts on port %i" % (len(server.nodes), port)
+  server.serve_forever()
+
+# Serves GetNodes for the hostnames in a file, each line is a hostname and
+# optionally its boot state.  Filters on the fields and '>last_updated' are
+# supported, AuthCheck and AddSliceToNodes always succeed.  The hosts are in
+# the server's nodes list.
+def make_standin(path_to_nodes, port = 8010):
+  now = int(time.time())
+  nodes = []
+  f = open(path_to_nodes)
+  for line in f:
+    fields = line.split()
+    if len(fields) == 0:
+      continue
+    boot_state = "boot"
+    if len(fields) > 1:
+      boot_state = fields[1]
+    nodes.append({'hostname' : fields[0], 'node_id' : len(nodes) + 1,
+      'boot_state' : boot_state, 'last_updated' : now})
+  f.close()
+
+  def matches(node, node_filter):
+    for k, v in node_filter.items():
+      if k.startswith(">"):
+        if not node[k[1:]] > v:
+          return False
+      elif node.get(k) != v:
+        return False
+    return True
+
+  def GetNodes(auth, node_filter = {}, fields = None):
+    res = [n for n in nodes if matches(n, node_filter or {})]
+    if fields:
+      res = [dict([(k, n[k]) for k in fields if k in n]) for n in res]
+    return res
+
+  server = SimpleXMLRPCServer.SimpleXMLRPCServer(('', port), \
+    StandinRequestHandler, allow_none = True)
+  server.nodes = nodes
+  server.register_function(GetNodes)
+  server.register_function(lambda auth: 1, "AuthCheck")
+  server.register_function(lambda auth, slice, hosts: 1, "AddSliceToNodes")
+  return server
+
+#############################
+# Here are the unit tests
+#############################
+
+class TestInventory(unittest.TestCase):
+  def setUp(self):
+    import tempfile, threading, os
+    self.dir = tempfile.mkdtemp()
+    hosts = os.path.join(self.dir, "hosts")
+    f = open(hosts, "w")
+    f.write("a.example.org\nb.example.org\n\nc.example.org dbg\nd.example.org\n")
+    f.close()
+    self.server = make_standin(hosts, 0)
+    t = threading.Thread(target = self.server.serve_forever)
+    t.daemon = True
+    t.start()
+    self.api = "http://127.0.0.1:%i/PLCAPI/" % self.server.server_address[1]
+    self.inv = Inventory(os.path.join(self.dir, "inventory.db"), self.api)
+
+  def tearDown(self):
+    import shutil
+    self.server.shutdown()
+    self.server.server_close()
+    shutil.rmtree(self.dir)
+
+  def health(self, hostname, kind):
+    return self.inv.db.execute("""SELECT time, count, ok, value FROM health
+      WHERE hostname = ? AND kind = ?""", (hostname, kind)).fetchone()
+
+  def testDecay(self):
+    now = 1000000000.0
+    self.inv.record("a.example.org", "probe", False, None, now)
+    self.inv.record("a.example.org", "probe", True, 0.2, now + HALF_LIFE)
+    self.assertEqual(self.health("a.example.org", "probe"), \
+      (now + HALF_LIFE, 1.5, 1.0, 0.2))
+    self.inv.record("a.example.org", "probe", True, 0.4, now + 3 * HALF_LIFE)
+    (t, count, ok, value) = self.health("a.example.org", "probe")
+    self.assertAlmostEqual(count, 1.375)
+    self.assertAlmostEqual(ok, 1.25)
+    self.assertAlmostEqual(value, 0.45)
+    #an event from before the last one does not grow the counts
+    self.inv.record("a.example.org", "probe", True, None, now)
+    self.assertAlmostEqual(self.health("a.example.org", "probe")[1], 2.375)
+    self.assertEqual(len(self.inv.history("a.example.org")), 4)
+
+  def testScores(self):
+    self.inv.refresh()
+    scores = self.inv.scores()
+    #no history is 0.5 of every kind
+    self.assertAlmostEqual(scores["d.example.org"], 0.5)
+    self.inv.record("a.example.org", "install", True)
+    self.inv.record_many([("a.example.org", "probe", True, 2.0), \
+      ("b.example.org", "stats", False, None)])
+    scores = self.inv.scores()
+    expected = 0.5 * 2 / 3.0 + 0.3 * 2 / 3.0 + 0.2 * 0.5 - LATENCY_PENALTY
+    self.assertAlmostEqual(scores["a.example.org"], expected)
+    self.assertAlmostEqual(scores["b.example.org"], 0.4 + 0.2 / 3.0)
+
+  def testRanked(self):
+    self.inv.record("a.example.org", "install", False)
+    self.inv.record("b.example.org", "install", True)
+    self.inv.record("c.example.org", "install", True)
+    self.assertEqual(self.inv.ranked(), \
+      ["b.example.org", "d.example.org", "a.example.org"])
+    self.assertEqual(self.inv.ranked(2), ["b.example.org", "d.example.org"])
+    ranked = self.inv.ranked(all = True, with_scores = True)
+    self.assertEqual([h for (h, score) in ranked][:2], \
+      ["b.example.org", "c.example.org"])
+    self.assertEqual(ranked[-1][0], "a.example.org")
+
+  def testRefresh(self):
+    self.assertEqual(self.inv.refresh(), 4)
+    #the list is not fetched again until it is max_age old
+    self.assertEqual(self.inv.refresh(), 0)
+    #nothing changed since the last update
+    self.assertEqual(self.inv.refresh(force = True), 0)
+    node = self.server.nodes[1]
+    node['boot_state'] = "dbg"
+    node['last_updated'] += 10
+    self.assertEqual(self.inv.refresh(force = True), 1)
+    self.assertEqual(self.inv.get_meta('last_updated'), node['last_updated'])
+    self.assertEqual(sorted(self.inv.hosts()), \
+      ["a.example.org", "d.example.org"])
+    #a removed host stays until the next full refresh
+    del self.server.nodes[0]
+    self.assertEqual(self.inv.refresh(force = True), 0)
+    self.assertEqual(len(self.inv.hosts(True)), 4)
+    self.assertEqual(self.inv.refresh(force = True, full = True), 3)
+    self.assertEqual(sorted(self.inv.hosts(True)), ["b.example.org", \
+      "c.example.org", "d.example.org"])
+
+  def testUnreachable(self):
+    self.assertEqual(self.inv.refresh(), 4)
+    self.server.shutdown()
+    self.server.server_close()
+    self.assertEqual(self.inv.refresh(force = True), None)
+    self.assertEqual(len(self.inv.hosts(True)), 4)
+
+if __name__ == "__main__":
+  main()
@@ -1,16 +1,9 @@
 #!/usr/bin/python
-# Returns a list of all planetlab nodes
-import xmlrpclib
+# Returns a list of all planetlab nodes, best first, from the host inventory
+# which only asks the PLC API for changes now and then (see plab_inventory.py)
+import plab_inventory
  
-api_server = xmlrpclib.ServerProxy('https://www.planet-lab.org/PLCAPI/', allow_none=True)
- 
-# Create an empty dictionary (XML-RPC struct)
-auth = {"AuthMethod": "anonymous"}
- 
-all_nodes = api_server.GetNodes(auth, {}, ['hostname'])
- 
-# Create an array of string hostnames
-node_hostnames = [node['hostname'] for node in all_nodes]
+node_hostnames = plab_inventory.Inventory().ranked(all = True)
 f = file("nodes", "w+")
 for node in node_hostnames:
   f.write(node + "\n")
@@ -0,0 +1,234 @@
+#!/usr/bin/python
+usage = """usage:
+plab_probe [--path_to_nodes=<filename>] [--inventory=<filename>] [--api=<url>]
+  [--port=<number>] [--timeout=<seconds>] [--parallel=<number>]
+  [--cache=<filename>] [--max_age=<seconds>]
+plab_probe test = run the unit tests
+path_to_nodes = a new line delimited file of hosts to probe, optional, use the
+  hosts of the inventory, best first, if unspecified
+inventory = host inventory (see plab_inventory.py), default plab_inventory.db
+api = url of the PLC API the inventory is refreshed from
+port = port the stats app (node/server.py) is running on, if given get_stats
+  is called on responsive hosts
+timeout = seconds before a probe gives up, default 5
+parallel = number of hosts probed at once, default 128
+cache = file the results are kept in, default plab_probe.json
+max_age = results younger than this are taken from the cache, default 3600
+"""
+
+import sys, time, socket, getopt, json, httplib, xmlrpclib, plab_inventory, \
+  unittest
+from multiprocessing.pool import ThreadPool
+
+def main():
+  optlist, args = getopt.getopt(sys.argv[1:], "", ["path_to_nodes=", \
+    "inventory=", "api=", "port=", "timeout=", "parallel=", "cache=", "max_age="])
+
+  o_d = {}
+  for k,v in optlist:
+    o_d[k] = v
+
+  if args == ["test"]:
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestProbe)
+    unittest.TextTestRunner(verbosity=2).run(suite)
+    return
+
+  try:
+    if "--path_to_nodes" in o_d:
+      nodes = read_nodes(o_d["--path_to_nodes"])
+    else:
+      nodes = plab_inventory.Inventory(o_d.get("--inventory", \
+        "plab_inventory.db"), o_d.get("--api", plab_inventory.PLC_API)).ranked()
+    port = None
+    if "--port" in o_d:
+      port = int(o_d["--port"])
+    timeout = float(o_d.get("--timeout", 5))
+    parallel = int(o_d.get("--parallel", 128))
+    cache = o_d.get("--cache", "plab_probe.json")
+    max_age = float(o_d.get("--max_age", 3600))
+  except:
+    print usage
+    sys.exit()
+
+  results = probe_cached(nodes, cache, port, timeout, parallel, max_age)
+  alive, dead = order_nodes(nodes, results)
+  for node in alive:
+    res = results[node]
+    print "%s ssh=%.3fs stats=%s" % (node, res['ssh'], res.get('stats'))
+  for node in dead:
+    print "%s dead: %s" % (node, results[node].get('error'))
+  print "%i responsive, %i dead" % (len(alive), len(dead))
+
+def read_nodes(filename):
+  f = open(filename)
+  nodes = [line.rstrip('\n\r ') for line in f if line.strip()]
+  f.close()
+  return nodes
+
+# xmlrpclib has no timeout of its own
+class TimeoutTransport(xmlrpclib.Transport):
+  def __init__(self, timeout):
+    xmlrpclib.Transport.__init__(self)
+    self.timeout = timeout
+
+  def make_connection(self, host):
+    return httplib.HTTPConnection(host, timeout = self.timeout)
+
+# Probes a single host: the time to open a tcp connection to ssh and, if port
+# is given and ssh answered, the state of the stats app.
+def probe(node, port = None, timeout = 5, ssh_port = 22):
+  res = {'host' : node, 'time' : time.time(), 'ssh' : None}
+  try:
+    start = time.time()
+    s = socket.create_connection((node, ssh_port), timeout)
+    res['ssh'] = time.time() - start
+    s.close()
+  except Exception, e:
+    res['error'] = str(e)
+    return res
+  if port != None:
+    try:
+      server = xmlrpclib.ServerProxy('http://%s:%i' % (node, port), \
+        transport = TimeoutTransport(timeout))
+      stats = server.get_stats()
+      if 'dead' in stats:
+        res['stats'] = "dead"
+      else:
+        res['stats'] = "running"
+    except Exception:
+      res['stats'] = "unreachable"
+  return res
+
+def probe_all(nodes, port = None, timeout = 5, parallel = 128):
+  pool = ThreadPool(min(parallel, max(len(nodes), 1)))
+  try:
+    return dict([(res['host'], res) for res in \
+      pool.imap_unordered(lambda node: probe(node, port, timeout), nodes)])
+  finally:
+    pool.close()
+    pool.join()
+
+def load_cache(filename):
+  try:
+    f = open(filename)
+    cache = json.load(f)
+    f.close()
+    return cache
+  except Exception:
+    return {}
+
+def save_cache(cache, filename):
+  f = open(filename, "w")
+  json.dump(cache, f)
+  f.close()
+
+# Probes the nodes whose cached result is older than max_age and updates the
+# cache, returns the results of all the nodes.
+def probe_cached(nodes, cache_file = "plab_probe.json", port = None, timeout = 5, \
+  parallel = 128, max_age = 3600):
+  cache = load_cache(cache_file)
+  now = time.time()
+  stale = [node for node in nodes if node not in cache or \
+    now - cache[node]['time'] > max_age or \
+    (port != None and cache[node]['ssh'] != None and 'stats' not in cache[node])]
+  cache.update(probe_all(stale, port, timeout, parallel))
+  save_cache(cache, cache_file)
+  return dict([(node, cache[node]) for node in nodes])
+
+# Splits the nodes into the responsive ones, fastest ssh connect first, and the
+# dead ones.
+def order_nodes(nodes, results):
+  alive = [node for node in nodes if results[node]['ssh'] != None]
+  alive.sort(key = lambda node: results[node]['ssh'])
+  dead = [node for node in nodes if results[node]['ssh'] == None]
+  return alive, dead
+
+#############################
+# Here are the unit tests
+#############################
+
+class TestProbe(unittest.TestCase):
+  def setUp(self):
+    import tempfile, os
+    fd, self.cache = tempfile.mkstemp(".json")
+    os.close(fd)
+
+  def tearDown(self):
+    import os
+    os.remove(self.cache)
+
+  def testOrder(self):
+    results = {'a' : {'ssh' : 0.3}, 'b' : {'ssh' : None}, 'c' : {'ssh' : 0.1},
+      'd' : {'ssh' : None}, 'e' : {'ssh' : 0.2}}
+    self.assertEqual(order_nodes(['a', 'b', 'c', 'd', 'e'], results), \
+      (['c', 'e', 'a'], ['b', 'd']))
+    #only the nodes asked for
+    self.assertEqual(order_nodes(['d', 'a'], results), (['a'], ['d']))
+
+  def testProbe(self):
+    import SimpleXMLRPCServer, threading
+    listener = socket.socket()
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(5)
+    ssh_port = listener.getsockname()[1]
+    server = SimpleXMLRPCServer.SimpleXMLRPCServer(("127.0.0.1", 0), \
+      logRequests = False)
+    state = {}
+    server.register_function(lambda: state, "get_stats")
+    t = threading.Thread(target = server.serve_forever)
+    t.daemon = True
+    t.start()
+    port = server.server_address[1]
+    try:
+      res = probe("127.0.0.1", None, 1, ssh_port)
+      self.assertTrue(res['ssh'] >= 0)
+      self.assertFalse('stats' in res)
+      self.assertEqual(probe("127.0.0.1", port, 1, ssh_port)['stats'], "running")
+      state['dead'] = True
+      self.assertEqual(probe("127.0.0.1", port, 1, ssh_port)['stats'], "dead")
+      listener.close()
+      res = probe("127.0.0.1", port, 1, ssh_port)
+      self.assertEqual(res['ssh'], None)
+      self.assertTrue('error' in res and 'stats' not in res)
+    finally:
+      listener.close()
+      server.shutdown()
+      server.server_close()
+
+  def testCache(self):
+    now = time.time()
+    cache = {'fresh' : {'host' : 'fresh', 'time' : now - 10, 'ssh' : 0.1},
+      'old' : {'host' : 'old', 'time' : now - 7200, 'ssh' : 0.1},
+      'nostats' : {'host' : 'nostats', 'time' : now - 10, 'ssh' : 0.1},
+      'deadhost' : {'host' : 'deadhost', 'time' : now - 10, 'ssh' : None},
+      'other' : {'host' : 'other', 'time' : now - 7200, 'ssh' : 0.1}}
+    save_cache(cache, self.cache)
+    probed = []
+    global probe_all
+    real = probe_all
+    def _probe_all(nodes, port = None, timeout = 5, parallel = 128):
+      probed.append(sorted(nodes))
+      return dict([(n, {'host' : n, 'time' : now, 'ssh' : 0.5, 'stats' : "running"}) \
+        for n in nodes])
+    probe_all = _probe_all
+    try:
+      nodes = ['fresh', 'old', 'nostats', 'deadhost', 'new']
+      res = probe_cached(nodes, self.cache, None, max_age = 3600)
+      self.assertEqual(probed, [['new', 'old']])
+      self.assertEqual(sorted(res), sorted(nodes))
+      self.assertEqual(res['fresh'], cache['fresh'])
+      self.assertEqual(res['old']['time'], now)
+      #with a port the hosts probed without one are probed again, dead ones
+      #have no stats app to ask
+      res = probe_cached(nodes, self.cache, 8000, max_age = 3600)
+      self.assertEqual(probed[1], ['fresh', 'nostats'])
+      #everything expires
+      probe_cached(nodes, self.cache, None, max_age = 0)
+      self.assertEqual(probed[2], sorted(nodes))
+    finally:
+      probe_all = real
+    #the hosts not asked for stay in the cache
+    self.assertEqual(load_cache(self.cache)['other'], cache['other'])
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,261 @@
+#!/usr/bin/python
+usage = """usage:
+plab_timeline [--run=<id>] [--top=<number>] <timeline file>
+plab_timeline test
+prints, for a rollout recorded by plab_assistant, the latency distribution of
+each step, the slowest hosts and the critical path (the host that finished
+last and where its time went)
+run = the rollout to look at, default the last one in the file, all lists the
+  rollouts
+top = number of slowest hosts printed, default 10
+test = run the unit tests
+"""
+
+import os, sys, time, getopt, contextlib, unittest
+
+# a run's own events are recorded under this host
+ROLLOUT = "-"
+
+def main():
+  try:
+    optlist, args = getopt.getopt(sys.argv[1:], "", ["run=", "top="])
+    o_d = {}
+    for k,v in optlist:
+      o_d[k] = v
+    if args[0] == "test":
+      suite = unittest.TestLoader().loadTestsFromTestCase(TestTimeline)
+      unittest.TextTestRunner(verbosity=2).run(suite)
+      return
+    events = read_events(args[0])
+    top = int(o_d.get("--top", 10))
+  except:
+    print usage
+    sys.exit()
+
+  runs = split_runs(events)
+  if len(runs) == 0:
+    print "No events in " + args[0]
+    return
+  run = o_d.get("--run", runs[-1][0])
+  if run == "all":
+    for run, events in runs:
+      print "%s %s %i hosts" % (run, events[0][1], len(hosts(events)))
+    return
+  events = dict(runs).get(run)
+  if events == None:
+    print "No run " + run
+    return
+  report(run, events, top)
+
+# Each event is a line of run, action, host, step, start, seconds, ok separated
+# by tabs, written with a single append so forked children can share the file
+def record(filename, run, action, host, name, start, duration, ok):
+  line = "%s\t%s\t%s\t%s\t%.3f\t%.3f\t%i\n" % (run, action, host, name, start, \
+    duration, int(bool(ok)))
+  try:
+    fd = os.open(filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+    os.write(fd, line)
+    os.close(fd)
+  except OSError:
+    pass
+
+# Times the body of the with statement as a step, it fails if an exception
+# (SystemExit included) leaves the body.  Children forked in the body exit
+# through it too, only the process that entered it records the step.
+@contextlib.contextmanager
+def step(filename, run, action, host, name):
+  start = time.time()
+  pid = os.getpid()
+  ok = False
+  try:
+    yield
+    ok = True
+  finally:
+    if filename and os.getpid() == pid:
+      record(filename, run, action, host, name, start, time.time() - start, ok)
+
+def new_run():
+  return "%i.%i" % (time.time(), os.getpid())
+
+def read_events(filename):
+  events = []
+  f = open(filename)
+  for line in f:
+    fields = line.rstrip("\n").split("\t")
+    if len(fields) != 7:
+      continue
+    events.append((fields[0], fields[1], fields[2], fields[3], float(fields[4]), \
+      float(fields[5]), fields[6] == "1"))
+  f.close()
+  return events
+
+# [(run, events)] in the order the runs started
+def split_runs(events):
+  runs = {}
+  for e in events:
+    runs.setdefault(e[0], []).append(e)
+  return sorted(runs.items(), key = lambda r: min([e[4] for e in r[1]]))
+
+def hosts(events):
+  res = {}
+  for e in events:
+    if e[2] != ROLLOUT:
+      res.setdefault(e[2], []).append(e)
+  for host_events in res.values():
+    host_events.sort(key = lambda e: e[4])
+  return res
+
+def percentile(values, q):
+  values = sorted(values)
+  return values[int(q * (len(values) - 1))]
+
+def report(run, events, top = 10):
+  start = min([e[4] for e in events])
+  end = max([e[4] + e[5] for e in events])
+  by_host = hosts(events)
+  failed = [h for h in by_host if not by_host[h][-1][6]]
+  print "Run %s %s: %i hosts, %i failed, %.1f seconds" % (run, events[0][1], \
+    len(by_host), len(failed), end - start)
+
+  steps = {}
+  order = []
+  for e in sorted(events, key = lambda e: e[4]):
+    if e[2] == ROLLOUT:
+      continue
+    if e[3] not in steps:
+      order.append(e[3])
+    steps.setdefault(e[3], []).append(e)
+  print "%-10s %6s %5s %8s %8s %8s %8s %9s" % ("step", "count", "fail", "p50", \
+    "p90", "p99", "max", "total")
+  for name in order:
+    times = [e[5] for e in steps[name]]
+    print "%-10s %6i %5i %8.2f %8.2f %8.2f %8.2f %9.1f" % (name, len(times), \
+      len([e for e in steps[name] if not e[6]]), percentile(times, 0.5), \
+      percentile(times, 0.9), percentile(times, 0.99), max(times), sum(times))
+
+  print "Slowest hosts:"
+  spans = dict([(h, host_span(by_host[h])) for h in by_host])
+  for h in sorted(spans, key = lambda h: spans[h][1] - spans[h][0], reverse = True)[:top]:
+    print "  %s %.1fs %s" % (h, spans[h][1] - spans[h][0], format_steps(by_host[h]))
+
+  if len(by_host) > 0:
+    last = max(by_host, key = lambda h: spans[h][1])
+    print "Critical path, %s finished last:" % last
+    print "  waiting for a slot %.1fs" % (spans[last][0] - start)
+    prev = spans[last][0]
+    for e in by_host[last]:
+      if e[4] - prev > 0.5:
+        print "  between steps %.1fs" % (e[4] - prev)
+      print "  %s %.1fs%s" % (e[3], e[5], "" if e[6] else " failed")
+      prev = max(prev, e[4] + e[5])
+
+def host_span(events):
+  return min([e[4] for e in events]), max([e[4] + e[5] for e in events])
+
+def format_steps(events):
+  return " ".join(["%s=%.1f%s" % (e[3], e[5], "" if e[6] else "!") for e in events])
+
+#############################
+# Here are the unit tests
+#############################
+
+class TestTimeline(unittest.TestCase):
+  def setUp(self):
+    import tempfile
+    self.dir = tempfile.mkdtemp()
+    self.filename = os.path.join(self.dir, "timeline")
+
+  def tearDown(self):
+    import shutil
+    shutil.rmtree(self.dir)
+
+  def testRecord(self):
+    record(self.filename, "r1", "install", "a.org", "copy", 100, 2.5, True)
+    record(self.filename, "r1", "install", "b.org", "copy", 101, 4, 0)
+    f = open(self.filename, "a")
+    f.write("not an event\n")
+    f.close()
+    self.assertEqual(read_events(self.filename), \
+      [("r1", "install", "a.org", "copy", 100.0, 2.5, True), \
+       ("r1", "install", "b.org", "copy", 101.0, 4.0, False)])
+    #a file that can not be written loses the event, not the rollout
+    record(os.path.join(self.dir, "none", "timeline"), "r1", "install", \
+      "a.org", "copy", 100, 1, True)
+
+  def testStep(self):
+    with step(self.filename, "r1", "install", "a.org", "copy"):
+      pass
+    try:
+      with step(self.filename, "r1", "install", "a.org", "install"):
+        raise ValueError()
+    except ValueError:
+      pass
+    try:
+      with step(self.filename, "r1", "install", "a.org", "start"):
+        sys.exit(1)
+    except SystemExit:
+      pass
+    #without a file nothing is recorded
+    with step(None, "r1", "install", "a.org", "stop"):
+      pass
+    events = read_events(self.filename)
+    self.assertEqual([(e[3], e[6]) for e in events], \
+      [("copy", True), ("install", False), ("start", False)])
+
+  def testForkedStep(self):
+    parent = os.getpid()
+    def _body():
+      with step(self.filename, "r1", "install", "a.org", "fork"):
+        pid = os.fork()
+        if pid == 0:
+          #like a plab_assistant child, it leaves through the step
+          sys.exit(0)
+        os.waitpid(pid, 0)
+    try:
+      _body()
+    except SystemExit:
+      if os.getpid() != parent:
+        os._exit(0)
+      raise
+    events = read_events(self.filename)
+    self.assertEqual([(e[3], e[6]) for e in events], [("fork", True)])
+
+  def testRuns(self):
+    events = [("r2", "install", "b.org", "copy", 200.0, 1.0, True), \
+      ("r1", "install", "b.org", "install", 105.0, 1.0, True), \
+      ("r1", "install", "b.org", "copy", 101.0, 4.0, True), \
+      ("r1", "install", ROLLOUT, "rollout", 100.0, 6.0, True)]
+    runs = split_runs(events)
+    self.assertEqual([r[0] for r in runs], ["r1", "r2"])
+    self.assertEqual(len(runs[0][1]), 3)
+    by_host = hosts(runs[0][1])
+    self.assertEqual(by_host.keys(), ["b.org"])
+    self.assertEqual([e[3] for e in by_host["b.org"]], ["copy", "install"])
+
+  def testReport(self):
+    import StringIO
+    events = [("r1", "install", ROLLOUT, "rollout", 99.0, 12.0, True), \
+      ("r1", "install", "a.org", "copy", 100.0, 2.0, True), \
+      ("r1", "install", "a.org", "install", 102.0, 3.0, True), \
+      ("r1", "install", "b.org", "copy", 101.0, 4.0, True), \
+      ("r1", "install", "b.org", "install", 106.0, 4.0, False)]
+    out = StringIO.StringIO()
+    stdout = sys.stdout
+    sys.stdout = out
+    try:
+      report("r1", events)
+    finally:
+      sys.stdout = stdout
+    lines = [" ".join(line.split()) for line in out.getvalue().split("\n")]
+    self.assertEqual(lines[0], "Run r1 install: 2 hosts, 1 failed, 12.0 seconds")
+    self.assertEqual(lines[2], "copy 2 0 2.00 2.00 2.00 4.00 6.0")
+    self.assertEqual(lines[3], "install 2 1 3.00 3.00 3.00 4.00 7.0")
+    self.assertEqual(lines[5:7], ["b.org 9.0s copy=4.0 install=4.0!", \
+      "a.org 5.0s copy=2.0 install=3.0"])
+    #b.org finished last, started 2s in and waited 1s between its steps
+    self.assertEqual(lines[7:], ["Critical path, b.org finished last:", \
+      "waiting for a slot 2.0s", "copy 4.0s", "between steps 1.0s", \
+      "install 4.0s failed", ""])
+
+if __name__ == "__main__":
+  main()
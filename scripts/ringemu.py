@@ -0,0 +1,365 @@
+#!/usr/bin/python
+""" Emulates a Brunet ring behind the node XML-RPC surface so the python tools
+(crawl.py, the DHT scripts, collectors, ...) can be exercised and benchmarked
+against 10k-100k nodes without running BasicNode.  It answers localproxy,
+proxy and uriproxy for sys:link.GetNeighbors, Information.Info, the DhtClient
+Put/Get/BeginGet/ContinueGet/EndGet methods, dht.Get at a single replica,
+RpcDhtProxy.Register / Unregister and ncserver.Echo / ComputePathLatencyTo.
+They are served on /xm.rem, on /xm<i>.rem and /<address>.rem for a MultiNode
+of local nodes and xmserver.rem for listNodes.
+
+The ring is only a sorted list of addresses, the DHT is a single table shared
+by every node.  Calls that cross the overlay are delayed by a number of hops
+times the per hop latency, may be dropped, and nodes can be replaced at a
+given churn rate.  Requests are served by a thread each so slow calls do not
+hold up others. """
+import xmlrpclib, SimpleXMLRPCServer, SocketServer, pybru, dhtplace, sys, \
+  getopt, random, math, time, threading
+from bisect import bisect_left
+from routesim import ring_distance
+
+usage = """usage:
+python ringemu.py [--port=<port>] [--nodes=<count>] [--local=<count>]
+  [--hop_latency=<ms>] [--loss=<probability>] [--timeout=<seconds>]
+  [--churn=<nodes per second>] [--seed=<seed>]
+port = port to serve on, default 10000 like XmlRpcManager
+nodes = number of nodes in the ring, default 10000
+local = number of local nodes (MultiNode), served on xm<i>.rem, default 1
+hop_latency = latency added per overlay hop in ms, default 0
+loss = probability that an overlay call is lost, default 0
+timeout = seconds a lost call takes to fail, default 5
+churn = nodes replaced per second, default 0
+seed = random seed for the ring addresses"""
+
+RING = 2 ** 160
+# replicas per key, as in BasicNode
+DHT_DEGREE = 8
+
+def main():
+  try:
+    optlist, args = getopt.getopt(sys.argv[1:], "", ["port=", "nodes=", \
+      "local=", "hop_latency=", "loss=", "timeout=", "churn=", "seed="])
+    o_d = {}
+    for k,v in optlist:
+      o_d[k] = v
+    port = int(o_d.get("--port", 10000))
+    nodes = int(o_d.get("--nodes", 10000))
+    local = int(o_d.get("--local", 1))
+    hop_latency = float(o_d.get("--hop_latency", 0)) / 1000.0
+    loss = float(o_d.get("--loss", 0))
+    timeout = float(o_d.get("--timeout", 5))
+    churn = float(o_d.get("--churn", 0))
+    if "--seed" in o_d:
+      random.seed(int(o_d["--seed"]))
+  except:
+    print usage
+    return
+
+  ring = VirtualRing(nodes, local, hop_latency, loss, timeout)
+  if churn > 0:
+    ring.start_churn(churn)
+  server = make_server(ring, port)
+  print "Emulating %i nodes (%i local) on port %i" % (nodes, local, port)
+  server.serve_forever()
+
+def random_address():
+  #structured (class 0) addresses are always even
+  return random.randrange(0, RING, 2)
+
+class LostCall(Exception):
+  pass
+
+class VirtualRing:
+  """The overlay state, a sorted list of node addresses guarded by a lock,
+  the local nodes (never churned) and a single DHT table."""
+  def __init__(self, count, local = 1, hop_latency = 0, loss = 0, timeout = 5):
+    self.lock = threading.Lock()
+    addrs = set()
+    while len(addrs) < count:
+      addrs.add(random_address())
+    self.addrs = sorted(addrs)
+    self.local = random.sample(self.addrs, local)
+    self.hop_latency = hop_latency
+    self.loss = loss
+    self.timeout = timeout
+    #key -> {value : expiration time or None when registered}
+    self.dht = {}
+    #replica address -> key, for dht.Get at a single replica
+    self.replicas = {}
+    self.dht_lock = threading.Lock()
+    #BeginGet token -> list of pending results
+    self.gets = {}
+    self.token = 0
+
+  def size(self):
+    return len(self.addrs)
+
+  def find(self, addr):
+    """Index of the node closest to addr, where a message for it ends"""
+    i = bisect_left(self.addrs, addr)
+    n = len(self.addrs)
+    left = self.addrs[(i - 1) % n]
+    right = self.addrs[i % n]
+    if ring_distance(left, addr) < ring_distance(right, addr):
+      return (i - 1) % n
+    return i % n
+
+  def neighbors(self, addr):
+    with self.lock:
+      n = len(self.addrs)
+      i = self.find(addr)
+      res = {'self' : self.addrs[i]}
+      #right is the direction of decreasing address
+      if n > 1:
+        res['left'] = self.addrs[(i + 1) % n]
+        res['right'] = self.addrs[(i - 1) % n]
+      if n > 2:
+        res['left2'] = self.addrs[(i + 2) % n]
+        res['right2'] = self.addrs[(i - 2) % n]
+    for k in res:
+      res[k] = str(pybru.Address(res[k]))
+    return res
+
+  def info(self, addr):
+    neighbors = self.neighbors(addr)
+    num = long(pybru.Address(neighbors['self']))
+    ip = "10.%i.%i.%i" % ((num >> 16) & 0xFF, (num >> 8) & 0xFF, num & 0xFE)
+    return {'type' : "BasicNode", 'geo_loc' : ",", 'localips' : [ip],
+            'neighbors' : neighbors,
+            'cons' : 6 + int(math.log(self.size() + 1, 2))}
+
+  def overlay_delay(self):
+    """Sleeps for a greedy route worth of hops, raises LostCall on loss"""
+    if self.loss > 0 and random.random() < self.loss:
+      time.sleep(self.timeout)
+      raise LostCall()
+    if self.hop_latency > 0:
+      mean_hops = max(1.0, math.log(self.size(), 2) / 2)
+      time.sleep(self.hop_latency * random.uniform(1, 2 * mean_hops))
+
+  def dht_put(self, key, value, ttl, register = False):
+    with self.dht_lock:
+      if key not in self.dht:
+        for target in dhtplace.map_to_ring(key, DHT_DEGREE):
+          self.replicas[target] = key
+      values = self.dht.setdefault(key, {})
+      if register:
+        values[value] = None
+      elif values.get(value, 0) != None:
+        values[value] = time.time() + ttl
+    return True
+
+  def dht_remove(self, key, value):
+    with self.dht_lock:
+      values = self.dht.get(key, {})
+      return values.pop(value, 0) == None
+
+  def dht_get(self, key):
+    now = time.time()
+    res = []
+    with self.dht_lock:
+      values = self.dht.get(key, {})
+      for value, expires in values.items():
+        if expires == None:
+          ttl = 3600
+        elif expires < now:
+          del values[value]
+          continue
+        else:
+          ttl = int(expires - now)
+        res.append({'value' : xmlrpclib.Binary(value), 'ttl' : ttl})
+      if len(values) == 0:
+        self.dht.pop(key, None)
+    return res
+
+  def begin_get(self, key):
+    results = self.dht_get(key)
+    with self.dht_lock:
+      self.token += 1
+      token = str(self.token)
+      self.gets[token] = results
+    return xmlrpclib.Binary(token)
+
+  def continue_get(self, token):
+    with self.dht_lock:
+      results = self.gets.get(token)
+      if results == None:
+        raise ValueError("Invalid token")
+      if len(results) == 0:
+        return {}
+      return results.pop(0)
+
+  def end_get(self, token):
+    with self.dht_lock:
+      if self.gets.pop(token, None) == None:
+        raise ValueError("Invalid token")
+    return True
+
+  def latency(self, a, b):
+    """Milliseconds between two nodes, each placed at a point of a 300 x 300
+    plane picked by its address"""
+    pa = random.Random(a)
+    pb = random.Random(b)
+    return 1 + math.hypot(pa.random() * 300 - pb.random() * 300, \
+      pa.random() * 300 - pb.random() * 300)
+
+  def path_latency(self, addr, dest):
+    """ncserver.ComputePathLatencyTo from addr, each hop halves the distance
+    left in nodes"""
+    with self.lock:
+      n = len(self.addrs)
+      i = self.find(addr)
+      j = self.find(dest)
+      path = [self.addrs[i]]
+      while i != j:
+        d = (j - i) % n
+        if d > n / 2:
+          d -= n
+        if abs(d) > 1:
+          d = int(d / 2.0)
+        i = (i + d) % n
+        path.append(self.addrs[i])
+    hops = []
+    for a, b in zip(path, path[1:]):
+      hops.append({'node' : str(pybru.Address(a)), 'next_latency' : self.latency(a, b),
+                   'next_contype' : "structured.shortcut"})
+    hops.append({'node' : str(pybru.Address(path[-1]))})
+    return hops
+
+  def churn_once(self):
+    with self.lock:
+      while True:
+        i = random.randrange(len(self.addrs))
+        if self.addrs[i] not in self.local:
+          break
+      del self.addrs[i]
+      new = random_address()
+      j = bisect_left(self.addrs, new)
+      if j == len(self.addrs) or self.addrs[j] != new:
+        self.addrs.insert(j, new)
+
+  def start_churn(self, rate):
+    def _churn():
+      while True:
+        time.sleep(random.expovariate(rate))
+        self.churn_once()
+    t = threading.Thread(target = _churn)
+    t.daemon = True
+    t.start()
+
+  def call(self, addr, method, args, remote):
+    """Runs a Brunet rpc method at the node for addr.  remote is set when the
+    call crosses the overlay."""
+    if remote or method.startswith("DhtClient.") or \
+      method.startswith("RpcDhtProxy."):
+      self.overlay_delay()
+    if method == "sys:link.GetNeighbors":
+      return self.neighbors(addr)
+    elif method == "Information.Info":
+      return self.info(addr)
+    elif method in ("DhtClient.Put", "DhtClient.Create"):
+      key, value, ttl = args
+      if method == "DhtClient.Create" and len(self.dht_get(key.data)) > 0:
+        raise xmlrpclib.Fault(-32602, "Key already exists")
+      return self.dht_put(key.data, value.data, ttl)
+    elif method == "DhtClient.Get":
+      return self.dht_get(args[0].data)
+    elif method == "dht.Get":
+      #TableServer.Get at one replica: [values, remaining, token]
+      key = self.replicas.get(pybru.bytes_to_int(args[0].data))
+      values = []
+      if key != None:
+        values = self.dht_get(key)
+      return [values, 0, xmlrpclib.Binary("")]
+    elif method == "DhtClient.BeginGet":
+      return self.begin_get(args[0].data)
+    elif method == "DhtClient.ContinueGet":
+      return self.continue_get(args[0].data)
+    elif method == "DhtClient.EndGet":
+      return self.end_get(args[0].data)
+    elif method == "ncserver.Echo":
+      return []
+    elif method == "ncserver.ComputePathLatencyTo":
+      return self.path_latency(addr, long(pybru.Address(args[0])))
+    elif method == "RpcDhtProxy.Register":
+      key, value, ttl = args
+      return self.dht_put(key.data, value.data, ttl, True)
+    elif method == "RpcDhtProxy.Unregister":
+      key, value = args
+      return self.dht_remove(key.data, value.data)
+    raise xmlrpclib.Fault(-32601, "No Handler for method: " + method)
+
+class NodeProxy:
+  """The XmlRpcManager methods of one local node"""
+  def __init__(self, ring, addr):
+    self.ring = ring
+    self.addr = addr
+
+  def localproxy(self, method, *args):
+    try:
+      return self.ring.call(self.addr, method, args, False)
+    except LostCall:
+      #a local call that gets no result returns null, an empty string
+      return ""
+
+  def proxy(self, node, ah_options, max_results, method, *args):
+    try:
+      return [self.ring.call(long(pybru.Address(node)), method, args, True)]
+    except LostCall:
+      return []
+
+  def uriproxy(self, uri, max_results, method, *args):
+    if uri != "sender:localnode":
+      raise xmlrpclib.Fault(-32602, "Only sender:localnode is emulated")
+    return [self.localproxy(method, *args)]
+
+# The path of the request being handled by this thread
+_request = threading.local()
+
+class EmulatorRequestHandler(SimpleXMLRPCServer.SimpleXMLRPCRequestHandler):
+  #any path, the dispatcher picks the node from it
+  rpc_paths = ()
+  #keep alive so clients don't pay a connection per call
+  protocol_version = "HTTP/1.1"
+
+  def do_POST(self):
+    _request.path = self.path
+    SimpleXMLRPCServer.SimpleXMLRPCRequestHandler.do_POST(self)
+
+  def log_message(self, format, *args):
+    pass
+
+class EmulatorServer(SocketServer.ThreadingMixIn, \
+  SimpleXMLRPCServer.SimpleXMLRPCServer):
+  daemon_threads = True
+  allow_reuse_address = True
+  request_queue_size = 1024
+
+  def __init__(self, ring, port):
+    SimpleXMLRPCServer.SimpleXMLRPCServer.__init__(self, ('', port), \
+      EmulatorRequestHandler, logRequests = False, allow_none = False)
+    self.ring = ring
+    self.proxies = {}
+    for i in range(len(ring.local)):
+      proxy = NodeProxy(ring, ring.local[i])
+      self.proxies["/xm%i.rem" % i] = proxy
+      self.proxies["/%s.rem" % pybru.Address(ring.local[i])] = proxy
+    self.proxies["/xm.rem"] = self.proxies["/xm0.rem"]
+
+  def listNodes(self):
+    return [str(pybru.Address(a)) for a in self.ring.local]
+
+  def _dispatch(self, method, params):
+    path = getattr(_request, "path", "/xm.rem")
+    if path == "/xmserver.rem":
+      if method == "listNodes":
+        return self.listNodes()
+    elif path in self.proxies and method in ("localproxy", "proxy", "uriproxy"):
+      return getattr(self.proxies[path], method)(*params)
+    raise xmlrpclib.Fault(-32601, "No method %s at %s" % (method, path))
+
+def make_server(ring, port = 10000):
+  return EmulatorServer(ring, port)
+
+if __name__ == "__main__":
+  main()
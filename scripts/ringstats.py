@@ -0,0 +1,322 @@
+#!/usr/bin/python
+""" Computes ring wide statistics of Information.Info fields (cons, wedges, sas,
+...) with a map-reduce over a bounded broadcast tree.  Every node maps to a
+small summary of its own values (count, sum, min, max, a fixed bucket histogram
+and an approximate quantile sketch) and the summaries are merged at each level
+of the tree, so the initiator only receives the final aggregate.
+
+The map and reduce steps are implemented here in python and reached by the
+nodes through xmlrpc.AddXRHandler, so an agent must be running next to every
+node that takes part (mapreduce.AddHandler only accepts local callers).  Nodes
+without an agent show up as failed subtrees in the result. """
+import xmlrpclib, SimpleXMLRPCServer, SocketServer, pybru, sys, getopt, math, \
+  unittest, random
+
+usage = """usage:
+python ringstats.py agent [--port=<xmlrpc port>] [--nodes=<count>] [--listen=<port>]
+python ringstats.py collect [--port=<xmlrpc port>] [--metrics=<m1,m2,...>]
+  [--bounds=<b1,b2,...>] [--quantiles=<q1,q2,...>]
+python ringstats.py test
+agent = register the map and reduce handlers with the local node(s) and serve
+  them until killed
+collect = start the computation at the local node and print the aggregate
+port = the xmlrpc port for the local brunet node
+nodes = number of nodes in a local MultiNode, uses xm<i>.rem for each
+listen = port for the agent's xmlrpc server
+metrics = Information.Info fields to summarize, default cons,wedges,sas
+bounds = upper bounds of the histogram buckets, default 0,1,2,4,8,16,32,64
+quantiles = quantiles to print, default 0.5,0.9,0.99
+test = run the unit tests"""
+
+TASK_NAME = "pyringstats"
+HANDLER_NAME = "pyringstats"
+# the children of the bounded broadcast keep our task name, so every node runs
+# the python map and reduce
+BROADCAST_TREE = "mapreduce.tree:Brunet.Services.MapReduce.MapReduceBoundedBroadcast"
+DEFAULT_METRICS = ["cons", "wedges", "sas"]
+DEFAULT_BOUNDS = [0, 1, 2, 4, 8, 16, 32, 64]
+DEFAULT_QUANTILES = [0.5, 0.9, 0.99]
+# relative accuracy of the quantile sketch
+SKETCH_ALPHA = 0.02
+
+def main():
+  try:
+    action = sys.argv[1]
+    optlist, args = getopt.getopt(sys.argv[2:], "", ["port=", "nodes=", \
+      "listen=", "metrics=", "bounds=", "quantiles="])
+    o_d = {}
+    for k,v in optlist:
+      o_d[k] = v
+    port = int(o_d.get("--port", 10000))
+    if action == "agent":
+      nodes = None
+      if "--nodes" in o_d:
+        nodes = int(o_d["--nodes"])
+      listen = int(o_d.get("--listen", 30001))
+    elif action == "collect":
+      metrics = DEFAULT_METRICS
+      if "--metrics" in o_d:
+        metrics = o_d["--metrics"].split(",")
+      bounds = DEFAULT_BOUNDS
+      if "--bounds" in o_d:
+        bounds = [float(b) for b in o_d["--bounds"].split(",")]
+      quantiles = DEFAULT_QUANTILES
+      if "--quantiles" in o_d:
+        quantiles = [float(q) for q in o_d["--quantiles"].split(",")]
+    elif action != "test":
+      raise ValueError(action)
+  except:
+    print usage
+    return
+
+  if action == "agent":
+    agent(port, nodes, listen)
+  elif action == "collect":
+    res = collect(port, metrics, bounds)
+    print_summary(res, quantiles)
+  else:
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestRingStats)
+    unittest.TextTestRunner(verbosity=1).run(suite)
+
+#############################
+# Mergeable summaries, these are plain dicts and lists so they can be passed
+# through Brunet as xmlrpc values.  Dictionary keys must be strings.
+#############################
+
+def empty_summary():
+  return {'nodes' : 0, 'failed' : 0, 'metrics' : {}}
+
+def empty_metric(bounds):
+  return {'count' : 0, 'sum' : 0.0, 'min' : 0.0, 'max' : 0.0,
+          'bounds' : list(bounds), 'hist' : [0] * (len(bounds) + 1),
+          'sketch' : empty_sketch()}
+
+def empty_sketch(alpha = SKETCH_ALPHA):
+  return {'alpha' : alpha, 'zero' : 0, 'bins' : {}}
+
+def sketch_add(sketch, x, n = 1):
+  """Logarithmic buckets, any estimate is within alpha of the true value"""
+  if x <= 0:
+    sketch['zero'] += n
+    return
+  gamma = (1 + sketch['alpha']) / (1 - sketch['alpha'])
+  idx = str(int(math.ceil(math.log(x, gamma))))
+  sketch['bins'][idx] = sketch['bins'].get(idx, 0) + n
+
+def sketch_merge(a, b):
+  assert a['alpha'] == b['alpha'], "sketches must have the same accuracy"
+  res = empty_sketch(a['alpha'])
+  res['zero'] = a['zero'] + b['zero']
+  for bins in (a['bins'], b['bins']):
+    for idx, n in bins.iteritems():
+      res['bins'][idx] = res['bins'].get(idx, 0) + n
+  return res
+
+def sketch_quantile(sketch, q):
+  total = sketch['zero'] + sum(sketch['bins'].itervalues())
+  if total == 0:
+    return None
+  rank = q * (total - 1)
+  seen = sketch['zero']
+  if rank < seen:
+    return 0.0
+  gamma = (1 + sketch['alpha']) / (1 - sketch['alpha'])
+  for idx in sorted(int(i) for i in sketch['bins']):
+    seen += sketch['bins'][str(idx)]
+    if rank < seen:
+      return 2 * gamma ** idx / (gamma + 1)
+  return 2 * gamma ** idx / (gamma + 1)
+
+def metric_add(metric, x):
+  if metric['count'] == 0:
+    metric['min'] = x
+    metric['max'] = x
+  else:
+    metric['min'] = min(metric['min'], x)
+    metric['max'] = max(metric['max'], x)
+  metric['count'] += 1
+  metric['sum'] += x
+  bucket = 0
+  while bucket < len(metric['bounds']) and x > metric['bounds'][bucket]:
+    bucket += 1
+  metric['hist'][bucket] += 1
+  sketch_add(metric['sketch'], x)
+
+def metric_merge(a, b):
+  assert a['bounds'] == b['bounds'], "histograms must have the same buckets"
+  if a['count'] == 0:
+    return b
+  if b['count'] == 0:
+    return a
+  res = empty_metric(a['bounds'])
+  res['count'] = a['count'] + b['count']
+  res['sum'] = a['sum'] + b['sum']
+  res['min'] = min(a['min'], b['min'])
+  res['max'] = max(a['max'], b['max'])
+  res['hist'] = [x + y for x, y in zip(a['hist'], b['hist'])]
+  res['sketch'] = sketch_merge(a['sketch'], b['sketch'])
+  return res
+
+def summarize(info, metrics, bounds):
+  """Summary of a single node's Information.Info"""
+  res = empty_summary()
+  res['nodes'] = 1
+  for name in metrics:
+    metric = empty_metric(bounds)
+    if name in info:
+      metric_add(metric, float(info[name]))
+    res['metrics'][name] = metric
+  return res
+
+def merge(a, b):
+  res = empty_summary()
+  res['nodes'] = a['nodes'] + b['nodes']
+  res['failed'] = a['failed'] + b['failed']
+  for name in set(a['metrics']) | set(b['metrics']):
+    if name not in a['metrics']:
+      res['metrics'][name] = b['metrics'][name]
+    elif name not in b['metrics']:
+      res['metrics'][name] = a['metrics'][name]
+    else:
+      res['metrics'][name] = metric_merge(a['metrics'][name], b['metrics'][name])
+  return res
+
+def is_summary(res):
+  return isinstance(res, dict) and 'nodes' in res and 'metrics' in res
+
+#############################
+# Map-reduce glue
+#############################
+
+# The node calls map with the map_arg given to mapreduce.Start
+def make_map(node):
+  def _map(map_arg):
+    try:
+      info = node.localproxy("Information.Info")
+    except:
+      res = empty_summary()
+      res['failed'] = 1
+      return res
+    return summarize(info, map_arg['metrics'], map_arg['bounds'])
+  return _map
+
+# current_result is "" on the first reduction (Brunet sends null as an empty
+# string) and child is a dict with the sender and the result of the child.
+# Anything that isn't a summary is a failed child, we count it and go on.
+def reduce_summary(reduce_arg, current_result, child):
+  if not is_summary(current_result):
+    current_result = empty_summary()
+  result = child.get('result')
+  if not is_summary(result):
+    result = empty_summary()
+    result['failed'] = 1
+  return [merge(current_result, result), False]
+
+class ThreadedXMLRPCServer(SocketServer.ThreadingMixIn, \
+  SimpleXMLRPCServer.SimpleXMLRPCServer):
+  daemon_threads = True
+
+# Registers the handlers with the local node, or with every node of a local
+# MultiNode when count is given, and serves them forever.  Each node gets its
+# own map function so it summarizes its own Information.Info.
+def agent(port = 10000, count = None, listen = 30001):
+  server = ThreadedXMLRPCServer(('localhost', listen), logRequests = False, \
+    allow_none = True)
+  server_url = 'http://localhost:%i/RPC2' % listen
+  server.register_function(reduce_summary, 'reduce')
+
+  if count == None:
+    urls = ["http://127.0.0.1:%i/xm.rem" % port]
+  else:
+    urls = ["http://127.0.0.1:%i/xm%i.rem" % (port, i) for i in range(count)]
+
+  for i in range(len(urls)):
+    node = xmlrpclib.Server(urls[i])
+    mapfn = 'map%i' % i
+    server.register_function(make_map(node), mapfn)
+    try:
+      node.localproxy("xmlrpc.AddXRHandler", HANDLER_NAME, server_url)
+    except xmlrpclib.Fault:
+      #already registered from a previous run
+      pass
+    hnd = {'task_name' : TASK_NAME,
+           'map' : ['sender:localnode', '%s.%s' % (HANDLER_NAME, mapfn)],
+           'tree' : ['sender:localnode', BROADCAST_TREE],
+           'reduce' : ['sender:localnode', '%s.reduce' % HANDLER_NAME]}
+    try:
+      node.localproxy("mapreduce.AddHandler", hnd)
+    except xmlrpclib.Fault:
+      pass
+  server.serve_forever()
+
+# Starts the computation over the whole ring from the local node and returns
+# the merged summary.
+def collect(port = 10000, metrics = DEFAULT_METRICS, bounds = DEFAULT_BOUNDS):
+  rpc = xmlrpclib.Server("http://127.0.0.1:" + str(port) + "/xm.rem")
+  node = rpc.localproxy("sys:link.GetNeighbors")['self']
+  #the bounded broadcast covers [start, end), end just left of the start
+  end = pybru.Address((long(pybru.Address(node)) - 2) % (2 ** 160))
+  args = { 'task_name' : TASK_NAME,
+           'gen_arg' : str(end),
+           'map_arg' : {'metrics' : metrics, 'bounds' : bounds},
+           'reduce_arg' : "" }
+  return rpc.localproxy("mapreduce.Start", args)
+
+def print_summary(res, quantiles = DEFAULT_QUANTILES):
+  print "Nodes: %i, Failed: %i" % (res['nodes'], res['failed'])
+  for name in sorted(res['metrics']):
+    metric = res['metrics'][name]
+    if metric['count'] == 0:
+      print "%s: no values" % name
+      continue
+    print "%s: count=%i mean=%f min=%f max=%f" % (name, metric['count'], \
+      metric['sum'] / metric['count'], metric['min'], metric['max'])
+    print "  quantiles: " + ", ".join(["%g=%g" % (q, \
+      sketch_quantile(metric['sketch'], q)) for q in quantiles])
+    low = "-inf"
+    for bound, n in zip(metric['bounds'] + ["inf"], metric['hist']):
+      print "  (%s, %s]: %i" % (low, bound, n)
+      low = bound
+
+#############################
+# Here are the unit tests
+#############################
+
+class TestRingStats(unittest.TestCase):
+  def testMergeMatchesSingle(self):
+    """Merging per node summaries in any tree shape gives the same result"""
+    values = [random.randint(0, 100) for i in xrange(500)]
+    parts = [summarize({'cons' : v}, ['cons'], DEFAULT_BOUNDS) for v in values]
+    flat = reduce(merge, parts)
+    random.shuffle(parts)
+    while len(parts) > 1:
+      parts = [merge(*parts[i:i + 2]) if i + 1 < len(parts) else parts[i] \
+        for i in xrange(0, len(parts), 2)]
+    tree = parts[0]
+    for res in (flat, tree):
+      metric = res['metrics']['cons']
+      self.assertEqual(res['nodes'], 500)
+      self.assertEqual(metric['count'], 500)
+      self.assertEqual(metric['sum'], sum(values))
+      self.assertEqual(metric['min'], min(values))
+      self.assertEqual(metric['max'], max(values))
+      self.assertEqual(sum(metric['hist']), 500)
+    self.assertEqual(flat['metrics']['cons']['hist'], tree['metrics']['cons']['hist'])
+  def testSketchAccuracy(self):
+    values = sorted(random.uniform(1, 1000) for i in xrange(2000))
+    sketch = empty_sketch()
+    for v in values:
+      sketch_add(sketch, v)
+    for q in (0.1, 0.5, 0.9, 0.99):
+      exact = values[int(q * (len(values) - 1))]
+      self.assertTrue(abs(sketch_quantile(sketch, q) - exact) <= SKETCH_ALPHA * exact)
+  def testReduceFailedChild(self):
+    one = summarize({'cons' : 3}, ['cons'], DEFAULT_BOUNDS)
+    res, done = reduce_summary("", "", {'sender' : 'a', 'result' : one})
+    res, done = reduce_summary("", res, {'sender' : 'b', 'result' : "error"})
+    self.assertEqual(res['nodes'], 1)
+    self.assertEqual(res['failed'], 1)
+    self.assertFalse(done)
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,255 @@
+#!/usr/bin/python
+""" Simulates greedy structured routing offline over a crawl snapshot (see
+crawl.py --connections --output).  Each node forwards to its structured
+connection closest to the destination, as ConnectionList.GetNearestTo does,
+and the message stops at the first node with no closer connection.  Reports
+the hop count distribution, how many messages were delivered to the node
+closest to the destination, and the nodes carrying a disproportionate share of
+the forwarding. """
+import pybru, crawl, sys, getopt, random, math, unittest
+from bisect import bisect_left
+from array import array
+
+usage = """usage:
+python routesim.py [--pairs=<count>] [--uniform] [--top=<count>]
+  [--load_factor=<factor>] <crawl snapshot>
+python routesim.py test
+pairs = number of source / destination pairs to route, default 100000
+uniform = route to uniformly random addresses rather than to nodes
+top = number of the most loaded nodes to print, default 20
+load_factor = nodes forwarding more than this times the mean are reported,
+  default 3"""
+
+RING = 2 ** 160
+HALF_RING = 2 ** 159
+# a route longer than this is considered a loop
+MAX_HOPS = 256
+
+def main():
+  try:
+    optlist, args = getopt.getopt(sys.argv[1:], "", ["pairs=", "uniform", \
+      "top=", "load_factor="])
+    o_d = {}
+    for k,v in optlist:
+      o_d[k] = v
+    pairs = int(o_d.get("--pairs", 100000))
+    top = int(o_d.get("--top", 20))
+    load_factor = float(o_d.get("--load_factor", 3))
+    snapshot = args[0]
+  except:
+    print usage
+    return
+
+  if snapshot == "test":
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestRouteSim)
+    unittest.TextTestRunner(verbosity=2).run(suite)
+    return
+
+  ring = Ring(crawl.load_snapshot(snapshot))
+  res = ring.simulate(pairs, "--uniform" in o_d)
+  print_report(ring, res, top, load_factor)
+
+def ring_distance(a, b):
+  d = (a - b) % RING
+  if d > HALF_RING:
+    d = RING - d
+  return d
+
+class Ring:
+  """The overlay as parallel arrays indexed by the position of each node on the
+  ring.  Each node's connections are kept sorted by address so the nearest
+  connection to a destination is found with a binary search."""
+  def __init__(self, nodes):
+    self.addrs = sorted([long(pybru.Address(addr)) for addr in nodes])
+    self.names = [str(pybru.Address(a)) for a in self.addrs]
+    index = {}
+    for i in xrange(len(self.addrs)):
+      index[self.addrs[i]] = i
+    self.con_addrs = []
+    self.con_idx = []
+    self.shortcuts = 0
+    for name in self.names:
+      info = nodes[name]
+      if 'connections' in info:
+        cons = [con[0] for con in info['connections']]
+        self.shortcuts += len([con for con in info['connections'] \
+          if con[1].endswith("shortcut")])
+      else:
+        #an old snapshot, we only know the near neighbors
+        cons = [info[k] for k in ('left', 'right', 'left2', 'right2') if info[k]]
+      #connections to nodes missing from the snapshot are assumed gone
+      known = set()
+      for con in cons:
+        a = long(pybru.Address(con))
+        if a in index:
+          known.add(a)
+      known = sorted(known)
+      self.con_addrs.append(known)
+      self.con_idx.append(array('l', [index[a] for a in known]))
+
+  def closest_node(self, dest):
+    """The node that should receive messages for dest"""
+    i = bisect_left(self.addrs, dest)
+    n = len(self.addrs)
+    left = (i - 1) % n
+    right = i % n
+    if ring_distance(self.addrs[left], dest) < ring_distance(self.addrs[right], dest):
+      return left
+    return right
+
+  def next_hop(self, node, dest):
+    """Same as ConnectionList.GetNearestTo, None if no connection is closer"""
+    cons = self.con_addrs[node]
+    if len(cons) == 0:
+      return None
+    i = bisect_left(cons, dest)
+    if i < len(cons) and cons[i] == dest:
+      return self.con_idx[node][i]
+    right = i % len(cons)
+    left = i - 1
+    ld = ring_distance(cons[left], dest)
+    rd = ring_distance(cons[right], dest)
+    my_dist = ring_distance(self.addrs[node], dest)
+    if ld < rd and ld < my_dist:
+      return self.con_idx[node][left]
+    if rd < ld and rd < my_dist:
+      return self.con_idx[node][right]
+    return None
+
+  def route(self, src, dest, load):
+    """Routes from src to dest adding one to load for every node that
+    forwards, returns the hop count and the final node or None on a loop"""
+    node = src
+    hops = 0
+    while hops < MAX_HOPS:
+      next = self.next_hop(node, dest)
+      if next == None:
+        return hops, node
+      if hops > 0:
+        load[node] += 1
+      node = next
+      hops += 1
+    return hops, None
+
+  def simulate(self, pairs, uniform = False):
+    n = len(self.addrs)
+    load = array('l', [0] * n)
+    hop_counts = {}
+    delivered = 0
+    loops = 0
+    for i in xrange(pairs):
+      src = random.randrange(n)
+      if uniform:
+        dest = random.randrange(0, RING, 2)
+      else:
+        dest = self.addrs[random.randrange(n)]
+      hops, end = self.route(src, dest, load)
+      if end == None:
+        loops += 1
+        continue
+      hop_counts[hops] = hop_counts.get(hops, 0) + 1
+      if end == self.closest_node(dest):
+        delivered += 1
+    return {'pairs' : pairs, 'hops' : hop_counts, 'delivered' : delivered,
+            'loops' : loops, 'load' : load}
+
+def print_report(ring, res, top = 20, load_factor = 3):
+  n = len(ring.addrs)
+  cons = sum([len(c) for c in ring.con_addrs])
+  print "Nodes: %i, Connections: %i (%i shortcuts)" % (n, cons, ring.shortcuts)
+  print "Pairs: %i, Delivered: %i, Loops: %i" % (res['pairs'], \
+    res['delivered'], res['loops'])
+  routed = sum(res['hops'].itervalues())
+  if routed > 0:
+    total = sum([h * c for h, c in res['hops'].iteritems()])
+    print "Hop count: mean=%f (log2 n = %f)" % (total / float(routed), \
+      math.log(max(n, 2), 2))
+    seen = 0
+    for h in sorted(res['hops']):
+      seen += res['hops'][h]
+      print "  %i hops: %i (cdf %f)" % (h, res['hops'][h], seen / float(routed))
+  load = res['load']
+  mean = sum(load) / float(n)
+  print "Forwarding load: mean=%f max=%i" % (mean, max(load))
+  ranked = sorted(xrange(n), key = lambda i: load[i], reverse = True)
+  for i in ranked[:top]:
+    print "  %s %i (%.2f x mean, %i connections)" % (ring.names[i], load[i], \
+      load[i] / mean if mean > 0 else 0, len(ring.con_addrs[i]))
+  hot = [i for i in ranked if mean > 0 and load[i] > load_factor * mean]
+  print "Nodes over %g x mean load: %i" % (load_factor, len(hot))
+
+#############################
+# Here are the unit tests
+#############################
+
+class TestRouteSim(unittest.TestCase):
+  # 16 nodes evenly spaced, node k at k * STEP
+  STEP = RING / 16
+
+  def name(self, k):
+    return str(pybru.Address((k % 16) * self.STEP))
+
+  def setUp(self):
+    nodes = {}
+    for k in xrange(16):
+      cons = [(self.name(k + d), "structured.near") for d in (-2, -1, 1, 2)]
+      nodes[self.name(k)] = {'connections' : cons}
+    nodes[self.name(0)]['connections'].append((self.name(8), "structured.shortcut"))
+    #a connection to a node that is not in the snapshot
+    nodes[self.name(4)]['connections'].append((str(pybru.Address(2 ** 150)), \
+      "structured.shortcut"))
+    self.ring = Ring(nodes)
+
+  def testConnections(self):
+    self.assertEqual(self.ring.addrs, [k * self.STEP for k in xrange(16)])
+    self.assertEqual(list(self.ring.con_idx[0]), [1, 2, 8, 14, 15])
+    self.assertEqual(list(self.ring.con_idx[4]), [2, 3, 5, 6])
+    self.assertEqual(self.ring.shortcuts, 2)
+
+  def testNextHop(self):
+    hop = self.ring.next_hop
+    #a connection to the destination is used
+    self.assertEqual(hop(0, 1 * self.STEP), 1)
+    self.assertEqual(hop(0, 8 * self.STEP), 8)
+    #otherwise the closer of the connections either side of it
+    self.assertEqual(hop(0, 6 * self.STEP), 8)
+    self.assertEqual(hop(0, 3 * self.STEP), 2)
+    #around the top of the ring
+    self.assertEqual(hop(14, 2), 0)
+    self.assertEqual(hop(14, RING - 2), 0)
+    self.assertEqual(hop(1, RING - 2), 0)
+    #a tie between the two goes nowhere, like GetNearestTo
+    self.assertEqual(hop(0, 5 * self.STEP), None)
+    #and so does no connection closer than the node itself
+    self.assertEqual(hop(2, 2 * self.STEP + 2), None)
+    self.assertEqual(hop(6, 6 * self.STEP), None)
+
+  def testRoute(self):
+    load = array('l', [0] * 16)
+    self.assertEqual(self.ring.route(0, 6 * self.STEP, load), (2, 6))
+    #the source does not count as forwarding
+    self.assertEqual([k for k in xrange(16) if load[k] > 0], [8])
+    self.assertEqual(self.ring.route(3, 10 * self.STEP, load), (4, 10))
+    self.assertEqual([k for k in xrange(16) if load[k] > 0], [5, 7, 8, 9])
+    #halfway round connections either side tie
+    self.assertEqual(self.ring.route(3, 11 * self.STEP, load), (0, 3))
+    self.assertEqual(self.ring.route(0, 0, load), (0, 0))
+    self.assertEqual(self.ring.closest_node(6 * self.STEP + 2), 6)
+    self.assertEqual(self.ring.closest_node(RING - 2), 0)
+
+  def testOldSnapshot(self):
+    nodes = {}
+    for k in xrange(16):
+      nodes[self.name(k)] = {'left' : self.name(k + 1), 'right' : self.name(k - 1),
+        'left2' : self.name(k + 2), 'right2' : self.name(k - 2)}
+    ring = Ring(nodes)
+    self.assertEqual(ring.shortcuts, 0)
+    load = array('l', [0] * 16)
+    self.assertEqual(ring.route(0, 6 * self.STEP, load), (3, 6))
+    res = ring.simulate(200)
+    self.assertEqual(res['loops'], 0)
+    self.assertEqual(sum(res['hops'].values()), 200)
+    self.assertTrue(max(res['hops']) <= 4)
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,259 @@
+#!/usr/bin/python
+""" Measures the quality of structured routing from the local node.  Samples
+destination addresses, uniformly over the address space or from a crawl
+snapshot, and for each one concurrently calls trace.GetRouteTo and
+ncserver.ComputePathLatencyTo.  The direct latency to the end of the route is
+estimated from the Vivaldi coordinates of both ends (ncserver.EchoVivaldiState)
+to compute the latency stretch of the route.  Prints the hop count and stretch
+distributions and the routes that look pathological: loops, errors, routes
+ending at the wrong node, too many hops or too much stretch. """
+import xmlrpclib, rpcstats, pybru, crawl, sys, getopt, random, math, threading, \
+  json, unittest
+from multiprocessing.pool import ThreadPool
+
+usage = """usage:
+python routetrace.py [--port=<xmlrpc port>] [--count=<destinations>]
+  [--snapshot=<crawl snapshot>] [--parallel=<in flight calls>]
+  [--max_hops=<hops>] [--max_stretch=<stretch>] [--output=<filename>]
+python routetrace.py test
+port = the xmlrpc port for the local brunet node
+count = number of destinations to sample, default 1000
+snapshot = sample destinations from the nodes of a crawl snapshot (see
+  crawl.py --output) rather than uniformly from the address space
+parallel = maximum number of outstanding routes, default 32
+max_hops = routes longer than this are pathological, default 3 * log2(nodes)
+max_stretch = routes with more stretch are pathological, default 10
+output = write all the route results as json"""
+
+def main():
+  try:
+    optlist, args = getopt.getopt(sys.argv[1:], "", ["port=", "count=", \
+      "snapshot=", "parallel=", "max_hops=", "max_stretch=", "output="])
+    o_d = {}
+    for k,v in optlist:
+      o_d[k] = v
+    port = int(o_d.get("--port", 10000))
+    count = int(o_d.get("--count", 1000))
+    parallel = int(o_d.get("--parallel", 32))
+    max_stretch = float(o_d.get("--max_stretch", 10))
+    max_hops = None
+    if "--max_hops" in o_d:
+      max_hops = int(o_d["--max_hops"])
+    if args == ["test"]:
+      suite = unittest.TestLoader().loadTestsFromTestCase(TestRouteTrace)
+      unittest.TextTestRunner(verbosity=2).run(suite)
+      return
+  except:
+    print usage
+    return
+
+  nodes = None
+  if "--snapshot" in o_d:
+    nodes = crawl.load_snapshot(o_d["--snapshot"])
+    dests = sample_snapshot(nodes, count)
+  else:
+    dests = sample_uniform(count)
+  if max_hops == None:
+    #without a snapshot we do not know the size, assume a thousand nodes
+    size = len(nodes) if nodes else 1000
+    max_hops = int(3 * math.log(max(size, 2), 2))
+
+  results = trace_routes(port, dests, parallel)
+  bad = pathological(results, max_hops, max_stretch, nodes != None)
+  print_report(results, bad)
+  if "--output" in o_d:
+    f = open(o_d["--output"], "w")
+    json.dump(results, f)
+    f.close()
+
+def sample_uniform(count):
+  #structured (class 0) addresses are always even
+  return [str(pybru.Address(random.randrange(0, 2 ** 160, 2))) \
+    for i in xrange(count)]
+
+def sample_snapshot(nodes, count):
+  addrs = nodes.keys()
+  return [str(random.choice(addrs)) for i in xrange(count)]
+
+# Each thread keeps its own proxy, xmlrpclib connections aren't thread safe
+_local = threading.local()
+
+def get_rpc(port):
+  if not hasattr(_local, "rpc"):
+    _local.rpc = rpcstats.Server("http://127.0.0.1:" + str(port) + "/xm.rem")
+  return _local.rpc
+
+def coordinate_distance(s1, s2):
+  """Same as Point.GetEucledianDistance with heights"""
+  p1 = s1['position']
+  p2 = s2['position']
+  planar = math.sqrt(sum([(x - y) ** 2 for x, y in zip(p1['side'], p2['side'])]))
+  return planar + p1['height'] + p2['height']
+
+# Traces the route to a single destination, returns a dict with the path, hop
+# count, path latency, estimated direct latency and the stretch, or an error.
+def trace_route(port, source_state, dest):
+  rpc = get_rpc(port)
+  res = {'dest' : dest}
+  try:
+    route = rpc.localproxy("trace.GetRouteTo", dest)
+    res['path'] = [hop['node'] for hop in route]
+    res['hops'] = len(route) - 1
+    hops = rpc.localproxy("ncserver.ComputePathLatencyTo", dest)
+    latencies = [hop['next_latency'] for hop in hops if 'next_latency' in hop]
+    if len(latencies) > 0 and min(latencies) >= 0:
+      res['latency'] = sum(latencies)
+    if 'latency' in res and source_state != None:
+      end = res['path'][-1]
+      end_state = rpc.proxy(end, 3, 1, "ncserver.EchoVivaldiState")[0]
+      direct = coordinate_distance(source_state, end_state)
+      if direct > 0:
+        res['direct'] = direct
+        res['stretch'] = res['latency'] / direct
+  except Exception, e:
+    res['error'] = str(e)
+  return res
+
+def trace_routes(port, dests, parallel = 32):
+  rpc = get_rpc(port)
+  try:
+    source_state = rpc.localproxy("ncserver.EchoVivaldiState")
+  except:
+    #no coordinates, we only get hop counts and path latencies
+    source_state = None
+  def _trace(dest):
+    return trace_route(port, source_state, dest)
+  pool = ThreadPool(parallel)
+  try:
+    return list(pool.imap_unordered(_trace, dests))
+  finally:
+    pool.close()
+
+# exact means the destinations are node addresses, so routes must end there
+def pathological(results, max_hops, max_stretch, exact = False):
+  bad = []
+  for res in results:
+    reasons = []
+    if 'error' in res:
+      reasons.append("error: " + res['error'])
+    else:
+      path = res['path']
+      if len(set(path)) != len(path):
+        reasons.append("loop")
+      if res['hops'] > max_hops:
+        reasons.append("%i hops" % res['hops'])
+      if res.get('stretch', 0) > max_stretch:
+        reasons.append("stretch %.2f" % res['stretch'])
+      if exact and pybru.Address(res['dest']) != path[-1]:
+        reasons.append("ended at the wrong node")
+    if len(reasons) > 0:
+      bad.append((res, reasons))
+  return bad
+
+def percentile(values, q):
+  values = sorted(values)
+  return values[int(q * (len(values) - 1))]
+
+def print_report(results, bad):
+  good = [res for res in results if 'error' not in res]
+  print "Routes: %i, Errors: %i" % (len(results), len(results) - len(good))
+  if len(good) > 0:
+    hops = [res['hops'] for res in good]
+    print "Hop count: mean=%f p50=%i p90=%i p99=%i max=%i" % \
+      (sum(hops) / float(len(hops)), percentile(hops, 0.5), \
+      percentile(hops, 0.9), percentile(hops, 0.99), max(hops))
+    counts = {}
+    for h in hops:
+      counts[h] = counts.get(h, 0) + 1
+    for h in sorted(counts):
+      print "  %i hops: %i" % (h, counts[h])
+    stretch = [res['stretch'] for res in good if 'stretch' in res]
+    if len(stretch) > 0:
+      print "Stretch: mean=%f p50=%f p90=%f p99=%f max=%f (%i routes)" % \
+        (sum(stretch) / len(stretch), percentile(stretch, 0.5), \
+        percentile(stretch, 0.9), percentile(stretch, 0.99), max(stretch), \
+        len(stretch))
+  print "Pathological routes: %i" % len(bad)
+  for res, reasons in bad:
+    print "  %s: %s %s" % (res['dest'], ", ".join(reasons), \
+      " -> ".join(res.get('path', [])))
+
+#############################
+# Here are the unit tests
+#############################
+
+def _state(side, height):
+  return {'position' : {'side' : side, 'height' : height}}
+
+class FakeRpc:
+  """Answers the calls of trace_route from canned hops and states"""
+  def __init__(self, route, latencies, states):
+    self.route = route
+    self.latencies = latencies
+    self.states = states
+
+  def localproxy(self, method, *args):
+    if method == "trace.GetRouteTo":
+      return [{'node' : node} for node in self.route]
+    elif method == "ncserver.ComputePathLatencyTo":
+      hops = [{'node' : node, 'next_latency' : l} for (node, l) in \
+        zip(self.route, self.latencies)]
+      return hops + [{'node' : self.route[-1]}]
+    raise xmlrpclib.Fault(-32601, "No Handler for method: " + method)
+
+  def proxy(self, node, ahoptions, max_results, method, *args):
+    return [self.states[node]]
+
+class TestRouteTrace(unittest.TestCase):
+  NODES = [str(pybru.Address(2 * k)) for k in xrange(1, 5)]
+
+  def tearDown(self):
+    if hasattr(_local, "rpc"):
+      del _local.rpc
+
+  def testCoordinateDistance(self):
+    self.assertAlmostEqual(coordinate_distance(_state([0, 0], 0), \
+      _state([3, 4], 0)), 5)
+    #the heights of both ends are added
+    self.assertAlmostEqual(coordinate_distance(_state([0, 0], 1.5), \
+      _state([3, 4], 2)), 8.5)
+
+  def testTraceRoute(self):
+    a, b, c, d = self.NODES
+    _local.rpc = FakeRpc([a, b, c], [10.0, 20.0], {c : _state([6, 8], 0)})
+    res = trace_route(0, _state([0, 0], 5), c)
+    self.assertEqual(res['path'], [a, b, c])
+    self.assertEqual(res['hops'], 2)
+    self.assertEqual(res['latency'], 30.0)
+    self.assertAlmostEqual(res['direct'], 15)
+    self.assertAlmostEqual(res['stretch'], 2)
+    #without coordinates there is no stretch
+    res = trace_route(0, None, c)
+    self.assertEqual(res['latency'], 30.0)
+    self.assertFalse('stretch' in res)
+    #a hop that could not measure its latency leaves the path latency out
+    _local.rpc = FakeRpc([a, b, c], [10.0, -1], {})
+    res = trace_route(0, _state([0, 0], 5), c)
+    self.assertFalse('latency' in res or 'stretch' in res)
+    del _local.rpc.route
+    self.assertTrue('error' in trace_route(0, None, c))
+
+  def testPathological(self):
+    a, b, c, d = self.NODES
+    ok = {'dest' : d, 'path' : [a, b, d], 'hops' : 2, 'stretch' : 1.5}
+    results = [ok,
+      {'dest' : d, 'path' : [a, b, a, d], 'hops' : 3},
+      {'dest' : d, 'path' : [a, b, c], 'hops' : 2},
+      {'dest' : d, 'path' : [a, b, c, d], 'hops' : 3, 'stretch' : 12.0},
+      {'dest' : d, 'error' : "timed out"}]
+    bad = pathological(results, 2, 10)
+    self.assertEqual([reasons for (res, reasons) in bad], [["loop", "3 hops"], \
+      ["3 hops", "stretch 12.00"], ["error: timed out"]])
+    #with node destinations the route must end at the destination
+    bad = pathological(results, 5, 10, True)
+    self.assertEqual([reasons for (res, reasons) in bad], [["loop"], \
+      ["ended at the wrong node"], ["stretch 12.00"], ["error: timed out"]])
+    self.assertEqual(pathological([ok], 2, 1.5, True), [])
+
+if __name__ == "__main__":
+  main()
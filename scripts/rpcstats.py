@@ -0,0 +1,334 @@
+#!/usr/bin/python
+""" Instrumentation for the xmlrpc calls the python tools make to a brunet node.
+Scripts get their proxy from Server(url) rather than xmlrpclib.Server(url).
+While instrumentation is off that is a plain xmlrpclib.Server, so nothing is
+paid.  When it is on every call is recorded under the xmlrpc call (localproxy,
+proxy, uriproxy) and the brunet method it carries (Information.Info,
+DhtClient.Get, RpcDhtProxy.Register, ...):
+  latency histogram, time spent parsing the xml response, bytes sent and
+  received, faults, errors, timeouts (socket timeouts and proxy calls that got
+  no result back) and retries.
+Calls slower than a threshold are logged together with their target address.
+
+Instrumentation is turned on with enable() or, without touching a script, with
+environment variables read at import:
+  BRUNET_RPC_STATS = file to export to, .json for a snapshot otherwise the
+    Prometheus text format, written periodically and at exit
+  BRUNET_RPC_INTERVAL = seconds between exports, default 10
+  BRUNET_RPC_SLOW = log calls slower than this many seconds, default 1
+  BRUNET_RPC_RETRIES = times to retry a call that failed on the socket,
+    default 0
+  BRUNET_DHT_TRACE = record the DHT calls to this trace, each process to its
+    own segment file (see dhttrace.py)
+
+python rpcstats.py <file> prints an exported snapshot. """
+import xmlrpclib, xmlselect, socket, sys, os, time, threading, json, atexit, \
+  unittest
+
+usage = """usage:
+python rpcstats.py <snapshot.json>
+python rpcstats.py test"""
+
+# upper bounds of the latency histogram buckets in seconds
+BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, \
+  5.0, 10.0, 30.0]
+# the position of the brunet method in the arguments of each call
+METHOD_ARG = {'localproxy' : 0, 'uriproxy' : 2, 'proxy' : 3}
+
+def main():
+  try:
+    filename = sys.argv[1]
+  except:
+    print usage
+    return
+  if filename == "test":
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestRpcStats)
+    unittest.TextTestRunner(verbosity=1).run(suite)
+    return
+  f = open(filename)
+  print_snapshot(json.load(f))
+  f.close()
+
+def stderr_logger(msg):
+  sys.stderr.write(msg + "\n")
+
+class RpcStats:
+  """Thread safe counters for every (call, brunet method) pair"""
+  def __init__(self, slow = 1.0, logger = stderr_logger):
+    self.slow = slow
+    self.logger = logger
+    self.lock = threading.Lock()
+    self.methods = {}
+    self.started = time.time()
+    # functions called with every call, see notify
+    self.observers = []
+
+  def get(self, call, method):
+    key = call + " " + method
+    if key not in self.methods:
+      self.methods[key] = {'call' : call, 'method' : method, 'count' : 0,
+        'seconds' : 0.0, 'parse_seconds' : 0.0, 'max' : 0.0,
+        'buckets' : [0] * (len(BUCKETS) + 1), 'bytes_sent' : 0,
+        'bytes_received' : 0, 'faults' : 0, 'errors' : 0, 'timeouts' : 0,
+        'retries' : 0}
+    return self.methods[key]
+
+  def record(self, call, method, target, seconds, outcome = "ok", sent = 0, \
+    received = 0, parse = 0.0, retries = 0):
+    """outcome is one of ok, fault, error or timeout"""
+    with self.lock:
+      m = self.get(call, method)
+      m['count'] += 1
+      m['seconds'] += seconds
+      m['parse_seconds'] += parse
+      m['max'] = max(m['max'], seconds)
+      b = 0
+      while b < len(BUCKETS) and seconds > BUCKETS[b]:
+        b += 1
+      m['buckets'][b] += 1
+      m['bytes_sent'] += sent
+      m['bytes_received'] += received
+      m['retries'] += retries
+      if outcome != "ok":
+        m[outcome + "s"] += 1
+    if seconds >= self.slow:
+      self.logger("slow rpc: %s %s %s %.3fs %s" % (call, method, target or "-", \
+        seconds, outcome))
+
+  def notify(self, call, method, args, start, seconds, outcome, result = None):
+    """Passes a call to the observers, args are the brunet method's"""
+    for observer in self.observers:
+      observer(call, method, args, start, seconds, outcome, result)
+
+  def snapshot(self):
+    with self.lock:
+      methods = [dict(m, buckets = list(m['buckets'])) for m in self.methods.values()]
+    return {'time' : time.time(), 'started' : self.started, 'buckets' : BUCKETS,
+            'methods' : sorted(methods, key = lambda m: (m['call'], m['method']))}
+
+  def prometheus(self):
+    """The snapshot in the Prometheus text exposition format"""
+    snap = self.snapshot()
+    lines = ["# TYPE brunet_rpc_seconds histogram"]
+    for m in snap['methods']:
+      labels = 'call="%s",method="%s"' % (m['call'], m['method'])
+      total = 0
+      for i in xrange(len(BUCKETS)):
+        total += m['buckets'][i]
+        lines.append('brunet_rpc_seconds_bucket{%s,le="%g"} %i' % \
+          (labels, BUCKETS[i], total))
+      lines.append('brunet_rpc_seconds_bucket{%s,le="+Inf"} %i' % \
+        (labels, m['count']))
+      lines.append('brunet_rpc_seconds_sum{%s} %f' % (labels, m['seconds']))
+      lines.append('brunet_rpc_seconds_count{%s} %i' % (labels, m['count']))
+    for name, field in [("parse_seconds_total", 'parse_seconds'),
+      ("sent_bytes_total", 'bytes_sent'), ("received_bytes_total", 'bytes_received'),
+      ("faults_total", 'faults'), ("errors_total", 'errors'),
+      ("timeouts_total", 'timeouts'), ("retries_total", 'retries')]:
+      lines.append("# TYPE brunet_rpc_%s counter" % name)
+      for m in snap['methods']:
+        lines.append('brunet_rpc_%s{call="%s",method="%s"} %s' % (name, \
+          m['call'], m['method'], m[field]))
+    return "\n".join(lines) + "\n"
+
+  def export(self, filename):
+    """Writes a json snapshot or the Prometheus text, replacing the file at
+    once so a scraper never reads half of it"""
+    if filename.endswith(".json"):
+      data = json.dumps(self.snapshot())
+    else:
+      data = self.prometheus()
+    tmp = "%s.%i.tmp" % (filename, os.getpid())
+    f = open(tmp, "w")
+    f.write(data)
+    f.close()
+    os.rename(tmp, filename)
+
+class CountingTransport(xmlrpclib.Transport):
+  """Counts the bytes of the last request and response and the time spent in
+  the xml parser, select is the member paths to decode (see xmlselect.py)"""
+  def __init__(self, select = None):
+    xmlrpclib.Transport.__init__(self)
+    self.select = select
+
+  def request(self, host, handler, request_body, verbose = 0):
+    self.sent = len(request_body)
+    self.received = 0
+    self.parse = 0.0
+    return xmlrpclib.Transport.request(self, host, handler, request_body, verbose)
+
+  def getparser(self):
+    if self.select:
+      parser, unmarshaller = xmlselect.getparser(self.select)
+    else:
+      parser, unmarshaller = xmlrpclib.Transport.getparser(self)
+    return TimedParser(self, parser), unmarshaller
+
+class TimedParser:
+  def __init__(self, transport, parser):
+    self.transport = transport
+    self.parser = parser
+
+  def feed(self, data):
+    self.transport.received += len(data)
+    start = time.time()
+    self.parser.feed(data)
+    self.transport.parse += time.time() - start
+
+  def close(self):
+    start = time.time()
+    self.parser.close()
+    self.transport.parse += time.time() - start
+
+class InstrumentedServer(xmlrpclib.ServerProxy):
+  """A ServerProxy recording every call in stats, calls failing on the socket
+  are retried up to retries times"""
+  def __init__(self, url, stats, retries = 0, select = None, **kwargs):
+    self._transport = CountingTransport(select)
+    xmlrpclib.ServerProxy.__init__(self, url, transport = self._transport, **kwargs)
+    self._stats = stats
+    self._retries = retries
+
+  #replaces ServerProxy.__request which every method call goes through
+  def _ServerProxy__request(self, methodname, params):
+    method = methodname
+    target = None
+    args = params
+    if methodname in METHOD_ARG and len(params) > METHOD_ARG[methodname]:
+      method = str(params[METHOD_ARG[methodname]])
+      args = params[METHOD_ARG[methodname] + 1:]
+      if methodname == "proxy":
+        target = params[0]
+    attempt = 0
+    while True:
+      t = self._transport
+      t.sent = t.received = 0
+      t.parse = 0.0
+      start = time.time()
+      try:
+        res = xmlrpclib.ServerProxy._ServerProxy__request(self, methodname, params)
+      except xmlrpclib.Fault:
+        self._stats.record(methodname, method, target, time.time() - start, \
+          "fault", t.sent, t.received, t.parse, attempt)
+        self._stats.notify(methodname, method, args, start, time.time() - start, \
+          "fault")
+        raise
+      except (socket.error, xmlrpclib.ProtocolError), e:
+        outcome = "timeout" if isinstance(e, socket.timeout) else "error"
+        if attempt < self._retries:
+          attempt += 1
+          continue
+        self._stats.record(methodname, method, target, time.time() - start, \
+          outcome, t.sent, t.received, t.parse, attempt)
+        self._stats.notify(methodname, method, args, start, time.time() - start, \
+          outcome)
+        raise
+      outcome = "ok"
+      #a proxy call without any result timed out in the overlay
+      if methodname in ("proxy", "uriproxy") and res == []:
+        outcome = "timeout"
+      seconds = time.time() - start
+      self._stats.record(methodname, method, target, seconds, outcome, t.sent, \
+        t.received, t.parse, attempt)
+      self._stats.notify(methodname, method, args, start, seconds, outcome, res)
+      return res
+
+# the stats of this process, None while instrumentation is off
+_stats = None
+_retries = 0
+
+def enable(filename = None, interval = 10, slow = 1.0, retries = 0, \
+  logger = stderr_logger):
+  """Turns instrumentation on for proxies created from now on, if filename is
+  given the stats are exported there every interval seconds and at exit"""
+  global _stats, _retries
+  _stats = RpcStats(slow, logger)
+  _retries = retries
+  if filename:
+    stats = _stats
+    def _export():
+      while True:
+        time.sleep(interval)
+        stats.export(filename)
+    t = threading.Thread(target = _export)
+    t.daemon = True
+    t.start()
+    atexit.register(stats.export, filename)
+  return _stats
+
+def stats():
+  return _stats
+
+def Server(url, select = None, **kwargs):
+  """An xmlrpclib.Server for url, instrumented if enable has been called.  If
+  select is given only those member paths of the results are decoded."""
+  if _stats == None:
+    if select:
+      return xmlselect.Server(url, select, **kwargs)
+    return xmlrpclib.Server(url, **kwargs)
+  return InstrumentedServer(url, _stats, _retries, select, **kwargs)
+
+def print_snapshot(snap):
+  print "%-12s %-36s %8s %9s %9s %9s %6s %6s %6s %6s" % ("call", "method", \
+    "count", "mean ms", "max ms", "parse ms", "fault", "error", "tmout", "retry")
+  for m in snap['methods']:
+    count = max(m['count'], 1)
+    print "%-12s %-36s %8i %9.2f %9.2f %9.2f %6i %6i %6i %6i" % (m['call'], \
+      m['method'], m['count'], 1000 * m['seconds'] / count, 1000 * m['max'], \
+      1000 * m['parse_seconds'] / count, m['faults'], m['errors'], \
+      m['timeouts'], m['retries'])
+
+if "BRUNET_RPC_STATS" in os.environ:
+  enable(os.environ["BRUNET_RPC_STATS"], \
+    float(os.environ.get("BRUNET_RPC_INTERVAL", 10)), \
+    float(os.environ.get("BRUNET_RPC_SLOW", 1)), \
+    int(os.environ.get("BRUNET_RPC_RETRIES", 0)))
+if "BRUNET_DHT_TRACE" in os.environ:
+  import dhttrace
+  dhttrace.enable(os.environ["BRUNET_DHT_TRACE"])
+
+#############################
+# Here are the unit tests
+#############################
+
+class TestRpcStats(unittest.TestCase):
+  def testRecord(self):
+    logged = []
+    stats = RpcStats(0.5, logged.append)
+    stats.record("proxy", "Information.Info", "brunet:node:A", 0.002, "ok", 100, 400)
+    stats.record("proxy", "Information.Info", "brunet:node:B", 0.7, "timeout")
+    snap = stats.snapshot()
+    self.assertEqual(len(snap['methods']), 1)
+    m = snap['methods'][0]
+    self.assertEqual(m['count'], 2)
+    self.assertEqual(m['timeouts'], 1)
+    self.assertEqual(m['bytes_received'], 400)
+    self.assertEqual(sum(m['buckets']), 2)
+    self.assertEqual(len(logged), 1)
+    self.assertTrue("brunet:node:B" in logged[0])
+    text = stats.prometheus()
+    self.assertTrue('brunet_rpc_seconds_count{call="proxy",method="Information.Info"} 2' in text)
+    self.assertTrue('le="+Inf"} 2' in text)
+  def testInstrumentedServer(self):
+    import SimpleXMLRPCServer
+    class Handler(SimpleXMLRPCServer.SimpleXMLRPCRequestHandler):
+      rpc_paths = ('/xm.rem',)
+    server = SimpleXMLRPCServer.SimpleXMLRPCServer(("127.0.0.1", 0), Handler, \
+      logRequests = False)
+    server.register_function(lambda method, *args: "x" * 1000, "localproxy")
+    server.register_function(lambda *args: [], "proxy")
+    t = threading.Thread(target = server.serve_forever)
+    t.daemon = True
+    t.start()
+    stats = RpcStats(10)
+    rpc = InstrumentedServer("http://127.0.0.1:%i/xm.rem" % server.server_address[1], stats)
+    rpc.localproxy("DhtClient.Get", xmlrpclib.Binary("key"))
+    rpc.proxy("brunet:node:A", 3, 1, "Information.Info")
+    server.shutdown()
+    methods = dict([(m['method'], m) for m in stats.snapshot()['methods']])
+    self.assertTrue(methods['DhtClient.Get']['bytes_received'] > 1000)
+    self.assertTrue(methods['DhtClient.Get']['bytes_sent'] > 0)
+    self.assertEqual(methods['Information.Info']['timeouts'], 1)
+
+if __name__ == "__main__":
+  main()
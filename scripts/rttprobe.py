@@ -0,0 +1,528 @@
+#!/usr/bin/python
+""" Measures the round trip times between the nodes of our own ring for the
+coordinate experiments (tests/coordinate), in place of the synthetic clusters
+of generate_rtt.py.
+
+A probe asks node i, through proxy on the local node, for
+ncserver.ComputePathLatencyTo node j.  Every hop of the structured route
+reports next_latency, the latency its node measured to the next hop
+(NCService.cs), and consecutive hops are always connected.  So the matrix
+only covers the edges of the overlay: i and j themselves are measured only
+when they are neighbours, and most pairs are never measured however long the
+campaign runs.  To find edges not measured yet the sources and destinations
+are drawn preferring the nodes with the fewest measured edges, as a route
+always crosses an edge of each, skipping the pairs probed already.  Probes run
+concurrently from one asyncbru.py loop within a budget of probes, a rate
+limit and limits on the probes in flight in total and per source node.
+
+A campaign is kept in files sharing a prefix:
+  <prefix>.nodes    the node addresses, the line number is the node's index
+  <prefix>.samples  every sample as "i j rtt", appended as they come in
+  <prefix>.probes   every probe as "i j ok", appended when it is done
+  <prefix>.matrix   with --dense, the memory mapped upper triangle of the
+                    matrix as float32, -1 for pairs without a sample (all but
+                    the overlay edges)
+Probing again with the same prefix resumes the campaign: the node list is
+kept, the probes done count against the budget and are not repeated, and the
+matrix is brought up to date from the samples.  The matrix holds the smallest
+sample of each pair, the one with the least queueing in it, in a dict unless
+--dense is given.  export writes it as "i j rtt" lines, the format of
+generate_rtt.py, for NCTester -e, which takes the measured pairs as the
+neighbours of each node and samples only those.  NCTester -l is no use here,
+it assumes a complete matrix and would train on the -1 of unmeasured pairs. """
+import asyncbru, crawl, pybru, sys, os, getopt, mmap, array, struct, random, \
+  collections, time, unittest
+
+usage = """usage:
+python rttprobe.py probe [--port=<xmlrpc port>] [--snapshot=<crawl snapshot>]
+  [--budget=<probes>] [--rate=<probes/s>] [--parallel=<in flight probes>]
+  [--per_node=<in flight probes per node>] [--timeout=<seconds>] [--dense]
+  [--seed=<seed>] <prefix>
+python rttprobe.py status <prefix>
+python rttprobe.py export <prefix> [<output file>]
+python rttprobe.py test
+probe = start or resume the campaign with files named <prefix>.*
+port = the xmlrpc port for the local brunet node
+snapshot = probe the nodes of a crawl snapshot (see crawl.py --output), by
+  default the nodes of crawl.latest, only used when the campaign starts
+budget = total probes of the campaign, default 10 per node
+rate = maximum probes started per second, default 50, 0 for no limit
+parallel = maximum probes in flight, default 64
+per_node = maximum probes in flight from one node, default 2
+timeout = seconds before a probe is given up, default 60
+dense = keep the matrix in a memory mapped file rather than a dict
+seed = random seed for the pairs
+status = print the progress of a campaign
+export = write the matrix, to stdout without a file, as input for NCTester -e
+the matrix only holds the rtts of overlay edges, pairs of connected nodes"""
+
+def main():
+  try:
+    action = sys.argv[1]
+    optlist, args = getopt.getopt(sys.argv[2:], "", ["port=", "snapshot=", \
+      "budget=", "rate=", "parallel=", "per_node=", "timeout=", "dense", "seed="])
+    o_d = {}
+    for k,v in optlist:
+      o_d[k] = v
+    if action == "test":
+      suite = unittest.TestLoader().loadTestsFromTestCase(TestRttProbe)
+      unittest.TextTestRunner(verbosity=1).run(suite)
+      return
+    prefix = args[0]
+    port = int(o_d.get("--port", 10000))
+    rate = float(o_d.get("--rate", 50))
+    parallel = int(o_d.get("--parallel", 64))
+    per_node = int(o_d.get("--per_node", 2))
+    timeout = float(o_d.get("--timeout", 60))
+    seed = None
+    if "--seed" in o_d:
+      seed = int(o_d["--seed"])
+    if action not in ("probe", "status", "export"):
+      raise ValueError(action)
+  except:
+    print usage
+    return
+
+  if action == "status":
+    print_status(Campaign(prefix))
+    return
+  elif action == "export":
+    campaign = Campaign(prefix)
+    out = sys.stdout
+    if len(args) > 1:
+      out = open(args[1], "w")
+    count = export(campaign.matrix, out)
+    out.close()
+    n = len(campaign.nodes)
+    sys.stderr.write("%i of %i pairs, only overlay edges are measured, use " \
+      "NCTester -e, not -l\n" % (count, n * (n - 1) / 2))
+    return
+
+  nodes = None
+  if not os.path.exists(prefix + ".nodes"):
+    if "--snapshot" in o_d:
+      nodes = crawl.load_snapshot(o_d["--snapshot"]).keys()
+    else:
+      nodes = crawl.latest(port).keys()
+  campaign = Campaign(prefix, nodes, "--dense" in o_d)
+  budget = int(o_d.get("--budget", 10 * len(campaign.nodes)))
+  client = asyncbru.Client(port, connections = parallel)
+  prober = Prober(client, campaign, budget, rate, per_node, timeout, seed, \
+    crawl.print_logger)
+  prober.run()
+  print_status(campaign)
+  campaign.close()
+
+def pair(i, j):
+  if i < j:
+    return (i, j)
+  return (j, i)
+
+class SparseMatrix:
+  """The smallest sample of each measured pair in a dict"""
+  def __init__(self):
+    self.rtts = {}
+
+  def add(self, i, j, rtt):
+    """Returns True if i and j had no sample before"""
+    p = pair(i, j)
+    old = self.rtts.get(p, -1.0)
+    if old < 0 or rtt < old:
+      self.rtts[p] = rtt
+    return old < 0
+
+  def get(self, i, j):
+    """The rtt of i and j, -1 if they were not measured"""
+    return self.rtts.get(pair(i, j), -1.0)
+
+  def items(self):
+    """((i, j), rtt) with i < j in order"""
+    return sorted(self.rtts.items())
+
+  def measured(self):
+    return len(self.rtts)
+
+  def close(self):
+    pass
+
+class DenseMatrix:
+  """The smallest sample of each pair in the upper triangle of a n x n
+  float32 matrix, row by row, in a memory mapped file"""
+  ROW = 65536
+
+  def __init__(self, filename, n):
+    self.n = n
+    size = 4 * (n * (n - 1) / 2)
+    if not os.path.exists(filename) or os.path.getsize(filename) != size:
+      f = open(filename, "wb")
+      left = size / 4
+      missing = array.array('f', [-1.0]) * self.ROW
+      while left > 0:
+        missing[:min(left, self.ROW)].tofile(f)
+        left -= self.ROW
+      f.close()
+    self.file = open(filename, "r+b")
+    self.data = None
+    if size > 0:
+      self.data = mmap.mmap(self.file.fileno(), size)
+
+  def offset(self, i, j):
+    (i, j) = pair(i, j)
+    return 4 * (i * self.n - i * (i + 1) / 2 + j - i - 1)
+
+  def add(self, i, j, rtt):
+    pos = self.offset(i, j)
+    old = struct.unpack_from("f", self.data, pos)[0]
+    if old < 0 or rtt < old:
+      struct.pack_into("f", self.data, pos, rtt)
+    return old < 0
+
+  def get(self, i, j):
+    return struct.unpack_from("f", self.data, self.offset(i, j))[0]
+
+  def row(self, i):
+    values = array.array('f')
+    start = self.offset(i, i + 1)
+    values.fromstring(self.data[start:start + 4 * (self.n - i - 1)])
+    return values
+
+  def items(self):
+    for i in xrange(self.n - 1):
+      values = self.row(i)
+      if values.count(-1.0) == len(values):
+        continue
+      for k in xrange(len(values)):
+        if values[k] >= 0:
+          yield ((i, i + 1 + k), values[k])
+
+  def measured(self):
+    count = 0
+    for i in xrange(self.n - 1):
+      values = self.row(i)
+      count += len(values) - values.count(-1.0)
+    return count
+
+  def close(self):
+    if self.data != None:
+      self.data.flush()
+      self.data.close()
+    self.file.close()
+
+class Campaign:
+  """The nodes, probes and samples of a campaign and its matrix, read back
+  from the files when resuming"""
+  def __init__(self, prefix, nodes = None, dense = False):
+    self.prefix = prefix
+    if os.path.exists(prefix + ".nodes"):
+      f = open(prefix + ".nodes")
+      self.nodes = [line.strip() for line in f if line.strip()]
+      f.close()
+    elif nodes == None:
+      raise ValueError("No campaign " + prefix)
+    else:
+      self.nodes = sorted([str(n) for n in nodes], \
+        key = lambda n: long(pybru.Address(n)))
+      f = open(prefix + ".nodes", "w")
+      f.write("".join([n + "\n" for n in self.nodes]))
+      f.close()
+    self.index = dict([(n, i) for (i, n) in enumerate(self.nodes)])
+    if dense or os.path.exists(prefix + ".matrix"):
+      self.matrix = DenseMatrix(prefix + ".matrix", len(self.nodes))
+    else:
+      self.matrix = SparseMatrix()
+    # pairs probed or being probed
+    self.probed = set()
+    # the number of measured edges of each node
+    self.edges = [0] * len(self.nodes)
+    self.done = self.failed = self.samples = 0
+    for (i, j, ok) in self.read(".probes"):
+      self.probed.add(pair(int(i), int(j)))
+      self.done += 1
+      if ok == "0":
+        self.failed += 1
+    for (i, j, rtt) in self.read(".samples"):
+      self.add_sample(int(i), int(j), float(rtt))
+      self.samples += 1
+    self.probe_file = open(prefix + ".probes", "a")
+    self.sample_file = open(prefix + ".samples", "a")
+
+  def read(self, suffix):
+    if not os.path.exists(self.prefix + suffix):
+      return []
+    f = open(self.prefix + suffix)
+    #a line cut short by an interrupted run is dropped
+    lines = [line.split() for line in f if line.endswith("\n")]
+    f.close()
+    return [fields for fields in lines if len(fields) == 3]
+
+  def add_sample(self, i, j, rtt):
+    if self.matrix.add(i, j, rtt):
+      self.edges[i] += 1
+      self.edges[j] += 1
+
+  def pick(self, rng, tries = 4):
+    """A random node, the one with the fewest measured edges of tries draws"""
+    n = len(self.nodes)
+    best = rng.randrange(n)
+    for k in xrange(tries - 1):
+      i = rng.randrange(n)
+      if self.edges[i] < self.edges[best]:
+        best = i
+    return best
+
+  def pairs(self, rng):
+    """Pairs not probed yet whose ends have few measured edges, until they
+    get too hard to find"""
+    n = len(self.nodes)
+    misses = 0
+    while n > 1 and misses < 20 * n:
+      i = self.pick(rng)
+      j = self.pick(rng)
+      if i == j or pair(i, j) in self.probed:
+        misses += 1
+        continue
+      misses = 0
+      yield (i, j)
+
+  def add_probe(self, i, j, hops):
+    """Records a probe from i to j, hops is None if it failed, returns the
+    number of samples it gave"""
+    lines = []
+    if hops != None:
+      for hop, next in zip(hops, hops[1:]):
+        a = self.index.get(str(hop['node']))
+        b = self.index.get(str(next['node']))
+        rtt = hop.get('next_latency', -1)
+        if a == None or b == None or a == b or rtt < 0:
+          continue
+        self.add_sample(a, b, rtt)
+        lines.append("%i %i %f\n" % (a, b, rtt))
+    #the samples go first, a probe without its samples is made again
+    self.sample_file.write("".join(lines))
+    self.sample_file.flush()
+    self.probe_file.write("%i %i %i\n" % (i, j, int(hops != None)))
+    self.probe_file.flush()
+    self.probed.add(pair(i, j))
+    self.done += 1
+    self.samples += len(lines)
+    if hops == None:
+      self.failed += 1
+    return len(lines)
+
+  def close(self):
+    self.probe_file.close()
+    self.sample_file.close()
+    self.matrix.close()
+
+class Prober:
+  """Runs the probes of a campaign until it has made budget probes or runs
+  out of pairs"""
+  def __init__(self, client, campaign, budget, rate = 50, per_node = 2, \
+    timeout = 60, seed = None, logger = crawl.null_logger, interval = 10):
+    self.client = client
+    self.campaign = campaign
+    self.budget = budget
+    self.rate = rate
+    self.per_node = per_node
+    self.timeout = timeout
+    self.rng = random.Random(seed)
+    self.logger = logger
+    self.interval = interval
+
+  def run(self):
+    loop = self.client.loop
+    campaign = self.campaign
+    pairs = campaign.pairs(self.rng)
+    # pairs drawn while their source was busy
+    waiting = collections.deque()
+    busy = collections.defaultdict(int)
+    state = {'in_flight' : 0, 'next' : time.time(), 'timer' : None,
+             'report' : None}
+
+    def _next_pair():
+      for k in xrange(len(waiting)):
+        (i, j) = waiting.popleft()
+        if pair(i, j) in campaign.probed:
+          #drawn again as (j, i) and probed meanwhile
+          continue
+        if busy[i] < self.per_node:
+          return (i, j)
+        waiting.append((i, j))
+      while len(waiting) < len(campaign.nodes):
+        try:
+          (i, j) = pairs.next()
+        except StopIteration:
+          return None
+        if busy[i] < self.per_node:
+          return (i, j)
+        waiting.append((i, j))
+      return None
+
+    def _finish(i, j, call):
+      state['in_flight'] -= 1
+      busy[i] -= 1
+      hops = None
+      if call.error == None:
+        hops = call.result()
+      campaign.add_probe(i, j, hops)
+      _feed()
+
+    def _feed():
+      state['timer'] = None
+      while campaign.done + state['in_flight'] < self.budget and \
+        state['in_flight'] < self.client.connections:
+        now = time.time()
+        if self.rate > 0 and state['next'] > now:
+          state['timer'] = loop.call_at(state['next'], _feed)
+          return
+        p = _next_pair()
+        if p == None:
+          return
+        (i, j) = p
+        campaign.probed.add(pair(i, j))
+        state['in_flight'] += 1
+        busy[i] += 1
+        if self.rate > 0:
+          state['next'] = max(state['next'], now - 1) + 1.0 / self.rate
+        call = self.client.path_latency(campaign.nodes[i], campaign.nodes[j], \
+          timeout = self.timeout)
+        call.add_callback(lambda call, i = i, j = j: _finish(i, j, call))
+
+    def _report():
+      self.logger("%i/%i probes, %i failed, %i samples, %i pairs measured" % \
+        (campaign.done, self.budget, campaign.failed, campaign.samples, \
+        campaign.matrix.measured()))
+      state['report'] = loop.call_at(time.time() + self.interval, _report)
+
+    state['report'] = loop.call_at(time.time() + self.interval, _report)
+    _feed()
+    #with nothing in flight or waiting for the rate limit no more probes
+    #can be made
+    loop.run(lambda: state['in_flight'] == 0 and state['timer'] == None)
+    loop.cancel_timer(state['report'])
+
+def export(matrix, out):
+  """Writes the measured pairs, returns how many"""
+  count = 0
+  for ((i, j), rtt) in matrix.items():
+    out.write("%i %i %f\n" % (i, j, rtt))
+    count += 1
+  return count
+
+def percentile(values, q):
+  values = sorted(values)
+  return values[int(q * (len(values) - 1))]
+
+def print_status(campaign):
+  n = len(campaign.nodes)
+  rtts = [rtt for (p, rtt) in campaign.matrix.items()]
+  pairs = max(n * (n - 1) / 2, 1)
+  print "%i nodes, %i probes, %i failed, %i samples" % (n, campaign.done, \
+    campaign.failed, campaign.samples)
+  print "%i of %i pairs measured (%.2f%%), only overlay edges are measured" % \
+    (len(rtts), pairs, 100.0 * len(rtts) / pairs)
+  if len(rtts) > 0:
+    print "rtt ms: p10=%.1f p50=%.1f p90=%.1f max=%.1f" % (percentile(rtts, 0.1), \
+      percentile(rtts, 0.5), percentile(rtts, 0.9), max(rtts))
+
+#############################
+# Here are the unit tests
+#############################
+
+class TestRttProbe(unittest.TestCase):
+  def setUp(self):
+    import ringemu, threading, tempfile
+    self.ring = ringemu.VirtualRing(60)
+    self.server = ringemu.make_server(self.ring, 0)
+    t = threading.Thread(target = self.server.serve_forever)
+    t.daemon = True
+    t.start()
+    self.port = self.server.server_address[1]
+    self.dir = tempfile.mkdtemp()
+    self.prefix = os.path.join(self.dir, "campaign")
+    self.nodes = [str(pybru.Address(a)) for a in self.ring.addrs]
+
+  def tearDown(self):
+    import shutil
+    self.server.shutdown()
+    self.server.server_close()
+    shutil.rmtree(self.dir)
+
+  def probe(self, campaign, budget, rate = 0):
+    client = asyncbru.Client(self.port, connections = 8)
+    Prober(client, campaign, budget, rate, 1, 10, 1).run()
+    client.close()
+
+  def check(self, matrix, places = 7):
+    for ((i, j), rtt) in matrix.items():
+      self.assertTrue(i < j)
+      self.assertAlmostEqual(rtt, self.ring.latency(self.ring.addrs[i], \
+        self.ring.addrs[j]), places)
+
+  def testResume(self):
+    campaign = Campaign(self.prefix, self.nodes)
+    self.probe(campaign, 100)
+    self.assertEqual((campaign.done, campaign.failed), (100, 0))
+    self.assertTrue(campaign.matrix.measured() > 100)
+    self.check(campaign.matrix)
+    measured = campaign.matrix.items()
+    campaign.close()
+    #an interrupted write at the end of the files
+    f = open(self.prefix + ".samples", "a")
+    f.write("1 2")
+    f.close()
+    campaign = Campaign(self.prefix, reversed(self.nodes))
+    self.assertEqual(campaign.nodes, self.nodes)
+    self.assertEqual(campaign.done, 100)
+    self.assertEqual(len(campaign.matrix.items()), len(measured))
+    self.check(campaign.matrix, 4)
+    self.probe(campaign, 150)
+    campaign.close()
+    f = open(self.prefix + ".probes")
+    probes = [tuple(line.split()[:2]) for line in f]
+    f.close()
+    self.assertEqual(len(probes), 150)
+    self.assertEqual(len(set([pair(int(i), int(j)) for (i, j) in probes])), 150)
+
+  def testEdges(self):
+    campaign = Campaign(self.prefix, self.nodes)
+    self.probe(campaign, 120)
+    edges = [0] * len(self.nodes)
+    for ((i, j), rtt) in campaign.matrix.items():
+      edges[i] += 1
+      edges[j] += 1
+    self.assertEqual(campaign.edges, edges)
+    #nodes without a measured edge are preferred, none is left after 2 per node
+    self.assertEqual(edges.count(0), 0)
+    campaign.close()
+    campaign = Campaign(self.prefix)
+    self.assertEqual(campaign.edges, edges)
+    campaign.close()
+
+  def testDense(self):
+    campaign = Campaign(self.prefix, self.nodes, True)
+    start = time.time()
+    self.probe(campaign, 30, 100)
+    self.assertTrue(time.time() - start > 0.25)
+    self.check(campaign.matrix, 3)
+    sparse = SparseMatrix()
+    for (i, j, rtt) in campaign.read(".samples"):
+      sparse.add(int(i), int(j), float(rtt))
+    campaign.close()
+    #reopened without the flag it is still dense
+    campaign = Campaign(self.prefix)
+    self.assertTrue(isinstance(campaign.matrix, DenseMatrix))
+    out = open(self.prefix + ".rtt", "w")
+    export(campaign.matrix, out)
+    out.close()
+    campaign.close()
+    f = open(self.prefix + ".rtt")
+    lines = [line.split() for line in f]
+    f.close()
+    self.assertEqual([(int(i), int(j)) for (i, j, rtt) in lines], \
+      [p for (p, rtt) in sparse.items()])
+    for ((i, j, rtt), (p, expected)) in zip(lines, sparse.items()):
+      self.assertAlmostEqual(float(rtt), expected, 3)
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,234 @@
+#!/usr/bin/python
+""" A selective decoder for xmlrpc responses.  xmlrpclib builds the whole
+response into python objects before a caller looks at it, for an
+Information.Info crawl or a large DhtClient.Get that is most of the client's
+cpu time.  This decoder is fed the response as it arrives and only builds the
+struct members on the wanted paths, everything else is skipped in the parser.
+
+A path is the dotted member names from the result down, arrays do not add to
+the path, so for a proxy call returning [Info] "neighbors" keeps
+result[0]['neighbors'] and all under it and "neighbors.right" only its right
+member.  Members above a wanted path are kept with just the wanted members in
+them, values outside of structs (arrays of arrays, scalars) are always kept
+and so are faults.  base64 values come back as memoryviews of the decoded
+bytes rather than xmlrpclib.Binary, strings as utf-8 encoded str.
+
+Scripts get a selective proxy with rpcstats.Server(url, select = paths) or
+Server(url, paths) here. """
+import xmlrpclib, base64, sys, unittest
+from xml.parsers import expat
+
+usage = """usage:
+python xmlselect.py test"""
+
+def main():
+  if len(sys.argv) > 1 and sys.argv[1] == "test":
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestXmlSelect)
+    unittest.TextTestRunner(verbosity=1).run(suite)
+    return
+  print usage
+
+def _int(data):
+  return int(data)
+
+def _boolean(data):
+  return data.strip() == "1"
+
+def _double(data):
+  return float(data)
+
+def _string(data):
+  return data
+
+def _datetime(data):
+  return xmlrpclib.DateTime(data)
+
+def _base64(data):
+  return memoryview(base64.decodestring(data))
+
+def _nil(data):
+  return None
+
+SCALARS = {'int' : _int, 'i4' : _int, 'i8' : _int, 'boolean' : _boolean,
+           'double' : _double, 'string' : _string, 'base64' : _base64,
+           'dateTime.iso8601' : _datetime, 'nil' : _nil}
+
+class Frame:
+  """An array or struct being built, for a struct name is the member it is in"""
+  def __init__(self, container):
+    self.container = container
+    self.name = None
+
+class SelectiveUnmarshaller:
+  """The expat handlers building the result, close returns the params tuple
+  like xmlrpclib.Unmarshaller or raises the Fault"""
+  def __init__(self, paths = None):
+    self.paths = None
+    if paths:
+      self.paths = [tuple(p.split(".")) for p in paths]
+    self.frames = []
+    self.result = []
+    self.fault = False
+    self.data = []
+    #for each open value whether a type element was in it
+    self.typed = []
+    #depth of the elements of a skipped value, 0 when not skipping
+    self.skip = 0
+    self.skip_next = False
+
+  def wanted(self, path):
+    if self.paths == None or self.fault:
+      return True
+    for p in self.paths:
+      if p[:len(path)] == path or path[:len(p)] == p:
+        return True
+    return False
+
+  def path(self):
+    return tuple([f.name for f in self.frames if isinstance(f.container, dict)])
+
+  def add(self, value):
+    if len(self.frames) == 0:
+      self.result.append(value)
+    elif isinstance(self.frames[-1].container, dict):
+      self.frames[-1].container[self.frames[-1].name] = value
+    else:
+      self.frames[-1].container.append(value)
+
+  def start(self, tag, attrs):
+    if self.skip:
+      self.skip += 1
+      return
+    if tag == "value":
+      if self.skip_next:
+        self.skip_next = False
+        self.skip = 1
+        return
+      self.typed.append(False)
+      self.data = []
+      return
+    if tag in SCALARS or tag == "struct" or tag == "array":
+      if len(self.typed) > 0:
+        self.typed[-1] = True
+      self.data = []
+      if tag == "struct":
+        self.frames.append(Frame({}))
+      elif tag == "array":
+        self.frames.append(Frame([]))
+    elif tag == "name":
+      self.data = []
+    elif tag == "fault":
+      self.fault = True
+
+  def chardata(self, data):
+    if not self.skip:
+      self.data.append(data)
+
+  def end(self, tag):
+    if self.skip:
+      self.skip -= 1
+      return
+    if tag in SCALARS:
+      self.add(SCALARS[tag]("".join(self.data)))
+    elif tag == "struct" or tag == "array":
+      self.add(self.frames.pop().container)
+    elif tag == "value":
+      if not self.typed.pop():
+        self.add("".join(self.data))
+    elif tag == "name":
+      self.frames[-1].name = "".join(self.data)
+      self.skip_next = not self.wanted(self.path())
+
+  def close(self):
+    if self.fault:
+      raise xmlrpclib.Fault(**self.result[0])
+    return tuple(self.result)
+
+  def getmethodname(self):
+    return None
+
+class SelectiveParser:
+  def __init__(self, target):
+    self._parser = parser = expat.ParserCreate(None, None)
+    parser.returns_unicode = False
+    parser.buffer_text = True
+    parser.StartElementHandler = target.start
+    parser.EndElementHandler = target.end
+    parser.CharacterDataHandler = target.chardata
+
+  def feed(self, data):
+    self._parser.Parse(data, 0)
+
+  def close(self):
+    self._parser.Parse("", 1)
+    del self._parser
+
+def getparser(paths):
+  """(parser, unmarshaller) as from xmlrpclib.getparser, keeping paths"""
+  target = SelectiveUnmarshaller(paths)
+  return SelectiveParser(target), target
+
+class SelectiveTransport(xmlrpclib.Transport):
+  def __init__(self, paths, use_datetime = 0):
+    xmlrpclib.Transport.__init__(self, use_datetime)
+    self.paths = paths
+
+  def getparser(self):
+    return getparser(self.paths)
+
+def Server(url, paths, **kwargs):
+  return xmlrpclib.ServerProxy(url, transport = SelectiveTransport(paths), **kwargs)
+
+def decode(response, paths = None):
+  """The params of an xmlrpc response string"""
+  parser, target = getparser(paths)
+  parser.feed(response)
+  parser.close()
+  return target.close()
+
+#############################
+# Here are the unit tests
+#############################
+
+class TestXmlSelect(unittest.TestCase):
+  info = {'neighbors' : {'self' : "brunet:node:A", 'right' : "brunet:node:B",
+                         'left' : "brunet:node:C"},
+          'localips' : ["10.0.0.1", "10.0.0.2"], 'geo_loc' : "29.6, -82.3",
+          'type' : "BasicNode", 'structured' : [["a", "b"], [1, 2.5, True]],
+          'big' : {'blob' : xmlrpclib.Binary("x" * 100), 'n' : None}}
+
+  def response(self, params):
+    return xmlrpclib.dumps(params, methodresponse = True, allow_none = True)
+
+  def testAll(self):
+    res = decode(self.response(([self.info, 7],)))[0]
+    self.assertEqual(res[1], 7)
+    self.assertEqual(res[0]['neighbors'], self.info['neighbors'])
+    self.assertEqual(res[0]['structured'], self.info['structured'])
+    self.assertEqual(res[0]['big']['blob'].tobytes(), "x" * 100)
+    self.assertEqual(res[0]['big']['n'], None)
+
+  def testSelect(self):
+    res = decode(self.response(([self.info],)), ["neighbors.right", "type", \
+      "localips"])[0][0]
+    self.assertEqual(sorted(res.keys()), ["localips", "neighbors", "type"])
+    self.assertEqual(res['neighbors'], {'right' : "brunet:node:B"})
+    self.assertEqual(res['localips'], self.info['localips'])
+    #the results of a dht get, only the values
+    values = [{'value' : xmlrpclib.Binary("v%i" % i), 'ttl' : i, 'age' : 0} \
+      for i in xrange(3)]
+    res = decode(self.response((values,)), ["value"])[0]
+    self.assertEqual([r.keys() for r in res], [['value']] * 3)
+    self.assertEqual([r['value'].tobytes() for r in res], ["v0", "v1", "v2"])
+
+  def testFault(self):
+    fault = xmlrpclib.dumps(xmlrpclib.Fault(3, "no such method"), methodresponse = True)
+    try:
+      decode(fault, ["type"])
+      self.fail()
+    except xmlrpclib.Fault, f:
+      self.assertEqual(f.faultCode, 3)
+      self.assertEqual(f.faultString, "no such method")
+
+if __name__ == "__main__":
+  main()
@@ -29,6 +29,10 @@ using Brunet.Util;
 /** Base map-reduce tasks. */
 using Brunet.Messaging;
 using Brunet.Symphony;
+#if BRUNET_NUNIT
+using Brunet.Transport;
+using NUnit.Framework;
+#endif
 namespace Brunet.Services.MapReduce {
   /** 
    * The following class provides a base class for tasks utilizing a greedy tree
@@ -74,6 +78,8 @@ namespace Brunet.Services.MapReduce {
      * Let the connections be b_1, b_2, ..... b_n.
      * To connection bi assign the range [b_i, b_{i+1}).
      * To the connection bn assign range [b_n, end).]
+     * The children keep the task name of mr_args, so the tree also works
+     * as the tree of another task (e.g. mapreduce.tree: in an RpcMapReduceTask).
      */
     public override void GenerateTree(Channel q, MapReduceArgs mr_args) 
     {
@@ -110,7 +116,7 @@ namespace Brunet.Services.MapReduce {
           //check if last connection
           if (i == con_list.Count - 1) {
             mr_info = new MapReduceInfo( (ISender) sender, 
-                                         new MapReduceArgs(this.TaskName, 
+                                         new MapReduceArgs(mr_args.TaskName, 
                                                            mr_args.MapArg, //map argument
                                                            end_range, //generate argument
                                                            mr_args.ReduceArg //reduce argument
@@ -124,7 +130,7 @@ namespace Brunet.Services.MapReduce {
           else {
             string child_end = ((Connection) con_list[i+1]).Address.ToString();
             mr_info = new MapReduceInfo( sender,
-                                         new MapReduceArgs(this.TaskName,
+                                         new MapReduceArgs(mr_args.TaskName,
                                                            mr_args.MapArg, 
                                                            child_end,
                                                            mr_args.ReduceArg));
@@ -158,4 +164,49 @@ namespace Brunet.Services.MapReduce {
       }
     } 
   }
+
+#if BRUNET_NUNIT
+  [TestFixture]
+  public class MapReduceBoundedBroadcastTest {
+    protected static AHAddress MakeAddress(byte last) {
+      byte[] buf = new byte[Address.MemSize];
+      buf[Address.MemSize - 1] = last;
+      return new AHAddress(buf);
+    }
+
+    [Test]
+    public void ChildTaskName() {
+      AHAddress local = MakeAddress(0x04);
+      Node n = new StructuredNode(local, "unittest");
+      TransportAddress home_ta =
+        TransportAddressFactory.CreateInstance("brunet.tcp://127.0.27.1:5000");
+      byte[] ends = new byte[]{0x10, 0x20, 0x30};
+      for(int i = 0; i < ends.Length; i++) {
+        TransportAddress ta = TransportAddressFactory.CreateInstance(
+                                String.Format("brunet.tcp://158.7.0.{0}:5000", i + 1));
+        n.ConnectionTable.Add(new Connection(new FakeEdge(home_ta, ta),
+                                             MakeAddress(ends[i]), "structured", null, null));
+      }
+      //the largest even address, the range covers every connection
+      byte[] buf = new byte[Address.MemSize];
+      for(int i = 0; i < buf.Length; i++) { buf[i] = 0xFF; }
+      buf[Address.MemSize - 1] = 0xFE;
+      string end = new AHAddress(buf).ToString();
+
+      //used as the tree of another task, the children run that task
+      MapReduceBoundedBroadcast tree = new MapReduceBoundedBroadcast(n);
+      MapReduceArgs args = new MapReduceArgs("pyringstats", "map", end, "reduce");
+      Channel q = new Channel(1);
+      tree.GenerateTree(q, args);
+      MapReduceInfo[] children = (MapReduceInfo[]) q.Dequeue();
+      Assert.AreEqual(ends.Length, children.Length, "one child per connection");
+      foreach(MapReduceInfo mri in children) {
+        Assert.AreEqual("pyringstats", mri.Args.TaskName, "child task name");
+        Assert.AreEqual("map", mri.Args.MapArg, "child map arg");
+        Assert.AreEqual("reduce", mri.Args.ReduceArg, "child reduce arg");
+      }
+      Assert.AreEqual(end, children[ends.Length - 1].Args.GenArg, "last child range end");
+    }
+  }
+#endif
 }
@@ -0,0 +1,83 @@
+/*
+This program is part of BruNet, a library for the creation of efficient overlay
+networks.
+Copyright (C) 2010  University of Florida
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+*/
+
+using System;
+using System.Collections;
+
+using Brunet.Concurrent;
+using Brunet.Connections;
+using Brunet.Util;
+
+using Brunet.Messaging;
+namespace Brunet.Services.MapReduce {
+  /**
+   * This class implements a map-reduce task that crawls a range of the ring.
+   * Each node in the bounded broadcast tree calls its local
+   * "Information.Info" method and the results are concatenated up the tree,
+   * so the caller receives a list with one Info entry per node in the range.
+   * Each entry also holds the node's structured connections, including
+   * shortcuts, under "structured" in ConnectionList.ToList format.
+   * Subtrees that fail are dropped rather than aborting the whole crawl.
+   */
+  public class MapReduceCrawl: MapReduceBoundedBroadcast {
+    public MapReduceCrawl(Node n):base(n) {}
+
+    public override void Map(Channel q, object map_arg) {
+      Channel result = new Channel(1, q);
+      result.CloseEvent += this.MapHandler;
+      _node.Rpc.Invoke(_node, result, "Information.Info");
+    }
+
+    protected void MapHandler(object o, EventArgs args) {
+      Channel result = (Channel) o;
+      Channel q = (Channel) result.State;
+      IList retval = new ArrayList();
+      try {
+        RpcResult r = (RpcResult) result.Dequeue();
+        IDictionary info = (IDictionary) r.Result;
+        ConnectionList structs = _node.ConnectionTable.GetConnections(ConnectionType.Structured);
+        info["structured"] = structs.ToList();
+        retval.Add(info);
+      }
+      catch(Exception x) {
+        //No Information handler or it timed out, report an empty list
+        Log("{0}: {1}, no Info available: {2}.", this.TaskName, _node.Address, x);
+      }
+      q.Enqueue(retval);
+    }
+
+    public override void Reduce(Channel q, object reduce_arg,
+                                  object current_result, RpcResult child_rpc) {
+      bool done = false;
+      ArrayList retval = new ArrayList();
+      if (current_result != null) {
+        retval.AddRange((IList) current_result);
+      }
+      try {
+        retval.AddRange((IList) child_rpc.Result);
+      }
+      catch(Exception x) {
+        //A failed child only loses its own subtree
+        Log("{0}: {1}, child failed: {2}.", this.TaskName, _node.Address, x);
+      }
+      q.Enqueue(new Brunet.Collections.Pair<object, bool>(retval, done));
+    }
+  }
+}
@@ -114,6 +114,7 @@ namespace Brunet.Symphony
       //Subscribe map-reduce tasks
       _mr_handler.SubscribeTask(new MapReduceTrace(this));
       _mr_handler.SubscribeTask(new MapReduceRangeCounter(this));
+      _mr_handler.SubscribeTask(new MapReduceCrawl(this));
 
       
       /*
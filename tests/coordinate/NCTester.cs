@@ -128,6 +128,65 @@ namespace Brunet.Coordinate {
 	  
 	}
       }
+      else if (mode.Equals("-e")) {
+	Random rr = new Random();
+	//
+	// Use only the measured pairs (e.g. the overlay edges of rttprobe.py),
+	// each node's neighbors are the nodes it has a latency to.
+	//
+	string edge_file = args[2].Trim();
+	int max_rounds = Int32.Parse(args[3]);
+	
+	ArrayList neighbors = new ArrayList();
+	ArrayList latencies = new ArrayList();
+	for (int i = 0; i < net_size; i++) {
+	  neighbors.Insert(i, new ArrayList());
+	  latencies.Insert(i, new ArrayList());
+	}
+	
+	StreamReader br = new StreamReader(new FileStream(edge_file, FileMode.Open, FileAccess.Read));
+	while(true) {
+	  string s = br.ReadLine();
+	  if (s == null) {
+	    break;
+	  }
+	  string[] ss = s.Split();
+	  int local_idx = Int32.Parse(ss[0]);
+	  int remote_idx = Int32.Parse(ss[1]);
+	  double rtt = double.Parse(ss[2]);
+	  ((ArrayList) neighbors[local_idx]).Add(remote_idx);
+	  ((ArrayList) latencies[local_idx]).Add(rtt);
+	  ((ArrayList) neighbors[remote_idx]).Add(local_idx);
+	  ((ArrayList) latencies[remote_idx]).Add(rtt);
+	}
+	
+	//
+	// Only the nodes with an edge take samples
+	//
+	ArrayList sampling = new ArrayList();
+	for (int i = 0; i < net_size; i++) {
+	  if (((ArrayList) neighbors[i]).Count > 0) {
+	    sampling.Add(i);
+	  }
+	}
+	
+	DateTime now = DateTime.Now;
+	int x = 0;
+	while (sampling.Count > 0 && x < max_rounds) {
+	  int local_idx = (int) sampling[rr.Next(0, sampling.Count)];
+	  ArrayList my_neighbors = (ArrayList) neighbors[local_idx];
+	  int k = rr.Next(0, my_neighbors.Count);
+	  int remote_idx = (int) my_neighbors[k];
+	  NCService nc_local = (NCService) nc_list[local_idx];
+	  Address addr_remote = (Address) addr_list[remote_idx];
+	  NCService nc_remote = (NCService) nc_list[remote_idx];
+	  NCService.VivaldiState remote_state = nc_remote.State;
+	  double o_rawLatency = (double) ((ArrayList) latencies[local_idx])[k];
+	  nc_local.ProcessSample(now + new TimeSpan(0, 0, x), addr_remote, remote_state.Position, 
+				 remote_state.WeightedError, o_rawLatency);
+	  x += 1;
+	}
+      }
       
       for (int i = 0; i < net_size; i++) {
 	NCService nc = (NCService) nc_list[i];
@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+
+# Converts a dot graph dump (N [pos nodes and a -> b [color= c]; edges) to a
+# compressed sparse row adjacency file, one edge array per colour, kept next to
+# the dump as <dump>.csr and memory mapped by later runs.  The file records
+# the size and mtime of the dump and is rebuilt when they change.
+#
+# Layout, little endian:
+#   header: magic, dump size, dump mtime, id count, node count, colour count
+#   per colour: name, edge count
+#   ids: the node ids sorted, every id in a node line or an edge
+#   is_node: 1 for the ids with a node line
+#   nodes: index of each node line's id, in the order of the dump
+#   per colour: offsets (id count + 1), degrees (id count) then targets, the
+#     edges of the id at index i are targets[offsets[i]:offsets[i + 1]] in the
+#     order of the dump
+#
+# usage: dotcsr.py <dot files> converts them and prints their sizes
+
+import re, os, sys, mmap, struct, array, bisect
+
+MAGIC = "DOTCSR2\0"
+HEADER = struct.Struct("<8sqdiii")
+COLOUR = struct.Struct("<16si")
+PAIR = struct.Struct("<ii")
+# row unpackers by length
+_rows = {}
+edge_re = re.compile(r"""(\d+) -> (\d+) \[color= (\w+)\];""")
+node_re = re.compile(r"""(\d+) \[pos""")
+
+def csr_name(dotfile):
+  return dotfile + ".csr"
+
+def parse(dotfile):
+  """[node ids], {colour : [(a, b)]} in the order of the dump"""
+  nodes = []
+  edges = {}
+  f = open(dotfile, 'r')
+  for line in f:
+    n_m = node_re.search(line)
+    if n_m:
+      nodes.append(int(n_m.group(1)))
+    else:
+      e_m = edge_re.search(line)
+      if e_m:
+        edges.setdefault(e_m.group(3), []).append((int(e_m.group(1)), int(e_m.group(2))))
+  f.close()
+  return nodes, edges
+
+def write_ints(values, out):
+  values = array.array('i', values)
+  if sys.byteorder == "big":
+    values.byteswap()
+  values.tofile(out)
+
+def build(dotfile, out):
+  st = os.stat(dotfile)
+  nodes, edges = parse(dotfile)
+  ids = set(nodes)
+  for colour_edges in edges.values():
+    for (a, b) in colour_edges:
+      ids.add(a)
+      ids.add(b)
+  ids = sorted(ids)
+  index = dict([(node, i) for (i, node) in enumerate(ids)])
+  colours = sorted(edges)
+  out.write(HEADER.pack(MAGIC, st.st_size, st.st_mtime, len(ids), len(nodes), len(colours)))
+  for colour in colours:
+    out.write(COLOUR.pack(colour, len(edges[colour])))
+  write_ints(ids, out)
+  is_node = array.array('i', [0]) * len(ids)
+  for node in nodes:
+    is_node[index[node]] = 1
+  write_ints(is_node, out)
+  write_ints([index[node] for node in nodes], out)
+  for colour in colours:
+    #a counting sort by source keeps the order of the dump in each row
+    offsets = array.array('i', [0]) * (len(ids) + 1)
+    for (a, b) in edges[colour]:
+      offsets[index[a] + 1] += 1
+    for i in xrange(len(ids)):
+      offsets[i + 1] += offsets[i]
+    fill = array.array('i', offsets)
+    targets = array.array('i', [0]) * len(edges[colour])
+    for (a, b) in edges[colour]:
+      i = index[a]
+      targets[fill[i]] = index[b]
+      fill[i] += 1
+    write_ints(offsets, out)
+    write_ints([offsets[i + 1] - offsets[i] for i in xrange(len(ids))], out)
+    write_ints(targets, out)
+
+def load(dotfile):
+  """The CSRGraph of dotfile, converting it first if there is no up to date
+  .csr next to it"""
+  name = csr_name(dotfile)
+  st = os.stat(dotfile)
+  try:
+    graph = CSRGraph(name)
+    if graph.size == st.st_size and graph.mtime == st.st_mtime:
+      return graph
+    graph.close()
+  except (IOError, OSError, ValueError, struct.error):
+    pass
+  tmp = "%s.%i.tmp" % (name, os.getpid())
+  try:
+    out = open(tmp, "wb")
+  except IOError:
+    #no writing next to the dump, convert in memory
+    import cStringIO
+    out = cStringIO.StringIO()
+    build(dotfile, out)
+    return CSRGraph(data = out.getvalue())
+  try:
+    build(dotfile, out)
+    out.close()
+    os.rename(tmp, name)
+  except:
+    out.close()
+    os.remove(tmp)
+    raise
+  return CSRGraph(name)
+
+def row_struct(count):
+  if count not in _rows:
+    _rows[count] = struct.Struct("<%ii" % count)
+  return _rows[count]
+
+class CSRGraph:
+  """Rows and single values are unpacked straight from the mapped file, so
+  walking the graph a node at a time copies nothing else out of it.  The
+  whole arrays (ids, offsets, degrees, targets) are copied out once when
+  first asked for: the python 2 mmap does not support the new buffer
+  protocol, so no memoryview can be taken of it to view as an array, and
+  bisect and the block compares of graph_series.py need one to run in C."""
+  def __init__(self, filename = None, data = None):
+    self.file = None
+    if filename != None:
+      self.file = open(filename, "rb")
+      data = mmap.mmap(self.file.fileno(), 0, access = mmap.ACCESS_READ)
+    self.data = data
+    (magic, self.size, self.mtime, self.n_ids, self.n_nodes, n_colours) = \
+      HEADER.unpack_from(data, 0)
+    if magic != MAGIC:
+      raise ValueError("not a csr file")
+    pos = HEADER.size
+    counts = []
+    for i in xrange(n_colours):
+      (colour, n_edges) = COLOUR.unpack_from(data, pos)
+      counts.append((colour.rstrip("\0"), n_edges))
+      pos += COLOUR.size
+    self.ids_at = pos
+    self.is_node_at = pos + 4 * self.n_ids
+    self.nodes_at = self.is_node_at + 4 * self.n_ids
+    pos = self.nodes_at + 4 * self.n_nodes
+    #colour -> (offsets position, targets position, edge count), the degrees
+    #are between the two
+    self.colours = {}
+    for (colour, n_edges) in counts:
+      self.colours[colour] = (pos, pos + 4 * (2 * self.n_ids + 1), n_edges)
+      pos += 4 * (2 * self.n_ids + 1 + n_edges)
+    if pos > len(data):
+      raise ValueError("truncated csr file")
+    self.arrays = {}
+
+  def close(self):
+    if self.file != None:
+      self.data.close()
+      self.file.close()
+
+  def ints(self, pos, count):
+    """The array of count ints at pos, copied out of the mapping once"""
+    if (pos, count) not in self.arrays:
+      values = array.array('i')
+      values.fromstring(self.data[pos:pos + 4 * count])
+      if sys.byteorder == "big":
+        values.byteswap()
+      self.arrays[(pos, count)] = values
+    return self.arrays[(pos, count)]
+
+  def node_ids(self):
+    """The id of every index"""
+    return self.ints(self.ids_at, self.n_ids)
+
+  def index(self, node):
+    """The index of a node id, -1 if the dump does not have it"""
+    ids = self.node_ids()
+    i = bisect.bisect_left(ids, node)
+    if i < len(ids) and ids[i] == node:
+      return i
+    return -1
+
+  def nodes(self):
+    """The indexes of the node lines in the order of the dump"""
+    return self.ints(self.nodes_at, self.n_nodes)
+
+  def is_node(self, i):
+    return row_struct(1).unpack_from(self.data, self.is_node_at + 4 * i)[0] == 1
+
+  def offsets(self, colour):
+    return self.ints(self.colours[colour][0], self.n_ids + 1)
+
+  def row(self, colour, i):
+    """The indexes i has colour edges to"""
+    if colour not in self.colours:
+      return ()
+    (offsets_at, targets_at, n_edges) = self.colours[colour]
+    (start, end) = PAIR.unpack_from(self.data, offsets_at + 4 * i)
+    return row_struct(end - start).unpack_from(self.data, targets_at + 4 * start)
+
+  def targets(self, colour):
+    (offsets_at, targets_at, n_edges) = self.colours[colour]
+    return self.ints(targets_at, n_edges)
+
+  def degrees(self, colour):
+    """The colour out degree of every index"""
+    if colour not in self.colours:
+      return array.array('i', [0]) * self.n_ids
+    return self.ints(self.colours[colour][0] + 4 * (self.n_ids + 1), self.n_ids)
+
+if __name__ == "__main__":
+  for file in sys.argv[1:]:
+    graph = load(file)
+    print "%s: %i nodes, %i ids, %s" % (csr_name(file), graph.n_nodes, graph.n_ids, \
+      ", ".join(["%s %i edges" % (c, graph.colours[c][2]) for c in sorted(graph.colours)]))
+    graph.close()
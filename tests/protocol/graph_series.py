@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+
+# Checks a series of dot graphs, one per time step, for the invariants of
+# graph_check.py (leaf and struct edges are symmetric, x -> x+1 and x+2 struct
+# edges exist) and prints what changed from one step to the next: the edges
+# added and removed and the violations that appeared and went away.
+#
+# Only the first graph is checked in full.  After it the rows of the two
+# graphs (read through dotcsr.py) are compared a block of ids at a time, in C,
+# and only the nodes whose edges changed, and the nodes at the other end of
+# those edges, are checked again, so a step costs about as much as its changes.
+# When nodes come or go the ids both graphs have are still in the same order,
+# so the blocks are compared shifted by the ids added and removed before them,
+# with the edge targets as ids rather than indexes.
+#
+# usage: graph_series.py <dot files in time order>
+
+import sys, array, bisect
+import dotcsr
+
+# invariant names and the colour of the edges they are about
+COLOURS = [("leaf", "blue"), ("struct", "red")]
+BLOCK = 256
+
+def row_ids(graph, colour, node):
+  i = graph.index(node)
+  if i == -1:
+    return ()
+  ids = graph.node_ids()
+  return [ids[t] for t in graph.row(colour, i)]
+
+def node_set(graph):
+  ids = graph.node_ids()
+  return set([ids[i] for i in graph.nodes()])
+
+# The colour edge targets of graph as ids
+def target_ids(graph, colour):
+  return array.array('i', map(graph.node_ids().__getitem__, graph.targets(colour)))
+
+# (start, end, shift) runs of old indexes whose id is at index + shift in new,
+# between the ids only one of the graphs has
+def aligned_runs(old, gone, came):
+  old_ids = old.node_ids()
+  runs = []
+  i = shift = 0
+  for (node, d) in sorted([(n, -1) for n in gone] + [(n, 1) for n in came]):
+    if d < 0:
+      #the ids after a removed one move down
+      k = old.index(node)
+      runs.append((i, k, shift))
+      i = k + 1
+    else:
+      #and the ids after an added one up
+      k = bisect.bisect_left(old_ids, node)
+      runs.append((i, k, shift))
+      i = k
+    shift += d
+  runs.append((i, len(old_ids), shift))
+  return [run for run in runs if run[0] < run[1]]
+
+# The ids whose colour edges differ between old and new
+def changed_rows(old, new, colour):
+  old_ids = old.node_ids()
+  new_ids = new.node_ids()
+  if colour not in old.colours and colour not in new.colours:
+    return set()
+  if colour not in old.colours or colour not in new.colours:
+    graph = old if colour in old.colours else new
+    ids = graph.node_ids()
+    degrees = graph.degrees(colour)
+    return set([ids[i] for i in xrange(len(ids)) if degrees[i] > 0])
+  old_deg, new_deg = old.degrees(colour), new.degrees(colour)
+  old_off, new_off = old.offsets(colour), new.offsets(colour)
+  changed = set()
+  if old_ids == new_ids:
+    runs = [(0, len(old_ids), 0)]
+    old_t, new_t = old.targets(colour), new.targets(colour)
+  else:
+    #nodes came or went, a node only one graph has changed if it has edges
+    old_set = set(old_ids)
+    new_set = set(new_ids)
+    gone = old_set - new_set
+    came = new_set - old_set
+    changed.update([n for n in gone if old_deg[old.index(n)] > 0])
+    changed.update([n for n in came if new_deg[new.index(n)] > 0])
+    runs = aligned_runs(old, gone, came)
+    old_t, new_t = target_ids(old, colour), target_ids(new, colour)
+  for (first, last, shift) in runs:
+    for start in xrange(first, last, BLOCK):
+      end = min(start + BLOCK, last)
+      #the same degrees and the same edges in a block mean the same rows
+      if old_deg[start:end] == new_deg[start + shift:end + shift] and \
+        old_t[old_off[start]:old_off[end]] == \
+        new_t[new_off[start + shift]:new_off[end + shift]]:
+        continue
+      for i in xrange(start, end):
+        j = i + shift
+        if old_t[old_off[i]:old_off[i + 1]] != new_t[new_off[j]:new_off[j + 1]]:
+          changed.add(old_ids[i])
+  return changed
+
+class Checker:
+  """The current violations, by the node they start from"""
+  def __init__(self):
+    self.violations = {}
+    self.nodes = set()
+    self.bounds = None
+
+  def all(self):
+    res = set()
+    for v in self.violations.values():
+      res |= v
+    return res
+
+  def check(self, graph, nodes, kinds):
+    """Replaces the violations of kinds starting at nodes with the ones in
+    graph"""
+    for node in nodes:
+      old = self.violations.get(node, set())
+      current = set([v for v in old if v[0] not in kinds])
+      if node in self.nodes:
+        current |= self.node_violations(graph, node, kinds)
+      if len(current) > 0:
+        self.violations[node] = current
+      elif node in self.violations:
+        del self.violations[node]
+
+  def node_violations(self, graph, node, kinds):
+    res = set()
+    for (name, colour) in COLOURS:
+      if name not in kinds:
+        continue
+      for partner in row_ids(graph, colour, node):
+        if node not in row_ids(graph, colour, partner):
+          res.add((name, node, partner))
+    if "missing" in kinds:
+      structs = row_ids(graph, "red", node)
+      (min_node, max_node) = self.bounds
+      for d in (1, 2):
+        target = node + d
+        if target > max_node:
+          target = target - max_node - 1 + min_node
+        if target not in structs:
+          res.add(("missing", node, target))
+    return res
+
+  def step(self, old, new):
+    """Updates the violations from graph old to new, returns the count of
+    edges added and removed and of nodes added and removed"""
+    nodes = node_set(new)
+    added_nodes = nodes - self.nodes
+    removed_nodes = self.nodes - nodes
+    self.nodes = nodes
+    bounds = self.bounds
+    if len(nodes) > 0:
+      self.bounds = (min(nodes), max(nodes))
+    added = removed = 0
+    changed_red = set()
+    for (name, colour) in COLOURS:
+      if old == None:
+        self.check(new, nodes, [name])
+        continue
+      changed = changed_rows(old, new, colour)
+      affected = set(changed) | added_nodes | removed_nodes
+      for node in changed:
+        before = set(row_ids(old, colour, node))
+        after = set(row_ids(new, colour, node))
+        added += len(after - before)
+        removed += len(before - after)
+        affected |= before | after
+      self.check(new, affected, [name])
+      if colour == "red":
+        changed_red = changed
+    if old == None or bounds != self.bounds:
+      self.check(new, nodes | removed_nodes, ["missing"])
+    else:
+      self.check(new, changed_red | added_nodes | removed_nodes, ["missing"])
+    return added, removed, len(added_nodes), len(removed_nodes)
+
+def describe(v):
+  if v[0] == "missing":
+    return "%i -> %i struct missing" % (v[1], v[2])
+  return "%s: %i -> %i but not vice-versa" % v
+
+if __name__ == "__main__":
+  checker = Checker()
+  old = None
+  for file in sys.argv[1:]:
+    graph = dotcsr.load(file)
+    before = checker.all()
+    (added, removed, joined, left) = checker.step(old, graph)
+    after = checker.all()
+    print "###  %s ###" % file
+    print "edges +%i -%i, nodes +%i -%i, violations %i (+%i -%i)" % (added, \
+      removed, joined, left, len(after), len(after - before), len(before - after))
+    for v in sorted(after - before):
+      print "+ " + describe(v)
+    for v in sorted(before - after):
+      print "- " + describe(v)
+    if old != None:
+      old.close()
+    old = graph
+  if old != None:
+    old.close()
@@ -2,56 +2,36 @@
 
 #Checks the unstructured part of a network.
 from __future__ import division
-import re
 import sys
+import dotcsr
 
 files = sys.argv[1:];
-edge_re = re.compile(r"""(\d+) -> (\d+) \[color= (red|blue|green)\];""")
-node_re = re.compile(r"""(\d+) \[pos""")
 max_k = 0
 for file in files:
   print "###  %s ###" % file
-  myfile = open(file, 'r');
+  #the graph is read through its csr cache (see dotcsr.py)
+  graph = dotcsr.load(file)
 
-  neighbors = {}
-  node_list = []
-  #load the graph
-  for line in myfile.readlines():
-    n_m = node_re.search(line);
-    if n_m:
-      node = int( n_m.group(1) )
-      node_list.append(node)
-      if node not in neighbors:
-        neighbors[node] = []
-    else:
-      e_m = edge_re.search(line);
-      if e_m:
-        n1 = int(e_m.group(1));
-        n2 = int(e_m.group(2));
-        if e_m.group(3) == "green":
-          if n1 in neighbors:
-            neighbors[n1].append(n2);
-          else:
-            neighbors[n1] = [ n2 ];
+  node_list = graph.nodes()
+  ids = graph.node_ids()
+  degrees = graph.degrees("green")
   #Check for sanity:
-  for node in node_list:
-    if node in neighbors:
-      if len(neighbors[node]) > max_k:
-        max_k = len(neighbors[node])
-      print "#%i has %i cons" % (node, len(neighbors[node]))
-    else:
-      print "#%i has 0 cons" % (node)
+  for i in node_list:
+    node = ids[i]
+    if degrees[i] > max_k:
+      max_k = degrees[i]
+    print "#%i has %i cons" % (node, degrees[i])
     #check that A -> B means B -> A
-    if node in neighbors:
-      for partner in neighbors[node]:
-        if node not in neighbors[partner]:
-          print "#%i -> %i but not vice-versa" % (node, partner)
+    for partner in graph.row("green", i):
+      if i not in graph.row("green", partner):
+        print "#%i -> %i but not vice-versa" % (node, ids[partner])
   #Print the CDF 
   deg_count = [0 for i in xrange(max_k + 1)];
   n_tot = len(node_list)
-  for (node, neighs) in neighbors.iteritems():
-    k = len(neighs);
-    deg_count[k] = deg_count[k] + 1;
+  for i in xrange(graph.n_ids):
+    if graph.is_node(i) or degrees[i] > 0:
+      k = degrees[i];
+      deg_count[k] = deg_count[k] + 1;
   rem = n_tot
   ccdf = open(file + ".ccdf", 'w') 
   for i in range(max_k + 1):
@@ -72,4 +52,4 @@ for file in files:
   gnuplot.write("plot f(x), \"%s.ccdf\" w l\n" % (file))
   gnuplot.close();
   print "# run this by typing: load \"%s.gnuplot\" in gnuplot\n" % (file)
-  myfile.close()
+  graph.close()